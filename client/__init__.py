@@ -0,0 +1,4 @@
+"""
+Example clients that query notaries and verify their replies.
+They only need the files in this directory, so they can be copied and used on their own.
+"""
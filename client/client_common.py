@@ -14,8 +14,9 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import struct
 import base64
+import binascii
+import struct
 import urllib
 import time 
 from xml.dom.minidom import parseString
@@ -36,35 +37,16 @@ def fetch_notary_xml(notary_server, notary_port, service_id):
 	return (code,xml_text)
 	
 def verify_notary_signature(service_id, notary_xml_text, notary_pub_key_text): 
- 
-	notary_reply = parseString(notary_xml_text).documentElement
-	packed_data = ""
 
-	keys = notary_reply.getElementsByTagName("key")
-	for k in keys:
-        	timespans = k.getElementsByTagName("timestamp")
-        	num_timespans = len(timespans)
-        	head = struct.pack("BBBBB", (num_timespans >> 8) & 255, num_timespans & 255, 0, 16,3)
-        	fingerprint = k.getAttribute("fp")
-        	fp_bytes = ""
-		for hex_byte in fingerprint.split(":"):
-                	fp_bytes += struct.pack("B", int(hex_byte,16))
-		ts_bytes = ""
-        	for ts in timespans:
-                	ts_start = int(ts.getAttribute("start"))
-                	ts_end  = int(ts.getAttribute("end"))
-                	ts_bytes += struct.pack("BBBB", ts_start >> 24 & 255,
-                                                   ts_start >> 16 & 255,
-                                                   ts_start >> 8 & 255,
-                                                   ts_start & 255)
-                	ts_bytes += struct.pack("BBBB", ts_end >> 24 & 255,
-                                                   ts_end >> 16 & 255,
-                                                   ts_end >> 8 & 255,
-                                                   ts_end & 255)
-		packed_data =(head + fp_bytes + ts_bytes) + packed_data   
+	notary_reply = parseString(notary_xml_text).documentElement
 
+	signed_keys = []
+	for k in notary_reply.getElementsByTagName("key"):
+		timespans = [(int(ts.getAttribute("start")), int(ts.getAttribute("end")))
+			for ts in k.getElementsByTagName("timestamp")]
+		signed_keys.append((k.getAttribute("fp"), timespans))
 
-	packed_data = service_id +  struct.pack("B",0) + packed_data
+	packed_data = pack_service(service_id, signed_keys)
 
 	sig_raw = base64.standard_b64decode(notary_reply.getAttribute("sig")) 
 	bio = BIO.MemoryBuffer(notary_pub_key_text)
@@ -77,6 +59,36 @@ def verify_notary_signature(service_id, notary_xml_text, notary_pub_key_text):
 	pubkey.verify_update(packed_data)
 	return pubkey.verify_final(sig_raw)
 
+# The data notaries sign is packed the same way as util/packing.py in the notary server.
+# It is copied here so the client can be used on its own; change both together.
+
+def pack_key(fingerprint, timespans):
+	"""
+	Pack one key and its timespans.
+	'fingerprint' is a hex string with bytes separated by colons; 'timespans' is a list of (start, end) pairs.
+	Raises ValueError if the fingerprint is not valid.
+	"""
+	head = struct.pack(">HBBB", len(timespans) & 0xFFFF, 0, 16, 3)
+
+	parts = fingerprint.split(":")
+	hex_digits = "".join(part.zfill(2) for part in parts)
+	if (len(hex_digits) != 2 * len(parts) or "" in parts):
+		raise ValueError("Invalid fingerprint '%s'" % fingerprint)
+	try:
+		fp_bytes = binascii.unhexlify(hex_digits)
+	except TypeError:
+		raise ValueError("Invalid fingerprint '%s'" % fingerprint)
+
+	times = [t for pair in timespans for t in pair]
+	return head + fp_bytes + struct.pack(">%dI" % len(times), *times)
+
+def pack_service(service_id, keys):
+	"""Pack a list of (fingerprint, timespans) tuples for a service, in the order they appear in the reply."""
+	packed_keys = [pack_key(fingerprint, timespans) for (fingerprint, timespans) in keys]
+	# keys are signed in the reverse order they appear
+	packed_keys.reverse()
+	return service_id.encode() + "\x00" + "".join(packed_keys)
+
 def notary_reply_as_text(notary_xml_text): 
 	t = ""
 	notary_reply = parseString(notary_xml_text).documentElement
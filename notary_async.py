@@ -0,0 +1,631 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Event-driven front end for the notary web server.
+
+Serves the same API as the CherryPy front end from one thread with asyncore,
+so idle keep-alive connections do not each need a worker thread.
+Lookups that can block - database queries and external caches -
+and signing new replies are handed to small, bounded pools of threads.
+
+Like the CherryPy front end we do *not* record any information about clients:
+there is no access log, request headers are never logged,
+and a client's address is discarded as soon as its connection is accepted -
+we only keep whether it connected from this machine, for the /metrics access check.
+"""
+
+import asynchat
+import asyncore
+import BaseHTTPServer
+import collections
+import email.utils
+import errno
+import fcntl
+import mimetypes
+import os
+import Queue
+import select
+import socket
+import threading
+import time
+import urlparse
+
+import cherrypy
+from cherrypy.lib.httputil import HeaderMap
+
+from util import cache, metrics_registry
+
+
+class Waker(asyncore.file_dispatcher):
+	"""Run callbacks on the event loop on behalf of other threads."""
+
+	def __init__(self, map):
+		(read_fd, self.write_fd) = os.pipe()
+		flags = fcntl.fcntl(self.write_fd, fcntl.F_GETFL)
+		fcntl.fcntl(self.write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+		# file_dispatcher uses its own copy of the file descriptor
+		asyncore.file_dispatcher.__init__(self, read_fd, map)
+		os.close(read_fd)
+		self.callbacks = collections.deque()
+
+	def call_soon(self, callback, *args):
+		"""Queue callback(*args) to run on the event loop. Safe to call from any thread."""
+		self.callbacks.append((callback, args))
+		try:
+			os.write(self.write_fd, "x")
+		except OSError as e:
+			# a full pipe will wake the loop anyway
+			if (e.errno != errno.EAGAIN):
+				raise
+
+	def writable(self):
+		return False
+
+	def handle_read(self):
+		try:
+			self.recv(4096)
+		except (OSError, socket.error):
+			pass
+
+		while (len(self.callbacks) > 0):
+			(callback, args) = self.callbacks.popleft()
+			try:
+				callback(*args)
+			except Exception:
+				cherrypy.log.error("Error running callback", 'ASYNC', traceback=True)
+
+
+class WorkerPool(object):
+	"""
+	A fixed number of threads that run blocking jobs from a bounded queue,
+	and hand the results back to the event loop.
+	"""
+
+	def __init__(self, name, num_threads, max_queued, waker):
+		self.jobs = Queue.Queue(max_queued)
+		self.waker = waker
+		for i in range(num_threads):
+			t = threading.Thread(target=self._work, name="%s-%d" % (name, i))
+			t.daemon = True
+			t.start()
+
+	def submit(self, callback, func, *args):
+		"""
+		Queue func(*args) to run on a worker thread.
+		callback(result, error) is then called on the event loop;
+		error is None if func returned normally.
+		Returns False if too many jobs are already waiting.
+		"""
+		try:
+			self.jobs.put_nowait((callback, func, args))
+		except Queue.Full:
+			return False
+		return True
+
+	def _work(self):
+		while True:
+			(callback, func, args) = self.jobs.get()
+			result = None
+			error = None
+			try:
+				result = func(*args)
+			except (cherrypy.HTTPError, cherrypy.HTTPRedirect) as e:
+				error = e
+			except Exception as e:
+				cherrypy.log.error("Error handling request", 'ASYNC', traceback=True)
+				error = e
+			self.waker.call_soon(callback, result, error)
+
+
+class Request(object):
+	"""One parsed HTTP request."""
+
+	def __init__(self, method, path, params, headers, keep_alive):
+		self.method = method
+		self.path = path
+		self.params = params
+		self.headers = headers
+		self.keep_alive = keep_alive
+		self.trace = None # see tracing.Tracer
+
+
+class NotaryConnection(asynchat.async_chat):
+	"""Read requests from one client connection and write responses in the order they were received."""
+
+	MAX_HEADER_SIZE = 16 * 1024
+	MAX_BODY_SIZE = 64 * 1024 # bytes. easily fits the largest batch request
+	MAX_PIPELINED = 8 # requests read ahead of the one being answered
+
+	def __init__(self, sock, front_end, local=False):
+		"""'local': True if the client connected from this machine."""
+		asynchat.async_chat.__init__(self, sock, map=front_end.map)
+		# asyncore stores the client address - never keep it
+		self.addr = None
+		self.local = local
+		self.front_end = front_end
+		self.set_terminator("\r\n\r\n")
+		self.incoming = []
+		self.incoming_size = 0
+		self.head = None # request line and headers, while we read the body
+		self.waiting = collections.deque()
+		self.busy = False
+		self.closing = False
+		self.last_active = time.time()
+
+	def __repr__(self):
+		# the default includes the client address, which may end up in logs
+		return "<%s>" % (self.__class__.__name__)
+
+	__str__ = __repr__
+
+	def readable(self):
+		return (not self.closing and len(self.waiting) < self.MAX_PIPELINED)
+
+	def idle_since(self):
+		"""Return the last time we did anything for this client, or None if a request is being answered."""
+		if (self.busy):
+			return None
+		return self.last_active
+
+	def collect_incoming_data(self, data):
+		if (self.closing):
+			return
+		self.incoming.append(data)
+		self.incoming_size += len(data)
+		if (self.head == None and self.incoming_size > self.MAX_HEADER_SIZE):
+			self.fail(431) # 431 Request Header Fields Too Large
+
+	def found_terminator(self):
+		if (self.closing):
+			return
+		data = "".join(self.incoming)
+		self.incoming = []
+		self.incoming_size = 0
+		self.last_active = time.time()
+
+		if (self.head == None):
+			# RFC 7230 section 3.5: ignore empty lines before a request
+			data = data.lstrip("\r\n")
+			if (data == ""):
+				return
+			head = self.parse_head(data)
+			if (head == None):
+				return
+
+			length = head[3].get('Content-Length', '0')
+			if (not length.isdigit()):
+				self.fail(400) # 400 Bad Request
+			elif (int(length) > self.MAX_BODY_SIZE):
+				self.fail(413) # 413 Request Entity Too Large
+			elif (int(length) > 0):
+				self.head = head
+				self.set_terminator(int(length))
+			else:
+				self.queue_request(head, "")
+		else:
+			head = self.head
+			self.head = None
+			self.set_terminator("\r\n\r\n")
+			self.queue_request(head, data)
+
+	def parse_head(self, data):
+		"""Parse a request line and headers into a (method, target, version, headers) tuple, or fail and return None."""
+		lines = data.split("\r\n")
+		request_line = lines[0].split()
+		if (len(request_line) != 3 or request_line[2] not in ('HTTP/1.0', 'HTTP/1.1')):
+			self.fail(400) # 400 Bad Request
+			return None
+
+		headers = HeaderMap()
+		for line in lines[1:]:
+			(name, sep, value) = line.partition(':')
+			# we don't accept obsolete line folding (RFC 7230 section 3.2.4)
+			if (sep == '' or name == '' or name != name.strip() or line[0] in ' \t'):
+				self.fail(400) # 400 Bad Request
+				return None
+			value = value.strip()
+			if (name in headers):
+				value = headers[name] + ", " + value
+			headers[name] = value
+
+		if ('Transfer-Encoding' in headers):
+			self.fail(411) # 411 Length Required
+			return None
+
+		return (request_line[0], request_line[1], request_line[2], headers)
+
+	def queue_request(self, head, body):
+		(method, target, version, headers) = head
+		connection = headers.get('Connection', '').lower()
+		if (version == 'HTTP/1.1'):
+			keep_alive = ('close' not in connection)
+		else:
+			keep_alive = ('keep-alive' in connection)
+
+		(path, sep, query) = target.partition('?')
+		params = urlparse.parse_qs(query, keep_blank_values=True)
+		if (method == 'POST' and \
+			headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded')):
+			for (name, values) in urlparse.parse_qs(body, keep_blank_values=True).iteritems():
+				params.setdefault(name, []).extend(values)
+
+		self.waiting.append(Request(method, path, params, headers, keep_alive))
+		self.answer_next()
+
+	def answer_next(self):
+		"""Start answering the next waiting request, if we are not already busy."""
+		if (self.busy or self.closing or len(self.waiting) == 0):
+			return
+		self.busy = True
+		self.front_end.handle_request(self, self.waiting.popleft())
+
+	def fail(self, status):
+		"""Answer a request we could not parse, and close the connection."""
+		self.waiting.clear()
+		if (self.busy):
+			# close once the request being answered is done
+			self.closing = True
+			return
+		self.busy = True
+		self.respond(Request(None, None, {}, HeaderMap(), False), status, HeaderMap(), "")
+
+	def respond(self, request, status, headers, body):
+		"""Send the response to the request being answered, then move on to the next one."""
+		if (not self.connected):
+			# the client went away while we worked
+			return
+
+		reason = BaseHTTPServer.BaseHTTPRequestHandler.responses.get(status, ('Unknown',))[0]
+		if (status == 431):
+			reason = 'Request Header Fields Too Large'
+
+		if (isinstance(body, unicode)):
+			body = body.encode('utf-8')
+		if (status == 304 or request.method == 'HEAD'):
+			content_length = len(body)
+			body = ""
+		else:
+			content_length = len(body)
+		if (status != 304):
+			headers['Content-Length'] = str(content_length)
+		headers['Date'] = email.utils.formatdate(usegmt=True)
+		if (not request.keep_alive):
+			headers['Connection'] = 'close'
+
+		lines = ["HTTP/1.1 %d %s" % (status, reason)]
+		for (name, value) in headers.items():
+			lines.append("%s: %s" % (name, value))
+		self.push("\r\n".join(lines) + "\r\n\r\n" + body)
+		if (request.trace != None):
+			request.trace.finish()
+
+		self.busy = False
+		self.last_active = time.time()
+		if (request.keep_alive and not self.closing):
+			self.answer_next()
+		else:
+			self.closing = True
+			self.close_when_done()
+
+	def handle_error(self):
+		cherrypy.log.error("Error on client connection", 'ASYNC', traceback=True)
+		self.close()
+
+
+class NotaryFrontEnd(asyncore.dispatcher):
+	"""Accept client connections and answer notary requests without one thread per connection."""
+
+	KEEPALIVE_TIMEOUT = 30 # seconds an idle connection may stay open
+
+	STATIC_FILES = { '/favicon.ico': os.path.join('img', 'perspectives.ico') }
+	STATIC_DIRS = ['img', 'css']
+
+	def __init__(self, notary, static_root, port, backlog, lookup_threads, signing_threads, max_queued, listener=None):
+		self.map = {}
+		asyncore.dispatcher.__init__(self, map=self.map)
+		self.notary = notary
+		self.static_root = static_root
+		self.static_files = {}
+		self.building = {} # service -> callbacks waiting for its reply
+
+		# our in-memory cache never blocks, so we can use it directly from the event loop
+		self.cache_blocks = (notary.cache != None and not isinstance(notary.cache, cache.Pycache))
+
+		if (listener != None):
+			# accept connections on a socket shared with other worker processes
+			listener.setblocking(0)
+			self.set_socket(listener)
+			self.accepting = True
+		else:
+			self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+			self.set_reuse_addr()
+			self.bind(("0.0.0.0", port))
+			self.listen(backlog)
+
+		self.waker = Waker(self.map)
+		self.lookups = WorkerPool('lookup', lookup_threads, max_queued, self.waker)
+		self.signers = WorkerPool('signing', signing_threads, max_queued, self.waker)
+
+	def __repr__(self):
+		return "<%s>" % (self.__class__.__name__)
+
+	__str__ = __repr__
+
+	def serve_forever(self):
+		"""Run the event loop."""
+		# poll() has no limit on the number of open connections, unlike select()
+		use_poll = hasattr(select, 'poll')
+		next_sweep = time.time() + 1
+		while True:
+			asyncore.loop(timeout=1.0, use_poll=use_poll, map=self.map, count=1)
+			if (time.time() >= next_sweep):
+				self.close_idle_connections()
+				next_sweep = time.time() + 1
+
+	def close_idle_connections(self):
+		cutoff = time.time() - self.KEEPALIVE_TIMEOUT
+		for channel in self.map.values():
+			if (isinstance(channel, NotaryConnection)):
+				idle_since = channel.idle_since()
+				if (idle_since != None and idle_since < cutoff):
+					channel.close()
+
+	def handle_accept(self):
+		pair = self.accept()
+		if (pair == None):
+			return
+		# never keep the client address
+		(sock, addr) = pair
+		local = self.notary.is_local_address(addr[0])
+		del addr
+		NotaryConnection(sock, self, local)
+
+	def handle_error(self):
+		# keep listening even if one accept() fails, e.g. if we are out of file descriptors
+		cherrypy.log.error("Error accepting connection", 'ASYNC', traceback=True)
+
+	def handle_request(self, conn, request):
+		"""Route a request to the handler for its path."""
+		if (request.path == '/' or request.path == '/index'):
+			self.handle_index(conn, request)
+		elif (request.path == '/batch'):
+			self.handle_batch(conn, request)
+		elif (request.path == '/metrics'):
+			self.handle_metrics(conn, request)
+		else:
+			self.handle_static(conn, request, self.get_static_file(request.path))
+
+	def run_cache_step(self, conn, request, response_headers, callback, func, *args):
+		"""
+		Run a step that reads the cache: directly if the cache is in memory,
+		otherwise on a lookup thread.
+		"""
+		if (self.cache_blocks):
+			self.submit(self.lookups, conn, request, response_headers, callback, func, *args)
+			return
+		try:
+			with self.notary.tracer.activate(request.trace):
+				result = func(*args)
+		except (cherrypy.HTTPError, cherrypy.HTTPRedirect) as e:
+			self.respond_error(conn, request, response_headers, e)
+			return
+		callback(result, None)
+
+	def submit(self, pool, conn, request, response_headers, callback, func, *args):
+		"""Run a blocking step on a worker pool, or answer 503 if the pool is already full."""
+		def done(result, error):
+			if (error != None):
+				self.respond_error(conn, request, response_headers, error)
+			else:
+				callback(result, None)
+
+		if (not pool.submit(done, self.notary.tracer.wrap(request.trace, func), *args)):
+			conn.respond(request, 503, HeaderMap(), "") # 503 Service Unavailable
+
+	def respond_error(self, conn, request, response_headers, error):
+		if (isinstance(error, cherrypy.HTTPRedirect)):
+			# 304 Not Modified: keep the validator headers
+			conn.respond(request, error.status, response_headers, "")
+		elif (isinstance(error, cherrypy.HTTPError)):
+			headers = HeaderMap()
+			retry_after = getattr(error, 'retry_after', None)
+			if (retry_after != None):
+				headers['Retry-After'] = str(retry_after)
+			conn.respond(request, error.code, headers, "")
+		else:
+			conn.respond(request, 500, HeaderMap(), "") # 500 Internal Server Error
+
+	def get_param(self, request, name):
+		"""Return the single value of a request parameter, or None. Raises a 400 if it was sent more than once."""
+		values = request.params.get(name)
+		if (values == None):
+			return None
+		if (len(values) != 1):
+			raise cherrypy.HTTPError(400) # 400 Bad Request
+		return values[0]
+
+	def handle_index(self, conn, request):
+		"""Answer a request for one service - see NotaryHTTPServer.index()."""
+		notary = self.notary
+		response_headers = HeaderMap()
+
+		try:
+			if (len(set(request.params) - set(['host', 'port', 'service_type'])) > 0):
+				raise cherrypy.HTTPError(400) # 400 Bad Request
+
+			host = self.get_param(request, 'host')
+			port = self.get_param(request, 'port')
+			service_type = self.get_param(request, 'service_type')
+			if (host == None and port == None and service_type == None):
+				self.handle_static(conn, request, notary.STATIC_INDEX)
+				return
+
+			(service, service_type) = notary.get_service_id(host, port, service_type)
+		except cherrypy.HTTPError as e:
+			self.respond_error(conn, request, response_headers, e)
+			return
+
+		response_headers['Content-Type'] = 'text/xml;charset=utf-8'
+		request.trace = notary.tracer.start('index')
+
+		def respond(body, error):
+			conn.respond(request, 200, response_headers, body)
+
+		def built(xml, error):
+			if (error != None):
+				self.respond_error(conn, request, response_headers, error)
+			else:
+				self.run_cache_step(conn, request, response_headers, respond,
+					notary.finish_response, service, xml, request.headers, response_headers)
+
+		def cache_checked(body, error):
+			if (body != None):
+				respond(body, None)
+			elif (notary.negative_cache_hit(service)):
+				# answer from memory before waiting to use the database
+				built(None, cherrypy.HTTPError(404)) # 404 Not Found
+			elif (not notary.database_available()):
+				conn.respond(request, 503, HeaderMap(), "") # 503 Service Unavailable
+			else:
+				self.build_reply(service, service_type, built, request.trace)
+
+		self.run_cache_step(conn, request, response_headers, cache_checked,
+			notary.get_cached_response, service, request.headers, response_headers)
+
+	def build_reply(self, service, service_type, callback, trace=None):
+		"""
+		Build the reply for a service that is not cached, on the lookup and signing threads.
+		callback(xml, error) is called on the event loop when it is ready.
+		Requests for the same service that arrive meanwhile share the same reply;
+		only the first request's 'trace' records how it was built.
+		"""
+		if (service in self.building):
+			self.building[service].append(callback)
+			return
+		self.building[service] = [callback]
+		notary = self.notary
+
+		def done(xml, error):
+			for waiting in self.building.pop(service):
+				waiting(xml, error)
+
+		def signing_needed(result, error):
+			if (error != None):
+				done(None, error)
+				return
+			(xml, keys, timestamps_by_key) = result
+			if (xml != None):
+				done(xml, None)
+			elif (not self.signers.submit(done, notary.tracer.wrap(trace, notary.create_service_xml),
+				service, service_type, keys, timestamps_by_key)):
+				done(None, notary.overloaded_error())
+
+		if (notary.single_flight.shared_cache != None):
+			# other processes may be building this reply too. waiting for them blocks,
+			# so the lookup thread does all of the work
+			submitted = self.lookups.submit(done, notary.tracer.wrap(trace, notary.single_flight.do), service,
+				notary.run_admitted, notary.calculate_service_xml, service, service_type)
+		else:
+			submitted = self.lookups.submit(signing_needed, notary.tracer.wrap(trace, notary.run_admitted),
+				notary.query_service, service)
+		if (not submitted):
+			done(None, notary.overloaded_error())
+
+	def handle_batch(self, conn, request):
+		"""Answer a request for many services - see NotaryHTTPServer.batch()."""
+		notary = self.notary
+		response_headers = HeaderMap()
+
+		if (request.method != 'POST'):
+			response_headers['Allow'] = 'POST'
+			conn.respond(request, 405, response_headers, "") # 405 Method Not Allowed
+			return
+
+		try:
+			if (len(request.params) != 1 or 'service' not in request.params):
+				raise cherrypy.HTTPError(400) # 400 Bad Request
+			services = notary.get_batch_service_ids(request.params['service'])
+		except cherrypy.HTTPError as e:
+			self.respond_error(conn, request, response_headers, e)
+			return
+
+		response_headers['Content-Type'] = 'text/xml;charset=utf-8'
+		request.trace = notary.tracer.start('batch')
+
+		def respond(results, error):
+			if (notary.needs_retry(results)):
+				response_headers['Retry-After'] = str(notary.RETRY_AFTER)
+			conn.respond(request, 200, response_headers, notary.format_batch_xml(results))
+
+		# batches usually need the database, so always answer them from a lookup thread
+		self.submit(self.lookups, conn, request, response_headers, respond, notary.get_xml_batch, services)
+
+	def handle_metrics(self, conn, request):
+		"""Answer a request for this process's counters and timings - see NotaryHTTPServer.metrics()."""
+		try:
+			body = self.notary.get_metrics_text(conn.local)
+		except cherrypy.HTTPError as e:
+			self.respond_error(conn, request, HeaderMap(), e)
+			return
+		conn.respond(request, 200, HeaderMap({'Content-Type': metrics_registry.CONTENT_TYPE}), body)
+
+	def get_static_file(self, path):
+		"""Return the file to serve for a static path, relative to the static root, or None."""
+		if (path in self.STATIC_FILES):
+			return self.STATIC_FILES[path]
+		parts = path.strip('/').split('/')
+		if (len(parts) != 2 or parts[0] not in self.STATIC_DIRS or parts[1] in ('', '.', '..')):
+			return None
+		return os.path.join(*parts)
+
+	def handle_static(self, conn, request, relative):
+		"""Serve one of the files used by the static index page."""
+		if (request.method not in ('GET', 'HEAD')):
+			conn.respond(request, 405, HeaderMap({'Allow': 'GET, HEAD'}), "") # 405 Method Not Allowed
+			return
+
+		if (relative != None and relative not in self.static_files):
+			# the files are small and few, so read each one once
+			try:
+				with open(os.path.join(self.static_root, relative), 'rb') as f:
+					content = f.read()
+				content_type = mimetypes.guess_type(relative)[0] or 'application/octet-stream'
+				self.static_files[relative] = (content_type, content)
+			except IOError:
+				pass
+
+		if (relative not in self.static_files):
+			conn.respond(request, 404, HeaderMap(), "") # 404 Not Found
+			return
+
+		(content_type, content) = self.static_files[relative]
+		conn.respond(request, 200, HeaderMap({'Content-Type': content_type}), content)
+
+
+def serve(notary, static_root, listener=None):
+	"""
+	Run the notary with the asyncore front end until interrupted.
+	If 'listener' is given accept connections on it rather than opening the web port.
+	"""
+	front_end = NotaryFrontEnd(notary, static_root, notary.web_port, notary.args.socket_queue_size,
+		notary.args.async_lookup_threads, notary.args.async_signing_threads, notary.args.async_max_queued,
+		listener)
+	notary.start_background_tasks()
+	try:
+		front_end.serve_forever()
+	except KeyboardInterrupt:
+		pass
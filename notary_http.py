@@ -15,21 +15,30 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import email.utils
 import errno
+import gzip
 import os
 import re
-import struct
+import signal
+import socket
+import StringIO
 import sys
-import threading 
+import threading
+import time
 import traceback 
-from xml.dom.minidom import getDOMImplementation
+import zlib
+from xml.sax.saxutils import quoteattr
 
 import cherrypy
+from cherrypy._cpwsgi_server import CPWSGIServer
 
-from util import crypto, cache
+from util import cache, crypto, metrics_registry, packing, tracing
+from util.load_shedder import LoadShedder, Overloaded
+from util.scan_queue import ScanQueue
 from util.keymanager import keymanager
 from notary_util.notary_db import ndb
-from notary_util import notary_common
+from notary_util import notary_common, notary_reply
 from util.ssl_scan_sock import attempt_observation_for_service, SSLScanTimeoutException, SSLAlertException
 
 class NotaryHTTPServer:
@@ -44,18 +53,42 @@ class NotaryHTTPServer:
 	# MAJOR version when you make large architectural changes,
 	# MINOR version when you add functionality in a backwards-compatible manner
 	# PATCH version when you make backwards-compatible bug fixes.
-	VERSION = "3.4.1"
+	VERSION = "3.5.0"
 
 	DEFAULT_WEB_PORT=8080
 	ENV_PORT_KEY_NAME='PORT'
-	STATIC_DIR = "notary_static"
+	# files are found relative to this script, wherever the notary is started from
+	ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+	STATIC_DIR = os.path.join(ROOT_DIR, "notary_static")
 	STATIC_INDEX = "index.html"
-	LOG_DIR = 'logs'
+	LOG_DIR = os.path.join(ROOT_DIR, 'logs')
 	LOG_FILE = 'webserver.log'
 
 	CACHE_EXPIRY = 60 * 60 * 12 # seconds. see doc/advanced_notary_configuration.txt
 
-	def __init__(self):
+	MAX_BATCH_SIZE = 100 # services per batch request
+	MAX_BATCH_IDS = 10 * MAX_BATCH_SIZE # service names per batch request, counting repeats
+	VALIDATORS_KEY_SUFFIX = '|validators' # cache key suffix for a response's ETag, Last-Modified, and expiry time
+	FRESH_KEY_SUFFIX = '|fresh' # cache key suffix for a marker that expires when a response becomes stale
+	REFRESH_THREADS = 2 # threads that rebuild stale responses
+	REFRESH_QUEUE_SIZE = 1000 # most stale responses waiting to be rebuilt. more are left to expire
+	REFRESH_AHEAD_CHECKS = 1000 # most requested services to check for expiry each time
+	RETRY_AFTER = 5 # seconds clients should wait before retrying when we are overloaded
+	LOCAL_ADDRESSES = ('127.0.0.1', '::1', '::ffff:127.0.0.1') # clients allowed to read /metrics
+	SLOW_REQUEST_LOG = 'slow_requests.log' # in LOG_DIR
+	CONTENT_ENCODINGS = ['gzip', 'deflate'] # in order of preference
+	COALESCE_WAIT = 5 # seconds
+	WARM_CACHE_RATE = 20 # services per second
+	HOT_SERVICES_FILE = 'hot_services.txt' # in LOG_DIR
+	HOT_SERVICES_PERIOD = 60 * 60 * 24 * 7 # seconds of metrics to count requests from
+	HOT_SERVICES_SAVE_INTERVAL = 60 # seconds
+	SERVICE_ID_FORMAT = re.compile("^([^:,\s]+):(\d{1,5}),(\d+)$")
+
+	def __init__(self, argv=None):
+		"""
+		Set up a notary from command-line arguments.
+		'argv': a list of arguments to use instead of sys.argv[1:].
+		"""
 		parser = argparse.ArgumentParser(parents=[keymanager.get_parser(), ndb.get_parser()],
 			description=self.__doc__, version=self.VERSION,
 			epilog="If the database schema does not exist it will be automatically created on launch.")
@@ -87,6 +120,21 @@ class NotaryHTTPServer:
 		parser.add_argument('--cache-only', action='store_true', default=False,
 			help="When retrieving data, *only* read from the cache - do not read any database records. Default: %(default)s")
 
+		parser.add_argument('--stored-responses', action='store_true', default=False,
+			help="Before building a reply, look for a signed reply already stored in the database\
+			(e.g. by running notary_util/threaded_scanner.py with --store-responses). Stored replies are returned without signing.\
+			Replies signed with a different private key are ignored.\
+			Replies for services found by on-demand scans are also stored. Default: %(default)s")
+
+		parser.add_argument('--compact-replies', action='store_true', default=False,
+			help="Send replies without any indentation or newlines, to save bandwidth and memory.\
+			Clients parse both forms. Default: %(default)s")
+
+		parser.add_argument('--compressed-replies', action='store_true', default=False,
+			help="Send gzip or deflate compressed replies to clients that accept them.\
+			Each reply is compressed once per encoding that clients ask for, and the compressed copy is cached.\
+			Requires a cache. Default: %(default)s")
+
 		parser.add_argument('--cache-expiry', '--cache-duration',\
 			default=self.CACHE_EXPIRY, type=self.cache_duration,
 			metavar="CACHE_EXPIRY[Ss|Mm|Hh]",
@@ -96,6 +144,18 @@ class NotaryHTTPServer:
 			"so you may want your (scan frequency + scan duration + cache expiry) to be <= 48 hours. Default: " +\
 			str(self.CACHE_EXPIRY / 3600) + " hours.")
 
+		parser.add_argument('--stale-while-revalidate',\
+			default=0, type=int, metavar='SECONDS',
+			help="Keep replies in the cache this many seconds past --cache-expiry. Requests for such stale replies\
+			are answered from the cache right away while the reply is rebuilt in the background,\
+			instead of waiting for the database and signing. 0 disables. Default: %(default)s")
+
+		parser.add_argument('--refresh-ahead',\
+			default=0, type=int, metavar='SECONDS',
+			help="Rebuild cached replies that are still being requested in the background\
+			when they will expire within this many seconds, so popular services are never missing from the cache.\
+			Requires a cache. 0 disables. Default: %(default)s")
+
 		# socket_queue_size and thread_pool use the cherrypy defaults,
 		# but we hardcode them here rather than refer to the cherrypy variables directly
 		# just in case the cherrypy architecture changes.
@@ -107,7 +167,92 @@ class NotaryHTTPServer:
 			default=10, type=self.positive_integer,
 			help="The number of worker threads to start up in the pool. Must be a positive integer. Default: %(default)s.")
 
-		args = parser.parse_args()
+		parser.add_argument('--coalesce-wait',\
+			default=self.COALESCE_WAIT, type=float, metavar='SECONDS',
+			help="When a response is not cached and another request is already building it,\
+			wait up to this many seconds for that response rather than building it again. 0 disables. Default: %(default)s.")
+
+		parser.add_argument('--coalesce-across-processes', action='store_true', default=False,
+			help="Also wait for responses being built by other notary processes that use the same memcache or redis cache.\
+			Default: %(default)s")
+
+		parser.add_argument('--negative-cache-ttl',\
+			default=cache.NegativeCache.TTL, type=int, metavar='SECONDS',
+			help="Remember services we have no data for - e.g. while they are being scanned - for this many seconds,\
+			so repeated requests for them are answered right away without reading the database. 0 disables. Default: %(default)s.")
+
+		parser.add_argument('--warm-cache',\
+			default=0, type=int, metavar='N',
+			help="After starting, build and cache replies for the N services requested most often,\
+			in the background. Requests are counted from the metrics database if --metricsdb is used,\
+			otherwise from a list the notary saves in '" + os.path.join(self.LOG_DIR, self.HOT_SERVICES_FILE) + "'\
+			while running with this option. Requires a cache. Default: %(default)s")
+
+		parser.add_argument('--warm-cache-rate',\
+			default=self.WARM_CACHE_RATE, type=self.positive_integer,
+			help="The most services per second to build replies for while warming the cache,\
+			so live requests are not slowed down. Default: %(default)s.")
+
+		parser.add_argument('--max-db-requests',\
+			default=0, type=int, metavar='N',
+			help="The most requests that may read the database and sign replies at once.\
+			Further requests that are not cached wait up to --max-db-wait seconds for one to finish,\
+			then are answered with '503 Service Unavailable' and a Retry-After header.\
+			Cached replies are always served. 0 disables. Default: %(default)s")
+
+		parser.add_argument('--max-db-wait',\
+			default=1, type=float, metavar='SECONDS',
+			help="With --max-db-requests: how long a request may wait to read the database. Default: %(default)s")
+
+		parser.add_argument('--scan-workers',\
+			default=ScanQueue.WORKERS, type=self.positive_integer,
+			help="The number of threads that scan services we have no data for. Default: %(default)s.")
+
+		parser.add_argument('--scan-queue-size',\
+			default=ScanQueue.MAX_QUEUED, type=self.positive_integer,
+			help="The most services that may wait for a scan. Services requested by more clients are scanned first;\
+			requests for new services beyond this are not scanned. Default: %(default)s.")
+
+		parser.add_argument('--metrics-endpoint', action='store_true', default=False,
+			help="Serve counters and timings for this process at /metrics, in the Prometheus text format.\
+			Only requests from this machine are answered. Default: %(default)s")
+
+		parser.add_argument('--trace-sample',\
+			default=0, type=int, metavar='N',
+			help="Time each phase of one in every N requests (cache lookups, database query, signing, etc.).\
+			Timings are served at /metrics with --metrics-endpoint, and requests slower than\
+			--slow-request-threshold are written to " + os.path.join(self.LOG_DIR, self.SLOW_REQUEST_LOG) + ".\
+			No information about clients or services is recorded. 0 disables. Default: %(default)s")
+
+		parser.add_argument('--slow-request-threshold',\
+			default=1, type=float, metavar='SECONDS',
+			help="With --trace-sample: log traced requests that take at least this long. Default: %(default)s")
+
+		parser.add_argument('--workers',\
+			default=1, type=self.positive_integer,
+			help="The number of server processes to run. Processes share the web port, the database,\
+			and any memcache or redis cache; each has its own --pycache. Processes that exit are restarted.\
+			Unix only. Default: %(default)s.")
+
+		parser.add_argument('--async', dest='async_frontend', action='store_true', default=False,
+			help="Serve requests from one event-driven thread instead of the CherryPy thread pool,\
+			so many clients can keep connections open without one thread each. Unix only.\
+			--thread-pool-size is ignored. Default: %(default)s")
+
+		parser.add_argument('--async-lookup-threads',\
+			default=10, type=self.positive_integer,
+			help="With --async: the number of threads that read the database and any external cache. Default: %(default)s.")
+
+		parser.add_argument('--async-signing-threads',\
+			default=2, type=self.positive_integer,
+			help="With --async: the number of threads that sign new replies. Default: %(default)s.")
+
+		parser.add_argument('--async-max-queued',\
+			default=1000, type=self.positive_integer,
+			help="With --async: the most requests that may wait for each group of threads.\
+			Further requests that need a thread are answered with '503 Service Unavailable'. Default: %(default)s.")
+
+		args = parser.parse_args(argv)
 
 		# pass ndb the args so it can use any relevant ones from its own parser
 		try:
@@ -118,10 +263,16 @@ class NotaryHTTPServer:
 
 		# same for keymanager
 		km = keymanager(args)
-		(self.notary_public_key, self.notary_priv_key) = km.get_keys()
-		if (self.notary_public_key == None or self.notary_priv_key == None):
+		(self.notary_public_key, notary_priv_key) = km.get_keys()
+		if (self.notary_public_key == None or notary_priv_key == None):
 			print >> sys.stderr, "Could not get public and private keys."
 			exit(1)
+		try:
+			# parse the key once, rather than for every signature
+			self.signer = crypto.Signer(notary_priv_key)
+		except Exception as e:
+			print >> sys.stderr, "Could not load private key: '%s'" % (str(e))
+			exit(1)
 
 		self.web_port = self.DEFAULT_WEB_PORT
 		if (args.envport):
@@ -133,24 +284,128 @@ class NotaryHTTPServer:
 		elif (args.webport):
 			self.web_port = args.webport
 
-		self.cache = None
-		if (args.memcache):
-			self.cache = cache.Memcache()
-		elif (args.memcachier):
-			self.cache = cache.Memcachier()
-		elif (args.redis):
-			self.cache = cache.Redis()
-		elif (args.pycache):
-			self.cache = cache.Pycache(args.pycache)
+		self.cache = self.create_cache(args)
+		self.negative_cache = cache.NegativeCache(args.negative_cache_ttl)
+		self.single_flight = self.create_single_flight(args)
+		self.scan_queue = ScanQueue(self.scan_service, args.scan_workers, args.scan_queue_size)
+		# the scan queue works for any per-service background job, with the same de-duplication
+		self.refresh_queue = ScanQueue(self.refresh_reply, self.REFRESH_THREADS, self.REFRESH_QUEUE_SIZE)
+
+		if (args.compressed_replies and self.cache == None):
+			print >> sys.stderr, "WARNING: --compressed-replies requires a cache. Replies will not be compressed."
+
+		if (args.warm_cache > 0 and self.cache == None):
+			print >> sys.stderr, "WARNING: --warm-cache requires a cache. The cache will not be warmed."
+			args.warm_cache = 0
+
+		if (args.refresh_ahead > 0 and self.cache == None):
+			print >> sys.stderr, "WARNING: --refresh-ahead requires a cache. Replies will not be refreshed."
+			args.refresh_ahead = 0
+
+		self.load_shedder = LoadShedder(args.max_db_requests, args.max_db_wait, self.load_shedding_changed)
+		self.create_metrics_registry()
+
+		# services requested since the refresh-ahead scheduler last ran
+		self.recent_requests = None
+		if (args.refresh_ahead > 0):
+			self.recent_requests = cache.HotKeys()
+
+		# without metrics in the database, keep our own count of the most requested services
+		self.hot_services = None
+		if (args.warm_cache > 0 and not (self.ndb != None and self.ndb.metricsdb)):
+			self.hot_services = cache.HotKeys()
 
 		self.create_folder(self.LOG_DIR)
+		self.tracer = self.create_tracer(args)
 
 		self.use_sni = args.sni
 		self.create_static_index()
 		self.args = args
 
-		print "Using public key\n" + self.notary_public_key
 
+	def create_cache(self, args):
+		"""Connect to the cache chosen on the command line, or return None if we are not caching."""
+		if (args.memcache):
+			return cache.Memcache()
+		elif (args.memcachier):
+			return cache.Memcachier()
+		elif (args.redis):
+			return cache.Redis()
+		elif (args.pycache):
+			return cache.Pycache(args.pycache)
+		return None
+
+	def create_single_flight(self, args):
+		"""Set up waiting for responses that are already being built."""
+		shared_cache = None
+		if (args.coalesce_across_processes):
+			if (self.cache == None or isinstance(self.cache, cache.Pycache)):
+				print >> sys.stderr, "WARNING: --coalesce-across-processes requires memcache, memcachier, or redis. " +\
+					"Only requests inside this process will wait for each other."
+			else:
+				shared_cache = self.cache
+		return cache.SingleFlight(args.coalesce_wait, shared_cache)
+
+	def create_metrics_registry(self):
+		"""Set up the counters and timings served at /metrics."""
+		self.registry = metrics_registry.Registry()
+		m = self.registry
+
+		self.cache_hits = m.counter('notary_cache_hits_total', "Requests for a service answered from the cache.")
+		self.cache_misses = m.counter('notary_cache_misses_total', "Requests for a service not found in the cache.")
+		self.negative_cache_hits = m.counter('notary_negative_cache_hits_total',
+			"Requests for a service recently found to have no data.")
+		self.db_lookups = m.counter('notary_db_lookups_total', "Services read from the database.")
+
+		self.db_query_seconds = m.histogram('notary_db_query_seconds',
+			"Time to read the observations or stored reply for a service, or a batch of services.")
+		self.packing_seconds = m.histogram('notary_packing_seconds', "Time to pack a reply's data for signing.")
+		self.signing_seconds = m.histogram('notary_signing_seconds', "Time to sign a reply.")
+		self.serialization_seconds = m.histogram('notary_serialization_seconds', "Time to write a reply's XML.")
+
+		m.gauge('notary_db_connections', "Database connections checked out of the pool.",
+			lambda: self.ndb.get_connection_count() if self.ndb != None else 0)
+
+		def stat(source, name):
+			return lambda: source().stats()[name]
+		scans = lambda: self.scan_queue
+		m.gauge('notary_scan_queue_length', "Services waiting to be scanned.", stat(scans, 'queued'))
+		m.gauge('notary_scans_in_progress', "Services being scanned.", stat(scans, 'scanning'))
+		m.counter('notary_scans_queued_total', "Services added to the scan queue.", stat(scans, 'added'))
+		m.counter('notary_scans_dropped_total', "Services not scanned because the queue was full.", stat(scans, 'dropped'))
+		m.counter('notary_scans_completed_total', "Scans finished, whether or not they succeeded.", stat(scans, 'completed'))
+		m.gauge('notary_refresh_queue_length', "Stale replies waiting to be rebuilt.",
+			stat(lambda: self.refresh_queue, 'queued'))
+
+		shedder = lambda: self.load_shedder
+		m.gauge('notary_max_db_requests', "Requests allowed to use the database at once (0: no limit).",
+			stat(shedder, 'max_in_flight'))
+		m.gauge('notary_max_db_wait_seconds', "Time a request may wait to use the database.", stat(shedder, 'max_wait'))
+		m.gauge('notary_db_requests_in_flight', "Requests using the database.", stat(shedder, 'in_flight'))
+		m.gauge('notary_db_requests_waiting', "Requests waiting to use the database.", stat(shedder, 'waiting'))
+		m.gauge('notary_db_wait_seconds', "Recent average time admitted requests waited to use the database.",
+			stat(shedder, 'average_wait'))
+		m.gauge('notary_load_shedding', "1 if requests that need the database are being turned away.",
+			stat(shedder, 'shedding'))
+		m.counter('notary_db_requests_admitted_total', "Requests admitted to the database (with --max-db-requests).",
+			stat(shedder, 'admitted'))
+		m.counter('notary_db_requests_shed_total', "Requests turned away with 503 because the database was busy.",
+			stat(shedder, 'shed'))
+
+	def create_tracer(self, args):
+		"""Set up timing the phases of a sample of requests."""
+		slow_log = None
+		if (args.trace_sample > 0):
+			slow_log = open(os.path.join(self.LOG_DIR, self.SLOW_REQUEST_LOG), 'a')
+		return tracing.Tracer(args.trace_sample, args.slow_request_threshold, slow_log, self.registry)
+
+	def after_fork(self):
+		"""Set up anything a worker process must not share with the process it was forked from."""
+		# each process needs its own connections to the cache servers
+		self.cache = self.create_cache(self.args)
+		self.single_flight = self.create_single_flight(self.args)
+		self.scan_queue = ScanQueue(self.scan_service, self.args.scan_workers, self.args.scan_queue_size)
+		self.refresh_queue = ScanQueue(self.refresh_reply, self.REFRESH_THREADS, self.REFRESH_QUEUE_SIZE)
 
 	# function to help with argument validation.
 	# we name this 'positive_integer' because argparse will print messages
@@ -267,156 +522,294 @@ class NotaryHTTPServer:
 			elif e.errno != errno.EEXIST:
 				raise
 
-	def get_xml(self, host, port, service_type):
-		"""Fetch the xml response for a given service."""
-
-		service = str(host + ":" + port + "," + service_type)
-
-		if (self.cache):
-			try:
-				cached_service = self.cache.get(service)
-				if (cached_service != None):
-					self.ndb.report_metric('CacheHit', service)
-					return cached_service
-				else:
-					self.ndb.report_metric('CacheMiss', service)
-			except Exception as e:
-				print >> sys.stderr, "ERROR getting service from cache: %s\n" % (e)
+	def get_uncached_xml(self, service, service_type):
+		"""Build the xml response for a service from the database."""
+		# answer from memory before waiting to use the database
+		if (self.negative_cache_hit(service)):
+			raise cherrypy.HTTPError(404) # 404 Not Found
 
-		#TODO: don't reference session directly
-		if (not self.args.cache_only and self.ndb and (self.ndb._Session != None)):
-			return self.calculate_service_xml(service, service_type)
+		if (self.database_available()):
+			# if another request is already building this response, use theirs
+			return self.single_flight.do(service, self.run_admitted, self.calculate_service_xml, service, service_type)
 		else:
 			print >> sys.stderr, "ERROR: Database is not available to retrieve data, and data not in the cache.\n"
 			raise cherrypy.HTTPError(503) # 503 Service Unavailable
 
+	def run_admitted(self, func, *args):
+		"""
+		Return func(*args), once the load shedder lets us use the database.
+		Raises a 503 with a Retry-After header if we are too busy.
+		"""
+		try:
+			with self.load_shedder.admit():
+				return func(*args)
+		except Overloaded:
+			raise self.overloaded_error()
+
+	def overloaded_error(self):
+		"""Return the error to raise when there are too many requests to handle."""
+		return OverloadedError(self.RETRY_AFTER)
+
+	def load_shedding_changed(self, shedding, stats):
+		"""Report when we start or stop turning away requests that need the database."""
+		details = "MaxDBRequests: %d MaxDBWait: %s InFlight: %d Waiting: %d Shed: %d" % \
+			(stats['max_in_flight'], stats['max_wait'], stats['in_flight'], stats['waiting'], stats['shed'])
+		if (shedding):
+			print >> sys.stderr, "WARNING: too many requests need the database - answering new ones with 503. " + details
+			self.ndb.report_metric('LoadSheddingStart', details)
+		else:
+			print >> sys.stderr, "Requests are being admitted to the database again. " + details
+			self.ndb.report_metric('LoadSheddingStop', details)
+
+	def database_available(self):
+		"""Return True if we may read responses from the database."""
+		#TODO: don't reference session directly
+		return (not self.args.cache_only and self.ndb and (self.ndb._Session != None))
+
 	def calculate_service_xml(self, service, service_type):
 		"""
 		Query the database and build a response containing any known keys for the given service.
 		"""
+		(xml, keys, timestamps_by_key) = self.query_service(service)
+		if (xml != None):
+			return xml
+		return self.create_service_xml(service, service_type, keys, timestamps_by_key)
 
+	def negative_cache_hit(self, service, from_request=True):
+		"""
+		Return True if we recently found no data for a service, so it should be answered with 404.
+		This needs no database, so check it before asking the load shedder to admit the lookup.
+		If 'from_request' is False (e.g. when warming the cache) no request metrics are reported.
+		"""
+		status = self.negative_cache.get(service)
+		if (status == None):
+			return False
+		if (from_request):
+			if (status == cache.NegativeCache.SCAN_IN_PROGRESS):
+				# another client wants it - scan it sooner
+				self.scan_queue.add(service)
+			self.negative_cache_hits.inc()
+			self.ndb.report_metric('NegativeCacheHit', service)
+		return True
+
+	def query_service(self, service):
+		"""
+		Look up a service for a client request, counting the lookup and scanning services we know nothing about.
+		Callers check negative_cache_hit() first.
+
+		Returns a tuple of (xml, keys, timestamps_by_key) - see read_service().
+		"""
+		self.db_lookups.inc()
 		self.ndb.report_metric('GetObservationsForService', service)
-		obs = None
-		timestamps_by_key = {}
-		keys = []
-		num_rows = 0
+
+		(xml, keys, timestamps_by_key) = self.read_service(service)
+		if (xml == None and len(keys) == 0):
+			self.scan_new_service(service)
+			# return 404, assume client will re-query
+			raise cherrypy.HTTPError(404) # 404 Not Found
+
+		return (xml, keys, timestamps_by_key)
+
+	def read_service(self, service):
+		"""
+		Read what we know about a service from the database.
+
+		Returns a tuple of (xml, keys, timestamps_by_key):
+		xml is the stored signed response, if there is one;
+		otherwise the observations are returned, ready to pass to create_service_xml().
+		keys is empty if there are no observations.
+		"""
+		if (self.args.stored_responses):
+			try:
+				with self.tracer.phase('db_query', self.db_query_seconds):
+					xml = self.ndb.get_signed_response(service, self.signer.fingerprint)
+			except Exception as e:
+				print >> sys.stderr, "Error getting stored reply for service '%s': '%s'" % (service, e)
+				raise cherrypy.HTTPError(503) # 503 Service Unavailable
+
+			if (xml != None):
+				self.cache_reply(service, xml)
+				return (xml, None, None)
 
 		try:
 			# TODO: can we grab this all in one query instead of looping?
 			with self.ndb.get_session() as session:
-				obs = self.ndb.get_observations(session, service)
-				if (obs != None):
-					for (name, key, start, end) in obs:
-						num_rows += 1
-						if key not in keys:
-							timestamps_by_key[key] = []
-							keys.append(key)
-						timestamps_by_key[key].append((start, end))
+				with self.tracer.phase('db_query', self.db_query_seconds):
+					obs = list(self.ndb.get_observations(session, service))
+				with self.tracer.phase('regroup'):
+					(keys, timestamps_by_key) = notary_reply.group_observations(obs)
 		except Exception as e:
 			# error already logged inside get_observations.
 			# we can also see InterfaceError or AttributeError when looping through observation records
 			# if the database is under heavy load.
 			raise cherrypy.HTTPError(503) # 503 Service Unavailable
 
-		if num_rows == 0: 
-			# rate-limit on-demand probes
-			global scan_semaphore
-			global scan_sites
-			global scan_sites_lock
-
-			if (scan_semaphore.acquire(False)):
-				do_scan = False
-				with scan_sites_lock:
-					if (service not in scan_sites):
-						# only scan a given site with one thread at a time
-						scan_sites[service] = True
-						do_scan = True
-
-				if (do_scan):
-					t = OnDemandScanThread(service, 10 , self.use_sni, self, self.ndb)
-					t.start()
-					# report the metrics *after* launching so the scanning thread can get started
-					self.ndb.report_metric('ScanForNewService', service)
-				else:
-					scan_semaphore.release()
-			else: 
-				self.ndb.report_metric('ProbeLimitExceeded', "CurrentProbleLimit: " + str(PROBE_LIMIT) + " Service: " + service)
-			# return 404, assume client will re-query
-			raise cherrypy.HTTPError(404) # 404 Not Found
-	
-		dom_impl = getDOMImplementation() 
-		new_doc = dom_impl.createDocument(None, "notary_reply", None) 
-		top_element = new_doc.documentElement
-		top_element.setAttribute("version","1") 
-		top_element.setAttribute("sig_type", "rsa-md5") 
-	
-		packed_data = ""
-
-		# create an XML response that we'll send back to the client
-		for k in keys:
-			key_elem = new_doc.createElement("key")
-			key_elem.setAttribute("type", notary_common.SERVICE_TYPES[service_type])
-			key_elem.setAttribute("fp", k)
-			top_element.appendChild(key_elem)
-			num_timespans = len(timestamps_by_key[k])
-			head = struct.pack("BBBBB", (num_timespans >> 8) & 255, num_timespans & 255, 0, 16,3)
-
-			fp_bytes = ""
-			for hex_byte in k.split(":"):
-				fp_bytes += struct.pack("B", int(hex_byte,16))
-
-			ts_bytes = ""
-			for ts in sorted(timestamps_by_key[k], key=lambda t_pair: t_pair[0]):
-				ts_start = ts[0]
-				ts_end  = ts[1]
-				ts_elem = new_doc.createElement("timestamp")
-				ts_elem.setAttribute("end",str(ts_end))
-				ts_elem.setAttribute("start", str(ts_start))
-				key_elem.appendChild(ts_elem) 
-				ts_bytes += struct.pack("BBBB", ts_start >> 24 & 255,
-											   ts_start >> 16 & 255,
-											   ts_start >> 8 & 255,
-											   ts_start & 255)
-				ts_bytes += struct.pack("BBBB", ts_end >> 24 & 255,
-											   ts_end >> 16 & 255,
-											   ts_end >> 8 & 255,
-											   ts_end & 255)
-			packed_data =(head + fp_bytes + ts_bytes) + packed_data   
-	
-		packed_data = service.encode() + struct.pack("B", 0) + packed_data
-		sig = crypto.sign_content(packed_data, self.notary_priv_key)
-		top_element.setAttribute("sig",sig)
-		xml = top_element.toprettyxml()
+		return (None, keys, timestamps_by_key)
+
+	def create_service_xml(self, service, service_type, keys, timestamps_by_key):
+		"""Build and sign a response for the given service, and store it in the cache."""
+		# the same steps as notary_reply.create_reply_xml(), timed separately
+		with self.tracer.phase('packing', self.packing_seconds):
+			signed_keys = notary_reply.sort_timespans(keys, timestamps_by_key)
+			packed_data = packing.pack_service(service, signed_keys)
+		with self.tracer.phase('signing', self.signing_seconds):
+			sig = self.signer.sign(packed_data)
+		with self.tracer.phase('xml', self.serialization_seconds):
+			xml = notary_reply.serialize_reply(sig, service_type, signed_keys, self.args.compact_replies)
+		self.cache_reply(service, xml)
+		return xml
 
+	def cache_reply(self, service, xml):
+		"""
+		Store a response in the cache, along with its HTTP validators,
+		so conditional requests can be answered without reading the response itself.
+		"""
 		if (self.cache != None):
-			self.cache.set(service, xml, expiry=self.args.cache_expiry)
+			with self.tracer.phase('cache_set'):
+				self._cache_reply(service, xml)
 
-		return xml
+	def cache_entry_expiry(self):
+		"""Return how long to keep a response and its related entries in the cache."""
+		# with --stale-while-revalidate, entries outlive the marker that says they are fresh
+		return self.args.cache_expiry + max(0, self.args.stale_while_revalidate)
 
-	def scan_finished(self, service):
-		"""Clean up any state used for on-deman scans."""
-		global scan_semaphore
-		global scan_sites
-		global scan_sites_lock
+	def _cache_reply(self, service, xml):
+		"""Store a response and its related entries in the cache."""
+		expiry = self.cache_entry_expiry()
 
-		with scan_sites_lock:
-			if service in scan_sites:
-				del scan_sites[service]
-		scan_semaphore.release()
+		self.cache.set(service, xml, expiry=expiry)
+		(etag, last_modified) = notary_reply.get_validators(xml)
+		# also note when the reply expires, for caches that cannot tell us (see refresh_ahead())
+		fresh_until = int(time.time()) + self.args.cache_expiry
+		self.cache.set(service + self.VALIDATORS_KEY_SUFFIX, "%s %d %d" % (etag, last_modified, fresh_until),
+			expiry=expiry)
 
-	@cherrypy.expose
-	def index(self, host=None, port=None, service_type=None, **invalid_params):
-		if(len(invalid_params) > 0):
-			# invalid_params will catch any other parameters sent to the web server.
-			# if we have any it's an invalid request.
-			raise cherrypy.HTTPError(400) # 400 Bad Request
+		# compressed copies are only made when a client asks for them - see get_compressed_copy()
 
-		if (host == None and port == None and service_type == None):
-			# probably a visitor that doesn't know what this server is for.
-			# serve a static explanation page
-			path = os.path.join(cherrypy.request.app.config['/']['tools.staticfile.root'], self.STATIC_INDEX)
-			return cherrypy.lib.static.serve_file(path)
+		if (self.args.stale_while_revalidate > 0):
+			self.cache.set(service + self.FRESH_KEY_SUFFIX, "1", expiry=self.args.cache_expiry)
 
+	def refresh_reply(self, service):
+		"""
+		Rebuild and cache the response for a service. Called on one of the refresh queue's threads.
+
+		Refreshes are not client lookups: they are not counted, do not use the negative cache,
+		and never queue scans. They wait for the load shedder like requests do.
+		"""
+		if (not self.database_available()):
+			return
+		try:
+			self.run_admitted(self.rebuild_reply, service)
+		except (cherrypy.HTTPError, cherrypy.HTTPRedirect) as e:
+			# e.g. we are overloaded, or the service's data was removed - the stale response expires by itself
+			pass
+
+	def rebuild_reply(self, service):
+		"""Read a service from the database and cache a new response for it, if it still has data."""
+		(xml, keys, timestamps_by_key) = self.read_service(service)
+		if (xml == None and len(keys) > 0):
+			self.create_service_xml(service, service.split(",")[1], keys, timestamps_by_key)
+
+	def compress_reply(self, xml, encoding):
+		"""Compress a response with the given content encoding."""
+		if (isinstance(xml, unicode)):
+			xml = xml.encode('utf-8')
+
+		if (encoding == 'gzip'):
+			buf = StringIO.StringIO()
+			# use a fixed mtime so the same response always compresses to the same bytes
+			with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as gz:
+				gz.write(xml)
+			return buf.getvalue()
+		elif (encoding == 'deflate'):
+			# HTTP 'deflate' is zlib-wrapped data (RFC 2616 section 3.5)
+			return zlib.compress(xml, 9)
+		raise ValueError("Unknown content encoding '%s'" % (encoding))
+
+	def get_compressed_copy(self, service, xml, etag, encoding):
+		"""
+		Compress a response with the given content encoding and cache the compressed copy,
+		so later requests in the same encoding don't compress it again.
+		"""
+		compressed = self.compress_reply(xml, encoding)
+		if (self.cache != None):
+			try:
+				# store the etag with it, so a copy of an older response is never sent in place of a newer one
+				with self.tracer.phase('cache_set'):
+					self.cache.set(service + "|" + encoding, etag + " " + compressed, expiry=self.cache_entry_expiry())
+			except Exception as e:
+				print >> sys.stderr, "ERROR caching compressed reply: %s\n" % (e)
+		return compressed
+
+	def unpack_compressed_copy(self, value, etag):
+		"""Return the compressed response from a cache entry made by get_compressed_copy(), or None if it is for another etag."""
+		if (value != None):
+			fields = value.split(" ", 1)
+			if (len(fields) == 2 and fields[0] == etag):
+				return fields[1]
+		return None
+
+	def choose_encoding(self, request_headers, response_headers):
+		"""Return the compressed encoding to send based on the client's Accept-Encoding header, or None."""
+		if (not self.args.compressed_replies or self.cache == None):
+			return None
+
+		response_headers['Vary'] = 'Accept-Encoding'
+		# elements() sorts by quality value, highest first
+		for element in request_headers.elements('Accept-Encoding'):
+			if (element.qvalue <= 0):
+				continue
+			if (element.value == '*'):
+				return self.CONTENT_ENCODINGS[0]
+			if (element.value in self.CONTENT_ENCODINGS):
+				return element.value
+		return None
+
+	def parse_validators(self, value):
+		"""Return the (etag, last_modified) tuple from a cached validators entry, or None if there is no entry."""
+		if (value == None):
+			return None
+		fields = value.split(" ")
+		return (fields[0], int(fields[1]))
+
+	def is_conditional(self, request_headers):
+		"""Return True if the request has conditional request headers."""
+		return ('If-None-Match' in request_headers or 'If-Modified-Since' in request_headers)
+
+	def is_not_modified(self, request_headers, etag, last_modified):
+		"""
+		Return True if the client's conditional request headers show it already has the current response.
+		"""
+		# If-None-Match takes precedence over If-Modified-Since (RFC 7232 section 6)
+		if_none_match = request_headers.get('If-None-Match')
+		if (if_none_match != None):
+			# our etags are weak, so use the weak comparison
+			weak_etag = etag.replace('W/', '', 1)
+			for tag in if_none_match.split(','):
+				tag = tag.strip()
+				if (tag == '*' or tag.replace('W/', '', 1) == weak_etag):
+					return True
+			return False
+
+		if_modified_since = request_headers.get('If-Modified-Since')
+		if (if_modified_since != None and last_modified > 0):
+			since = email.utils.parsedate_tz(if_modified_since)
+			if (since != None):
+				return last_modified <= email.utils.mktime_tz(since)
+
+		return False
+
+	def set_validator_headers(self, response_headers, etag, last_modified):
+		"""Add the response validator headers."""
+		response_headers['ETag'] = etag
+		if (last_modified > 0):
+			response_headers['Last-Modified'] = email.utils.formatdate(last_modified, usegmt=True)
+
+	def get_service_id(self, host, port, service_type):
+		"""
+		Validate the parameters of a request for one service.
+		Returns a tuple of (service, service_type), filling in any default values.
+		"""
 		if (service_type == None):
 			service_type = notary_common.SSL_TYPE
 
@@ -426,53 +819,604 @@ class NotaryHTTPServer:
 		if (host == None or host == '' or port == None or \
 			service_type not in notary_common.SERVICE_TYPES):
 			raise cherrypy.HTTPError(400) # 400 Bad Request
-			
-		cherrypy.response.headers['Content-Type'] = 'text/xml'
-		return self.get_xml(host, port, service_type)
 
+		return (str(host + ":" + port + "," + service_type), service_type)
+
+	def get_cached_response(self, service, request_headers, response_headers):
+		"""
+		Return the body to send for a service if the request can be answered from the cache,
+		or None if the response must be built first.
+		Raises a 304 if the client already has the current response.
+		"""
+		if (self.hot_services != None):
+			self.hot_services.record(service)
+		if (self.recent_requests != None):
+			self.recent_requests.record(service)
+
+		if (self.cache == None):
+			return None
+
+		# read the validators, the response in the client's encoding, and the fresh marker
+		# with one call, so a cache hit costs one round trip to the cache
+		encoding = self.choose_encoding(request_headers, response_headers)
+		body_key = service
+		if (encoding != None):
+			body_key = service + "|" + encoding
+		validators_key = service + self.VALIDATORS_KEY_SUFFIX
+		fresh_key = service + self.FRESH_KEY_SUFFIX
+		keys = [body_key, validators_key]
+		if (self.args.stale_while_revalidate > 0):
+			keys.append(fresh_key)
+
+		try:
+			with self.tracer.phase('cache_get'):
+				found = self.cache.get_multi(keys)
+			validators = self.parse_validators(found.get(validators_key))
+			body = found.get(body_key)
+			if (validators != None and encoding != None):
+				body = self.unpack_compressed_copy(body, validators[0])
+				if (body == None):
+					# the first request in this encoding since the response was cached
+					with self.tracer.phase('cache_get'):
+						xml = self.cache.get(service)
+					if (xml != None):
+						body = self.get_compressed_copy(service, xml, validators[0], encoding)
+		except Exception as e:
+			print >> sys.stderr, "ERROR getting service from cache: %s\n" % (e)
+			(validators, body) = (None, None)
+
+		# every cached response has validators; if either was evicted, build both again
+		if (validators == None or body == None):
+			self.cache_misses.inc()
+			self.ndb.report_metric('CacheMiss', service)
+			return None
+
+		self.cache_hits.inc()
+		self.ndb.report_metric('CacheHit', service)
+		if (fresh_key in keys and fresh_key not in found):
+			self.refresh_queue.add(service)
+
+		self.set_validator_headers(response_headers, *validators)
+		if (self.is_conditional(request_headers) and self.is_not_modified(request_headers, *validators)):
+			raise cherrypy.HTTPRedirect([], 304) # 304 Not Modified
+		if (encoding != None):
+			response_headers['Content-Encoding'] = encoding
+		return body
+
+	def finish_response(self, service, xml, request_headers, response_headers):
+		"""
+		Add the validator headers for a response that was just built and return the body to send,
+		compressed if the client accepts it.
+		Raises a 304 if the client already has the current response.
+		"""
+		(etag, last_modified) = notary_reply.get_validators(xml)
+		self.set_validator_headers(response_headers, etag, last_modified)
+		if (self.is_conditional(request_headers) and self.is_not_modified(request_headers, etag, last_modified)):
+			raise cherrypy.HTTPRedirect([], 304) # 304 Not Modified
+
+		encoding = self.choose_encoding(request_headers, response_headers)
+		if (encoding != None):
+			response_headers['Content-Encoding'] = encoding
+			return self.get_compressed_copy(service, xml, etag, encoding)
+
+		return xml
+
+	def get_xml_batch(self, services):
+		"""
+		Fetch the xml responses for a list of services.
+
+		Returns a list of (service, HTTP status, xml) tuples in the same order as 'services'.
+		xml is None for any service that does not have a 200 status.
+		"""
+		replies = {}
 
-class OnDemandScanThread(threading.Thread): 
+		for service in services:
+			if (self.hot_services != None):
+				self.hot_services.record(service)
+			if (self.recent_requests != None):
+				self.recent_requests.record(service)
 
-	def __init__(self, sid, timeout_sec, use_sni, server_obj, db):
-		self.sid = sid
-		self.timeout_sec = timeout_sec
-		self.use_sni = use_sni
-		self.server_obj = server_obj
-		self.db = db
-		threading.Thread.__init__(self)
+		if (self.cache):
+			swr = (self.args.stale_while_revalidate > 0)
+			keys = list(services)
+			if (swr):
+				keys += [service + self.FRESH_KEY_SUFFIX for service in services]
+			try:
+				with self.tracer.phase('cache_get'):
+					replies = self.cache.get_multi(keys)
+			except Exception as e:
+				print >> sys.stderr, "ERROR getting services from cache: %s\n" % (e)
+			for service in services:
+				if (service in replies):
+					self.cache_hits.inc()
+					self.ndb.report_metric('CacheHit', service)
+					if (swr and (service + self.FRESH_KEY_SUFFIX) not in replies):
+						self.refresh_queue.add(service)
+				else:
+					self.cache_misses.inc()
+					self.ndb.report_metric('CacheMiss', service)
+			replies = dict((service, replies[service]) for service in services if service in replies)
+
+		statuses = {}
+		# answer from memory before waiting to use the database
+		misses = self.filter_negative_cache([service for service in services if service not in replies], statuses)
+
+		if (len(misses) > 0):
+			if (self.database_available()):
+				try:
+					self.run_admitted(self.calculate_service_xml_batch, misses, replies, statuses)
+				except OverloadedError:
+					for service in misses:
+						statuses[service] = 503 # 503 Service Unavailable
+			else:
+				print >> sys.stderr, "ERROR: Database is not available to retrieve data, and data not in the cache.\n"
+				for service in misses:
+					statuses[service] = 503 # 503 Service Unavailable
+
+		results = []
+		for service in services:
+			if (service in replies):
+				results.append((service, 200, replies[service]))
+			else:
+				results.append((service, statuses.get(service, 404), None))
+		return results
+
+	def filter_negative_cache(self, services, statuses, from_request=True):
+		"""Return the services not found in the negative cache; the rest get a 404 in 'statuses'."""
+		remaining = []
+		for service in services:
+			if (self.negative_cache_hit(service, from_request)):
+				statuses[service] = 404 # 404 Not Found
+			else:
+				remaining.append(service)
+		return remaining
 
-	def __del__(self):
-		"""Clean up after scanning."""
-		del self.db
+	def calculate_service_xml_batch(self, services, replies, statuses, from_request=True):
+		"""
+		Query the database once and build responses for a list of services.
+		Responses are added to the 'replies' dictionary;
+		services that cannot be answered have their HTTP status added to 'statuses'.
 
-	def run(self): 
+		If 'from_request' is False (e.g. when warming the cache) no request metrics are reported
+		and unknown services are not scanned.
+		Callers remove services found in the negative cache first - see filter_negative_cache().
+		"""
+		if (from_request):
+			for service in services:
+				self.ndb.report_metric('GetObservationsForService', service)
+		self.db_lookups.inc(len(services))
 
+		if (self.args.stored_responses):
+			try:
+				with self.tracer.phase('db_query', self.db_query_seconds):
+					stored = self.ndb.get_signed_responses(services, self.signer.fingerprint)
+			except Exception as e:
+				print >> sys.stderr, "Error getting stored replies: '%s'" % (e)
+				stored = {}
+			for (service, xml) in stored.iteritems():
+				replies[service] = xml
+				self.cache_reply(service, xml)
+			services = [service for service in services if service not in replies]
+			if (len(services) == 0):
+				return
+
+		obs_by_service = dict((service, []) for service in services)
 		try:
-			fp = attempt_observation_for_service(self.sid, self.timeout_sec, self.use_sni)
+			with self.ndb.get_session() as session:
+				with self.tracer.phase('db_query', self.db_query_seconds):
+					obs = list(self.ndb.get_observations_for_services(session, services))
+				with self.tracer.phase('regroup'):
+					for ob in obs:
+						obs_by_service[ob[0]].append(ob)
+		except Exception as e:
+			# error already logged inside get_observations_for_services.
+			for service in services:
+				statuses[service] = 503 # 503 Service Unavailable
+			return
+
+		for service in services:
+			with self.tracer.phase('regroup'):
+				(keys, timestamps_by_key) = notary_reply.group_observations(obs_by_service[service])
+			if (len(keys) == 0):
+				if (from_request):
+					self.scan_new_service(service)
+				statuses[service] = 404 # 404 Not Found
+			else:
+				replies[service] = self.create_service_xml(service, service.split(",")[1],
+					keys, timestamps_by_key)
+
+	def start_background_tasks(self):
+		"""Start work that should begin once the server is accepting requests."""
+		if (self.args.warm_cache > 0):
+			t = threading.Thread(target=self.warm_cache, name="warm-cache")
+			t.daemon = True
+			t.start()
+		if (self.hot_services != None):
+			t = threading.Thread(target=self.save_hot_services, name="save-hot-services")
+			t.daemon = True
+			t.start()
+		if (self.args.refresh_ahead > 0):
+			t = threading.Thread(target=self.schedule_refresh_ahead, name="refresh-ahead")
+			t.daemon = True
+			t.start()
+
+	def get_hot_services(self, limit):
+		"""Return up to 'limit' of the services requested most often, most requested first."""
+		if (self.ndb.metricsdb):
+			try:
+				return self.ndb.get_most_requested_services(limit, time.time() - self.HOT_SERVICES_PERIOD)
+			except Exception as e:
+				print >> sys.stderr, "Error reading the most requested services from metrics: '%s'" % (e)
+				return []
+		return cache.HotKeys.load(os.path.join(self.LOG_DIR, self.HOT_SERVICES_FILE), limit)
+
+	def warm_cache(self):
+		"""
+		Build and cache replies for the most requested services that are not cached yet,
+		at most --warm-cache-rate services per second.
+		"""
+		if (not self.database_available()):
+			print >> sys.stderr, "Database is not available - the cache will not be warmed."
+			return
+
+		services = [service for service in self.get_hot_services(self.args.warm_cache)
+			if self.SERVICE_ID_FORMAT.match(service)]
+		rate = self.args.warm_cache_rate
+		warmed = 0
+		start = time.time()
+
+		i = 0
+		while (i < len(services)):
+			batch_start = time.time()
+			batch = services[i:i + rate]
+			try:
+				# other processes sharing the cache may have warmed some already
+				cached = self.cache.get_multi(batch)
+				missing = self.filter_negative_cache([service for service in batch if service not in cached], {},
+					from_request=False)
+				replies = {}
+				if (len(missing) > 0):
+					# wait for the database like requests do, so warming never adds to an overload
+					self.run_admitted(self.calculate_service_xml_batch, missing, replies, {}, False)
+				warmed += len(replies)
+			except OverloadedError:
+				# clients need the database more. try the same batch again later
+				time.sleep(self.RETRY_AFTER)
+				continue
+			except Exception as e:
+				print >> sys.stderr, "Error warming the cache: '%s'" % (e)
+				traceback.print_exc(file=sys.stderr)
+			i += rate
+
+			# leave the rest of the second to live requests
+			time.sleep(max(0, 1 - (time.time() - batch_start)))
+
+		print "Warmed the cache with %s of %s services in %d seconds." % (warmed, len(services), time.time() - start)
+
+	def schedule_refresh_ahead(self):
+		"""Regularly queue replies that are still being requested and will expire soon to be rebuilt."""
+		# check often enough that each reply is seen at least once before it expires
+		interval = max(1, min(60, self.args.refresh_ahead / 2))
+		while True:
+			time.sleep(interval)
+			try:
+				self.queue_refresh_ahead()
+			except Exception as e:
+				print >> sys.stderr, "Error checking cached replies to refresh: '%s'" % (e)
+
+	def queue_refresh_ahead(self):
+		"""Queue the services requested since the last check whose replies expire soon to be rebuilt."""
+		(requested, self.recent_requests) = (self.recent_requests, cache.HotKeys())
+		for service in self.refresh_ahead(requested.top(self.REFRESH_AHEAD_CHECKS)):
+			self.refresh_queue.add(service)
+
+	def refresh_ahead(self, services):
+		"""Return the services whose cached replies expire within --refresh-ahead seconds."""
+		expiring = []
+		# for caches that cannot report how long a key has left, use the expiry time stored with the validators
+		no_ttl = []
+		for service in services:
+			ttl = self.cache.get_ttl(service)
+			if (ttl == None):
+				no_ttl.append(service)
+			elif (ttl - max(0, self.args.stale_while_revalidate) <= self.args.refresh_ahead):
+				expiring.append(service)
+
+		if (len(no_ttl) > 0):
+			now = time.time()
+			keys = [service + self.VALIDATORS_KEY_SUFFIX for service in no_ttl]
+			found = self.cache.get_multi(keys)
+			for (service, key) in zip(no_ttl, keys):
+				fields = found.get(key, "").split(" ")
+				if (len(fields) > 2 and int(fields[2]) - now <= self.args.refresh_ahead):
+					expiring.append(service)
+		return expiring
+
+	def save_hot_services(self):
+		"""Regularly save the most requested services, so the next run can warm the cache with them."""
+		path = os.path.join(self.LOG_DIR, self.HOT_SERVICES_FILE)
+		while True:
+			time.sleep(self.HOT_SERVICES_SAVE_INTERVAL)
+			try:
+				self.hot_services.save(path, self.args.warm_cache)
+			except (IOError, OSError) as e:
+				print >> sys.stderr, "Error saving the most requested services to '%s': '%s'" % (path, e)
+
+	def scan_new_service(self, service):
+		"""
+		Queue an on-demand scan for a service we have no data about, unless too many scans are already waiting.
+		Also remember that we have no data, so we don't look for it again until the scan is done.
+		"""
+		# set this before the scan starts, so it can't overwrite the scan's result
+		self.negative_cache.set(service, cache.NegativeCache.SCAN_IN_PROGRESS)
+		if (self.scan_queue.add(service)):
+			self.ndb.report_metric('ScanForNewService', service)
+		else:
+			self.negative_cache.set(service, cache.NegativeCache.NO_DATA)
+			self.ndb.report_metric('ProbeLimitExceeded', "ScanQueueSize: " + str(self.args.scan_queue_size) + \
+				" Service: " + service)
+
+	def scan_service(self, service, timeout_sec=10):
+		"""Scan a service and record what we find. Called on one of the scan queue's threads."""
+		try:
+			fp = attempt_observation_for_service(service, timeout_sec, self.use_sni)
 			if (fp != None):
-				self.db.report_observation(self.sid, fp)
-			# else error already logged
+				self.ndb.report_observation(service, fp)
+				# clients can now get the data right away
+				self.negative_cache.remove(service)
+				if (self.args.stored_responses):
+					notary_reply.store_service_reply(self.ndb, service, self.signer,
+						self.args.compact_replies)
+				else:
+					# report_observation() leaves any stored reply in place
+					self.ndb.delete_signed_response(service)
+			else:
+				# error already logged
+				self.negative_cache.set(service, cache.NegativeCache.SCAN_FAILED)
 			# TODO: add internal blacklisting to remove sites that don't exist or stop working.
 		except (ValueError, SSLScanTimeoutException, SSLAlertException) as e:
-			self.db.report_metric('OnDemandServiceScanFailure', self.sid + " " + str(e))
-			print >> sys.stderr, "Error scanning '{0}' - {1}".format(self.sid, e)
+			self.negative_cache.set(service, cache.NegativeCache.SCAN_FAILED)
+			self.ndb.report_metric('OnDemandServiceScanFailure', service + " " + str(e))
+			print >> sys.stderr, "Error scanning '{0}' - {1}".format(service, e)
 		except Exception as e:
-			self.db.report_metric('OnDemandServiceScanFailure', self.sid + " " + str(e))
+			self.negative_cache.set(service, cache.NegativeCache.SCAN_FAILED)
+			self.ndb.report_metric('OnDemandServiceScanFailure', service + " " + str(e))
 			traceback.print_exc(file=sys.stdout)
+
+	@cherrypy.expose
+	def index(self, host=None, port=None, service_type=None, **invalid_params):
+		if(len(invalid_params) > 0):
+			# invalid_params will catch any other parameters sent to the web server.
+			# if we have any it's an invalid request.
+			raise cherrypy.HTTPError(400) # 400 Bad Request
+
+		if (host == None and port == None and service_type == None):
+			# probably a visitor that doesn't know what this server is for.
+			# serve a static explanation page
+			path = os.path.join(cherrypy.request.app.config['/']['tools.staticfile.root'], self.STATIC_INDEX)
+			return cherrypy.lib.static.serve_file(path)
+
+		(service, service_type) = self.get_service_id(host, port, service_type)
+		cherrypy.response.headers['Content-Type'] = 'text/xml'
+
+		request_headers = cherrypy.request.headers
+		response_headers = cherrypy.response.headers
+
+		trace = self.tracer.start('index')
+		try:
+			with self.tracer.activate(trace):
+				body = self.get_cached_response(service, request_headers, response_headers)
+				if (body == None):
+					xml = self.get_uncached_xml(service, service_type)
+					body = self.finish_response(service, xml, request_headers, response_headers)
+			return body
 		finally:
-			self.server_obj.scan_finished(self.sid)
+			self.tracer.finish(trace)
+
+	@cherrypy.expose
+	def batch(self, service=None, **invalid_params):
+		"""
+		Return the responses for many services at once.
+		Services are sent with POST as repeated 'service' parameters of the form host:port,service_type.
+		"""
+		if (cherrypy.request.method != 'POST'):
+			cherrypy.response.headers['Allow'] = 'POST'
+			raise cherrypy.HTTPError(405) # 405 Method Not Allowed
+
+		if (len(invalid_params) > 0 or service == None):
+			raise cherrypy.HTTPError(400) # 400 Bad Request
+
+		services = self.get_batch_service_ids(service)
+
+		trace = self.tracer.start('batch')
+		try:
+			with self.tracer.activate(trace):
+				results = self.get_xml_batch(services)
+		finally:
+			self.tracer.finish(trace)
+		cherrypy.response.headers['Content-Type'] = 'text/xml'
+		if (self.needs_retry(results)):
+			cherrypy.response.headers['Retry-After'] = str(self.RETRY_AFTER)
+		return self.format_batch_xml(results)
+
+	@cherrypy.expose
+	def metrics(self, **params):
+		"""Return this process's counters and timings - see doc/advanced_notary_configuration.txt."""
+		cherrypy.response.headers['Content-Type'] = metrics_registry.CONTENT_TYPE
+		return self.get_metrics_text(self.is_local_address(cherrypy.request.remote.ip))
+
+	def is_local_address(self, client_ip):
+		"""Return True if a client IP address is on this machine."""
+		return client_ip in self.LOCAL_ADDRESSES
+
+	def get_metrics_text(self, local_client):
+		"""
+		Return the metrics served at /metrics.
+		Raises a 404 unless the endpoint is turned on and 'local_client' is True - the request comes from this machine.
+		"""
+		if (not self.args.metrics_endpoint or not local_client):
+			raise cherrypy.HTTPError(404) # 404 Not Found
+		return self.registry.render()
+
+	def needs_retry(self, results):
+		"""Return True if any of the results of get_xml_batch() could not be answered for now."""
+		for (service, status, xml) in results:
+			if (status == 503):
+				return True
+		return False
+
+	def get_batch_service_ids(self, service):
+		"""Validate the services sent in a batch request and return the list of unique service names."""
+		if (not isinstance(service, list)):
+			service = [service]
+
+		# reject huge requests before checking any of them
+		if (len(service) > self.MAX_BATCH_IDS):
+			raise cherrypy.HTTPError(413) # 413 Request Entity Too Large
+
+		services = []
+		seen = set()
+		for sid in service:
+			match = self.SERVICE_ID_FORMAT.match(sid)
+			if (match == None or match.group(3) not in notary_common.SERVICE_TYPES):
+				raise cherrypy.HTTPError(400) # 400 Bad Request
+			sid = str(sid)
+			if (sid not in seen):
+				seen.add(sid)
+				services.append(sid)
+				if (len(services) > self.MAX_BATCH_SIZE):
+					raise cherrypy.HTTPError(413) # 413 Request Entity Too Large
+
+		return services
+
+	def format_batch_xml(self, results):
+		"""Wrap the results of get_xml_batch() in one xml document."""
+		parts = ['<notary_replies>\n']
+		for (service, status, xml) in results:
+			if (xml != None):
+				parts.append('<service_reply service=%s status="%d">\n' % (quoteattr(service), status))
+				parts.append(xml)
+				parts.append('</service_reply>\n')
+			else:
+				parts.append('<service_reply service=%s status="%d"/>\n' % (quoteattr(service), status))
+		parts.append('</notary_replies>\n')
+		return "".join(parts)
+
+
+class OverloadedError(cherrypy.HTTPError):
+	"""A '503 Service Unavailable' error that tells clients when to try again."""
+
+	def __init__(self, retry_after):
+		self.retry_after = retry_after
+		cherrypy.HTTPError.__init__(self, 503)
 
+	def set_response(self):
+		cherrypy.HTTPError.set_response(self)
+		# set_response() removes any Retry-After header, so add ours afterwards
+		cherrypy.serving.response.headers['Retry-After'] = str(self.retry_after)
 
-# track locks at the module level so we only use them once across all cherrypy threads
-PROBE_LIMIT = 10 # simultaneous scans for new services
-scan_semaphore = threading.BoundedSemaphore(PROBE_LIMIT)
-scan_sites = {}
-scan_sites_lock = threading.Lock()
 
+class InheritedSocketServer(CPWSGIServer):
+	"""A CherryPy web server that accepts connections on a socket that is already listening."""
+
+	def __init__(self, server_adapter, listener):
+		self.listener = listener
+		CPWSGIServer.__init__(self, server_adapter)
+
+	def bind(self, family, type, proto=0):
+		"""Use the listening socket instead of creating and binding a new one."""
+		self.socket = self.listener
+
+
+class WorkerSupervisor(object):
+	"""
+	Run the notary in several forked worker processes that share one listening socket,
+	and restart any worker that exits.
+	"""
+
+	MIN_UPTIME = 5 # seconds. workers that exit sooner than this are restarted after a delay
+	RESTART_DELAY = 1 # seconds
+
+	def __init__(self, notary, static_root):
+		self.notary = notary
+		self.static_root = static_root
+		self.workers = {} # process ID -> start time
+		self.stopping = False
+		self.listener = None
+
+	def run(self):
+		"""Start the workers and keep them running until we are told to stop."""
+		if (not hasattr(os, 'fork')):
+			print >> sys.stderr, "ERROR: --workers is not supported on this platform."
+			exit(1)
+
+		self.listener = create_listener(self.notary)
+
+		# workers open their own database connections
+		if (self.notary.ndb):
+			self.notary.ndb.dispose_connections()
+
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+
+		for i in range(self.notary.args.workers):
+			self.start_worker()
+		print "Started %d worker processes." % (len(self.workers))
+
+		while (len(self.workers) > 0):
+			try:
+				(pid, status) = os.wait()
+			except OSError as e:
+				if (e.errno == errno.EINTR):
+					continue
+				raise
+
+			started = self.workers.pop(pid, None)
+			if (started == None or self.stopping):
+				continue
+
+			if (os.WIFSIGNALED(status)):
+				reason = "was stopped by signal %d" % (os.WTERMSIG(status))
+			else:
+				reason = "exited with status %d" % (os.WEXITSTATUS(status))
+			print >> sys.stderr, "Worker process %d %s - restarting it." % (pid, reason)
+			if (time.time() - started < self.MIN_UPTIME):
+				# don't restart in a tight loop if workers fail right away
+				time.sleep(self.RESTART_DELAY)
+			if (not self.stopping):
+				self.start_worker()
+
+	def start_worker(self):
+		pid = os.fork()
+		if (pid != 0):
+			self.workers[pid] = time.time()
+			return
+
+		# worker process
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		signal.signal(signal.SIGINT, signal.SIG_DFL)
+		exit_status = 0
+		try:
+			self.notary.after_fork()
+			serve(self.notary, self.static_root, self.listener)
+		except SystemExit as e:
+			exit_status = e.code
+		except BaseException:
+			traceback.print_exc(file=sys.stderr)
+			exit_status = 1
+		finally:
+			# never return into the supervisor's loop
+			os._exit(exit_status or 0)
+
+	def stop(self, signum, frame):
+		"""Stop all workers."""
+		self.stopping = True
+		for pid in self.workers.keys():
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:
+				pass
 
-# create an instance here so command-line args will be automatically passed and parsed
-# before we start the web server
-notary = NotaryHTTPServer()
 
 # PATCH: cherrypy has problems binding to the port on hosted server spaces
 # https://bitbucket.org/cherrypy/cherrypy/issue/1100/cherrypy-322-gives-engine-error-when
@@ -487,38 +1431,88 @@ servers.wait_for_occupied_port = fake_wait_for_occupied_port
 def fake_access(): return
 cherrypy.log.access = fake_access
 
-cherrypy.config.update({ 'server.socket_port' : notary.web_port,
-			 'server.socket_host' : "0.0.0.0",
-			 'server.socket_queue_size': notary.args.socket_queue_size,
-			 'server.thread_pool': notary.args.thread_pool_size,
-			 'request.show_tracebacks' : False,  
-			 # IMPORTANT PRIVACY SETTINGS!
-			 # we do *not* want to record any information about clients
-			 'log.access_file' : None,
-			 # disable all locations of logging request headers
-			 'server.log_request_headers': False,
-			 'cherrypy.lib.cptools.log_request_headers': False,
-			 'tools.log_headers.on': False,
-			 # end of privacy settings
-			 'log.error_file' : '{0}/{1}'.format(notary.LOG_DIR, notary.LOG_FILE),
-			 'log.screen' : False } ) 
-
-if (notary.args.echo_screen):
-	cherrypy.config.update({
-			 'log.error_file' : None,
-			 'log.screen' : True } )
-
-static_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), notary.STATIC_DIR)
-notary_config = { '/': {'tools.staticfile.root' : static_root,
-						'tools.staticdir.root' : static_root }}
-
-app = cherrypy.tree.mount(notary, '/', config=notary_config)
-app.merge("notary.cherrypy.config")
-
-if hasattr(cherrypy.engine, "signal_handler"):
-	cherrypy.engine.signal_handler.subscribe()
-if hasattr(cherrypy.engine, "console_control_handler"):
-	cherrypy.engine.console_control_handler.subscribe()
-cherrypy.engine.start()
-cherrypy.engine.block()
 
+def configure_cherrypy(notary):
+	"""Apply the global cherrypy settings, including the privacy settings used by every front end."""
+	cherrypy.config.update({ 'server.socket_port' : notary.web_port,
+				 'server.socket_host' : "0.0.0.0",
+				 'server.socket_queue_size': notary.args.socket_queue_size,
+				 'server.thread_pool': notary.args.thread_pool_size,
+				 'request.show_tracebacks' : False,  
+				 # IMPORTANT PRIVACY SETTINGS!
+				 # we do *not* want to record any information about clients
+				 'log.access_file' : None,
+				 # disable all locations of logging request headers
+				 'server.log_request_headers': False,
+				 'cherrypy.lib.cptools.log_request_headers': False,
+				 'tools.log_headers.on': False,
+				 # end of privacy settings
+				 'log.error_file' : '{0}/{1}'.format(notary.LOG_DIR, notary.LOG_FILE),
+				 'log.screen' : False } ) 
+
+	if (notary.args.echo_screen):
+		cherrypy.config.update({
+				 'log.error_file' : None,
+				 'log.screen' : True } )
+
+def create_listener(notary):
+	"""Create the socket that worker processes accept connections on."""
+	listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	listener.bind(("0.0.0.0", notary.web_port))
+	listener.listen(notary.args.socket_queue_size)
+	return listener
+
+def serve(notary, static_root, listener=None):
+	"""
+	Serve requests until we are told to stop.
+	If 'listener' is given accept connections on it rather than opening the web port.
+	"""
+	if (notary.args.async_frontend):
+		import notary_async
+		notary_async.serve(notary, static_root, listener)
+		return
+
+	notary_config = { '/': {'tools.staticfile.root' : static_root,
+							'tools.staticdir.root' : static_root }}
+
+	app = cherrypy.tree.mount(notary, '/', config=notary_config)
+	app.merge("notary.cherrypy.config")
+
+	if (listener != None):
+		# the port is already in use - by our own listening socket
+		def fake_wait_for_free_port(host, port): return
+		servers.wait_for_free_port = fake_wait_for_free_port
+		cherrypy.server.httpserver = InheritedSocketServer(cherrypy.server, listener)
+
+		# the autoreloader and SIGHUP would restart this worker as a whole new notary;
+		# let the supervisor handle restarts instead
+		cherrypy.config.update({'engine.autoreload.on': False})
+		if hasattr(cherrypy.engine, "signal_handler"):
+			cherrypy.engine.signal_handler.handlers.pop('SIGHUP', None)
+
+	if hasattr(cherrypy.engine, "signal_handler"):
+		cherrypy.engine.signal_handler.subscribe()
+	if hasattr(cherrypy.engine, "console_control_handler"):
+		cherrypy.engine.console_control_handler.subscribe()
+	cherrypy.engine.start()
+	notary.start_background_tasks()
+	cherrypy.engine.block()
+
+def main():
+	# create an instance here so command-line args will be automatically passed and parsed
+	# before we start the web server
+	notary = NotaryHTTPServer()
+	print "Using public key\n" + notary.notary_public_key
+	configure_cherrypy(notary)
+
+	static_root = notary.STATIC_DIR
+
+	if (notary.args.workers > 1):
+		WorkerSupervisor(notary, static_root).run()
+	else:
+		serve(notary, static_root)
+
+
+if __name__ == '__main__':
+	main()
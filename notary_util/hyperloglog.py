@@ -0,0 +1,91 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Estimate how many different values were seen, in a small fixed amount of memory.
+
+See Flajolet et al., "HyperLogLog: the analysis of a near-optimal cardinality estimation algorithm" (2007).
+"""
+
+import base64
+import hashlib
+import math
+import struct
+
+
+class HyperLogLog(object):
+	"""
+	A HyperLogLog sketch.
+
+	Sketches with the same precision can be merged, e.g. to count the different services
+	requested in a day from the sketches for each hour.
+	The typical error is about 1.04 / sqrt(2 ** precision): 3.3% for the default precision.
+	"""
+
+	PRECISION = 10 # 2 ** 10 one-byte registers
+
+	def __init__(self, precision=PRECISION, registers=None):
+		if (precision < 4 or precision > 16):
+			raise ValueError("HyperLogLog precision must be between 4 and 16, not %s" % precision)
+		self.precision = precision
+		self.num_registers = 1 << precision
+		if (registers == None):
+			registers = bytearray(self.num_registers)
+		elif (len(registers) != self.num_registers):
+			raise ValueError("Expected %d registers, not %d" % (self.num_registers, len(registers)))
+		self.registers = registers
+
+	def add(self, value):
+		"""Record that we have seen 'value' (a string)."""
+		if (isinstance(value, unicode)):
+			value = value.encode('utf-8')
+		(x,) = struct.unpack('>Q', hashlib.sha1(value).digest()[:8])
+		index = x >> (64 - self.precision)
+		# the position of the first 1 bit in the rest of the hash
+		rest = x & ((1 << (64 - self.precision)) - 1)
+		rank = (64 - self.precision) - rest.bit_length() + 1
+		if (rank > self.registers[index]):
+			self.registers[index] = rank
+
+	def merge(self, other):
+		"""Add everything seen by another sketch with the same precision to this one."""
+		if (other.precision != self.precision):
+			raise ValueError("Cannot merge HyperLogLog sketches with precision %d and %d" % \
+				(self.precision, other.precision))
+		for i in xrange(self.num_registers):
+			if (other.registers[i] > self.registers[i]):
+				self.registers[i] = other.registers[i]
+
+	def count(self):
+		"""Return the estimated number of different values seen."""
+		m = float(self.num_registers)
+		alpha = 0.7213 / (1 + 1.079 / m)
+		estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+		zeros = self.registers.count("\x00")
+		if (estimate <= 2.5 * m and zeros > 0):
+			# for small counts, count the empty registers instead (linear counting)
+			estimate = m * math.log(m / zeros)
+		return int(round(estimate))
+
+	def to_string(self):
+		"""Return the sketch as ASCII text, e.g. to store in the database."""
+		return "%d:%s" % (self.precision, base64.b64encode(str(self.registers)))
+
+	@staticmethod
+	def from_string(text):
+		"""Return the sketch stored by to_string()."""
+		(precision, encoded) = text.split(":", 1)
+		return HyperLogLog(int(precision), bytearray(base64.b64decode(encoded)))
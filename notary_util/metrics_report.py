@@ -0,0 +1,113 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Roll up notary metrics into hourly totals, delete old raw events,
+and print reports of notary demand from the totals.
+"""
+
+import argparse
+import time
+
+from notary_db import ndb
+from hyperloglog import HyperLogLog
+
+
+DEFAULT_DAYS = 7
+DEFAULT_RETENTION_DAYS = 30
+DEFAULT_OUTFILE = "-"
+
+# events that each mean one client request - see doc/metrics.txt
+REQUEST_EVENT_TYPES = ['GetObservationsForService', 'CacheHit', 'NegativeCacheHit']
+COLUMNS = ['Requests', 'Services', 'CacheHit', 'CacheMiss', 'ScanForNewService', 'ProbeLimitExceeded']
+
+
+def summarize(hourly, period):
+	"""
+	Group the results of ndb.get_hourly_metrics() into periods of 'period' seconds.
+	Returns a list of (period start, {column: value}, {event type: count}) tuples.
+	"""
+	periods = []
+	for (hour, event_type, count, sketch) in hourly:
+		start = hour - (hour % period)
+		if (len(periods) == 0 or periods[-1][0] != start):
+			periods.append((start, {'Requests': 0, 'Services': HyperLogLog()}, {}))
+		(start, columns, events) = periods[-1]
+
+		events[event_type] = events.get(event_type, 0) + count
+		if (event_type in REQUEST_EVENT_TYPES):
+			columns['Requests'] += count
+			if (sketch != None):
+				columns['Services'].merge(sketch)
+
+	for (start, columns, events) in periods:
+		columns['Services'] = columns['Services'].count()
+		for column in COLUMNS:
+			if (column not in columns):
+				columns[column] = events.get(column, 0)
+	return periods
+
+def print_report(periods, hourly, all_events, output_file):
+	"""Print one line for each period, with the number of events in each column."""
+	time_format = "%Y-%m-%d %H:00" if hourly else "%Y-%m-%d"
+	print >> output_file, "%-16s" % "Period" + "".join("  %s" % column for column in COLUMNS)
+	for (start, columns, events) in periods:
+		print >> output_file, "%-16s" % time.strftime(time_format, time.gmtime(start)) + \
+			"".join("  %*d" % (len(column), columns[column]) for column in COLUMNS)
+		if (all_events):
+			for event_type in sorted(events):
+				print >> output_file, "\t%-28s %d" % (event_type, events[event_type])
+
+
+parser = argparse.ArgumentParser(parents=[ndb.get_parser()],
+description=__doc__,
+epilog="Run with --rollup regularly (e.g. hourly from cron) on a notary that uses --metricsdb. \
+'Services' is an estimate of the number of different services requested, accurate to within a few percent.")
+
+parser.add_argument('output_file', type=argparse.FileType('w'), nargs='?', default=DEFAULT_OUTFILE,
+			help="File to write the report to. Use '-' to write to stdout. Writing to stdout is the default if no file is given.")
+parser.add_argument('--rollup', action='store_true', default=False,
+			help="Add up the metric events from every complete hour that has not been rolled up yet, \
+			and delete raw events older than --retention-days, before printing the report.")
+parser.add_argument('--retention-days', type=int, default=DEFAULT_RETENTION_DAYS, metavar='DAYS',
+			help="With --rollup: keep raw metric events for this many days. 0 keeps them forever. Default: %(default)s. \
+			notary_http.py --warm-cache reads the last week of raw events, so keep at least 7 days if you use it.")
+parser.add_argument('--days', type=int, default=DEFAULT_DAYS,
+			help="Report on this many days, up to the last complete hour. 0 prints no report. Default: %(default)s.")
+parser.add_argument('--hourly', action='store_true', default=False,
+			help="Print one line for each hour rather than for each day (UTC).")
+parser.add_argument('--all-events', action='store_true', default=False,
+			help="Also print the count of every event type in each period.")
+
+args = parser.parse_args()
+
+# pass ndb the args so it can use any relevant ones from its own parser
+ndb = ndb(args)
+
+if (args.rollup):
+	hours = ndb.rollup_metrics()
+	print "Rolled up %d hours of metrics." % hours
+	if (args.retention_days > 0):
+		deleted = ndb.prune_metrics(args.retention_days * 24 * 3600)
+		print "Deleted %d metric events older than %d days." % (deleted, args.retention_days)
+
+if (args.days > 0):
+	now = int(time.time())
+	end = now - (now % 3600)
+	period = 3600 if args.hourly else 24 * 3600
+	since = end - args.days * 24 * 3600
+	hourly = ndb.get_hourly_metrics(since - (since % period), end)
+	print_report(summarize(hourly, period), args.hourly, args.all_events, args.output_file)
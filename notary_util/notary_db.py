@@ -22,6 +22,7 @@ and keeps things modular for easier refactoring.
 """
 
 import argparse
+import atexit
 from contextlib import contextmanager
 import os
 import re
@@ -40,6 +41,8 @@ from sqlalchemy.schema import CheckConstraint, UniqueConstraint
 from sqlalchemy.sql import select, and_, func
 from sqlalchemy import Column, Integer, String, Index, ForeignKey
 
+from hyperloglog import HyperLogLog
+
 
 # class to base ORM classes on
 ORMBase = declarative_base()
@@ -112,6 +115,18 @@ Index('ix_observations_end', Observations.end)
 Index('ix_observations_service_id_key_end', Observations.service_id, Observations.key, Observations.end)
 
 
+class SignedResponses(ORMBase):
+	"""
+	Signed notary replies built ahead of time, so they can be returned without signing on each request.
+	A service has at most one stored reply; the scanner replaces or removes it whenever the service's observations change.
+	"""
+	__tablename__ = 't_signed_responses'
+	service_id = Column(Integer, ForeignKey('t_services.service_id'), nullable=False, primary_key=True)
+	created = Column(Integer, nullable=False) # unix timestamp - when the reply was signed.
+	key_fingerprint = Column(String, nullable=False) # crypto.key_fingerprint() of the key that signed the reply.
+	xml = Column(String, nullable=False)
+
+
 class EventTypes(ORMBase):
 	"""
 	Various types of events we may be interested in tracking while a notary server runs.
@@ -136,45 +151,143 @@ class Metrics(ORMBase):
 # we want writing data to be as fast as possible.
 # analysis can be done later on a copy of the data so it doesn't slow down the actual notary machine.
 
+class MetricsHourly(ORMBase):
+	"""
+	The number of metric events of each type in each hour - see ndb.rollup_metrics().
+	Raw Metrics rows can be deleted once they are counted here, so reports stay fast and the database stays small.
+	"""
+	__tablename__ = 't_metrics_hourly'
+	hour = Column(Integer, nullable=False, primary_key=True) # unix timestamp of the start of the hour.
+	event_type_id = Column(Integer, ForeignKey('t_event_types.event_type_id'), nullable=False, primary_key=True)
+	count = Column(Integer, nullable=False)
+	# for events that note a service: a HyperLogLog sketch of the different services,
+	# so they can be counted for any number of hours without storing service names.
+	services_sketch = Column(String)
+
 
-def ratelimited(max_per_second=1):
+class MetricsWriter(object):
 	"""
-	Decorate a function, only allowing it to be called every so often.
+	Write metric events to the database in the background, many rows at a time.
+
+	Callers only add events to an in-memory buffer; a thread inserts everything buffered
+	with one statement every FLUSH_INTERVAL seconds.
+	If the buffer fills up faster than it is written, further events are dropped so memory stays bounded.
+	Each flush records how many events of each type were dropped, as one MetricsDropped event per type.
 	"""
-	# we could make this available to other modules if it would be useful.
-
-	min_interval = 1.0 / float(max_per_second)
-	warn_every = 10 # seconds
-
-	def decorate(func):
-		last_called = [0.0]
-		last_warned = [0.0]
-		num_skips = [0]
-
-		def rate_limited_function(*args,**kargs):
-			curtime = time.clock()
-			elapsed = curtime - last_called[0]
-			left_to_wait = min_interval - elapsed
-
-			if left_to_wait <= 0:
-				# return the actual function so it can be called
-				ret = func(*args, **kargs)
-				last_called[0] = curtime
-
-				# we want to note in the logs that some calls were skipped,
-				# while not printing the log too often -
-				# that would slow down the system and defeat the purpose of rate limiting.
-				if ((curtime - last_warned[0] >= warn_every) and (num_skips[0] > 0)):
-					print >> sys.stderr, "WARNING: Skipped %s calls to '%s()' in %s seconds." % (num_skips[0], func.__name__, warn_every)
-					last_warned[0] = curtime
-					num_skips[0] = 0
+
+	FLUSH_INTERVAL = 1 # seconds
+	MAX_BUFFERED = 10000 # events
+
+	DROPPED_EVENT_TYPE = 'MetricsDropped'
+
+	def __init__(self, db, flush_interval=FLUSH_INTERVAL, max_buffered=MAX_BUFFERED, event_types=None):
+		"""
+		'db': the SQLAlchemy engine to write to.
+		'event_types': a dictionary of event type name -> event_type_id, used to record dropped events.
+		"""
+		self.db = db
+		self.event_types = event_types if event_types != None else {}
+		self.flush_interval = flush_interval
+		self.max_buffered = max_buffered
+		self.lock = threading.Lock()
+		self.write_lock = threading.Lock()
+		self._reset()
+
+	def _reset(self):
+		"""Start with an empty buffer and no thread, e.g. in a newly forked process."""
+		self.pid = os.getpid()
+		self.thread = None
+		self.closed = False
+		self.events = [] # (event_type_id, date, comment)
+		self.dropped = {} # event_type_id -> number of events not buffered because the buffer was full
+
+	def add(self, event_type_id, comment):
+		"""Buffer one event to be written soon."""
+		date = int(time.time())
+		with self.lock:
+			if (self.pid != os.getpid()):
+				# events buffered before a fork belong to the parent process
+				self._reset()
+			if (self.thread == None):
+				self._start()
+
+			if (len(self.events) < self.max_buffered):
+				self.events.append((event_type_id, date, comment))
 			else:
-				# ignore the function call and continue
-				ret = lambda: True
-				num_skips[0] += 1
-			return ret
-		return rate_limited_function
-	return decorate
+				self.dropped[event_type_id] = self.dropped.get(event_type_id, 0) + 1
+
+	def _start(self):
+		"""Start the thread that writes events. Caller must hold the lock."""
+		self.thread = threading.Thread(target=self._run, name="metrics-writer")
+		self.thread.daemon = True
+		self.thread.start()
+		# don't lose the last few events when the program exits
+		atexit.register(self.close)
+
+	def close(self):
+		"""Write any buffered events and stop the writer thread."""
+		self.closed = True
+		self.flush()
+
+	def _run(self):
+		while True:
+			time.sleep(self.flush_interval)
+			if (self.closed):
+				# the interpreter may be shutting down
+				return
+			try:
+				self.flush()
+			except Exception as e:
+				# keep writing later events
+				print >> sys.stderr, "Error writing metrics: '%s'" % e
+
+	def flush(self):
+		"""Write every buffered event now. Returns the number of rows written."""
+		with self.write_lock:
+			with self.lock:
+				if (self.pid != os.getpid()):
+					return 0
+				(events, dropped) = (self.events, self.dropped)
+				self.events = []
+				self.dropped = {}
+
+			rows = [{'event_type_id': event_type_id, 'date': date, 'comment': comment}
+				for (event_type_id, date, comment) in events]
+			rows.extend(self._dropped_rows(dropped))
+			if (len(rows) == 0):
+				return 0
+
+			try:
+				with self.db.begin() as conn:
+					# a list of parameters runs the insert with executemany()
+					conn.execute(Metrics.__table__.insert(), rows)
+			except (ProgrammingError, IntegrityError, OperationalError, ResourceClosedError) as e:
+				# ResourceClosedError can happen when the database is under heavy load
+				print >> sys.stderr, "Error writing %d metrics: '%s'" % (len(rows), e)
+				return 0
+			return len(rows)
+
+	def _dropped_rows(self, dropped):
+		"""Return a MetricsDropped row for each event type in 'dropped', noting the type and how many were dropped."""
+		if (len(dropped) == 0):
+			return []
+		if (self.DROPPED_EVENT_TYPE not in self.event_types):
+			print >> sys.stderr, "Dropped %d metric events because too many arrived at once." % sum(dropped.values())
+			return []
+		names = dict((event_type_id, name) for (name, event_type_id) in self.event_types.iteritems())
+		date = int(time.time())
+		return [{'event_type_id': self.event_types[self.DROPPED_EVENT_TYPE], 'date': date,
+			'comment': "%s %d" % (names.get(event_type_id, event_type_id), count)}
+			for (event_type_id, count) in sorted(dropped.iteritems())]
+
+	@staticmethod
+	def parse_dropped(comment):
+		"""Return the (event type name, number dropped) noted by a MetricsDropped event, or None if it cannot be read."""
+		try:
+			(name, count) = comment.rsplit(" ", 1)
+			return (name, int(count))
+		except (AttributeError, ValueError):
+			return None
 
 
 class ndb:
@@ -214,9 +327,13 @@ class ndb:
 
 	EVENT_TYPE_NAMES=['GetObservationsForService', 'ScanForNewService', 'ProbeLimitExceeded',
 		'ServiceScanStart', 'ServiceScanStop', 'ServiceScanFailure', 'CacheHit', 'CacheMiss',
-		'OnDemandServiceScanFailure', 'EventTypeUnknown']
+		'OnDemandServiceScanFailure', 'NegativeCacheHit', 'LoadSheddingStart', 'LoadSheddingStop',
+		'MetricsDropped', 'EventTypeUnknown']
 	EVENT_TYPES={}
 	METRIC_PREFIX = "NOTARY_METRIC"
+	# events whose comment is the name of a service, so we can count the different services in rollups
+	SERVICE_EVENT_TYPE_NAMES = ['GetObservationsForService', 'ScanForNewService', 'CacheHit', 'CacheMiss',
+		'NegativeCacheHit']
 
 	# if the scanner does not run regularly and consistently,
 	# blindly updating an observation's end time
@@ -336,6 +453,7 @@ class ndb:
 
 		# cache data used when logging metrics
 		self.__init_event_types()
+		self.metrics_writer = MetricsWriter(self.db, event_types=self.EVENT_TYPES)
 
 		if (write_config_file):
 			self._write_db_config(locals())
@@ -612,6 +730,13 @@ class ndb:
 		"""Return the count of open database connections."""
 		return self._open_connections
 
+	def dispose_connections(self):
+		"""
+		Close all pooled database connections; new ones are opened when they are next needed.
+		Call this before forking, so processes never share a connection.
+		"""
+		self.db.dispose()
+
 	@contextmanager
 	def _get_connection(self):
 		"""
@@ -660,7 +785,7 @@ class ndb:
 		with self._get_connection() as conn:
 			return conn.execute(select([Services.name]).where(\
 				and_(Services.service_id == Observations.service_id,\
-				~Services.name.in_(self._get_newest_service_names(conn, end_limit))\
+				~Services.name.in_([row[0] for row in self._get_newest_service_names(conn, end_limit)])\
 				))).fetchall()
 
 	def insert_service(self, session, service_name):
@@ -715,6 +840,41 @@ class ndb:
 
 		return
 
+	def insert_bulk_observations(self, observations):
+		"""
+		Add multiple Observations to the database at once.
+		This is much faster than adding them one record at a time,
+		but unlike report_observation() the records are not checked against existing ones.
+		Use it to import or generate data, a few thousand records at a time.
+
+		'observations': a list of (service name, key, start, end) tuples.
+		The services must already be in the database.
+		Returns the number of observations added.
+		"""
+		if len(observations) < 1:
+			return 0
+
+		with self._get_connection() as conn:
+			try:
+				names = set(ob[0] for ob in observations)
+				service_ids = dict((row[0], row[1]) for row in
+					conn.execute(select([Services.name, Services.service_id], Services.name.in_(names))).fetchall())
+
+				rows = [{'service_id': service_ids[service], 'key': key, 'start': start, 'end': end}
+					for (service, key, start, end) in observations
+					if service in service_ids and 0 <= start <= end]
+				if (len(rows) < len(observations)):
+					print >> sys.stderr, "Skipped %d observations for unknown services or with invalid times." % \
+						(len(observations) - len(rows))
+
+				if (len(rows) > 0):
+					conn.execute(Observations.__table__.insert(), rows)
+				return len(rows)
+
+			except IntegrityError as e:
+				print >> sys.stderr, "Error adding bulk observations: '{0}'".format(e)
+				return 0
+
 	#######
 	def count_observations(self):
 		"""Return a count of the observation records."""
@@ -739,6 +899,16 @@ class ndb:
 			# as opposed to there being no observation records
 			raise
 
+	def get_observations_for_services(self, session, services):
+		"""Get all observations for each of a list of services, with one query."""
+		try:
+			return session.query(Services).join(Observations).\
+				filter(Services.name.in_(services)).\
+				values(Services.name, Observations.key, Observations.start, Observations.end)
+		except Exception as e:
+			print >> sys.stderr, "Error getting observations: '%s'" % (e)
+			raise
+
 	def _insert_observation(self, service, key, start_time, end_time):
 		"""Insert a new Observation about a service/key pair."""
 		with self.get_session() as session:
@@ -832,35 +1002,199 @@ class ndb:
 				# if there was a previous key that ended within the time cutoff, update its end time.
 				self._update_observation_end_time(service, most_recent_key, most_recent_time, cur_time - 1)
 
+	#######
+	# Stored signed replies.
+	# report_observation() does not remove a service's stored reply, to keep it fast;
+	# callers that record observations should call delete_signed_responses() for each batch of services.
+
+	def get_signed_response(self, service, key_fingerprint):
+		"""
+		Return the stored signed reply for a service, or None if there is no stored reply.
+		Replies signed by a key other than the one with 'key_fingerprint' are ignored.
+		"""
+		with self._get_connection() as conn:
+			row = conn.execute(select([SignedResponses.xml]).where(\
+				and_(SignedResponses.service_id == Services.service_id,\
+				Services.name == service,\
+				SignedResponses.key_fingerprint == key_fingerprint\
+				))).first()
+			if (row != None):
+				return row[0]
+			return None
+
+	def get_signed_responses(self, services, key_fingerprint):
+		"""
+		Return a dictionary of the stored signed replies for a list of services,
+		signed by the key with 'key_fingerprint'. Services without such a reply are left out.
+		"""
+		with self._get_connection() as conn:
+			rows = conn.execute(select([Services.name, SignedResponses.xml]).where(\
+				and_(SignedResponses.service_id == Services.service_id,\
+				Services.name.in_(services),\
+				SignedResponses.key_fingerprint == key_fingerprint\
+				))).fetchall()
+			return dict((name, xml) for (name, xml) in rows)
+
+	def store_signed_response(self, service, xml, key_fingerprint):
+		"""
+		Save the signed reply for a service, replacing any reply already stored.
+		'key_fingerprint' identifies the key that signed it - see crypto.key_fingerprint().
+		"""
+		try:
+			with self.get_session() as session:
+				srv = session.query(Services).filter(Services.name == service).first()
+				if (srv == None):
+					print >> sys.stderr, "Attempted to store a signed reply for unknown service '%s'." % (service)
+					return
+				session.query(SignedResponses).filter(SignedResponses.service_id == srv.service_id).delete()
+				session.add(SignedResponses(service_id=srv.service_id, created=int(time.time()),
+					key_fingerprint=key_fingerprint, xml=xml))
+				session.commit()
+		except (ProgrammingError, IntegrityError, OperationalError) as e:
+			print >> sys.stderr, "Error storing signed reply for service '%s': '%s'" % (service, e)
+
+	def delete_signed_response(self, service):
+		"""Remove the stored signed reply for a service, if one exists."""
+		self.delete_signed_responses([service])
+
+	def delete_signed_responses(self, services):
+		"""Remove the stored signed replies for a list of services, with one query."""
+		if (len(services) == 0):
+			return
+		try:
+			with self._get_connection() as conn:
+				conn.execute(SignedResponses.__table__.delete().where(\
+					SignedResponses.service_id.in_(select([Services.service_id]).where(Services.name.in_(services)))))
+		except (ProgrammingError, OperationalError) as e:
+			print >> sys.stderr, "Error removing signed replies for %d services: '%s'" % (len(services), e)
+
+	def get_most_requested_services(self, limit, since=0):
+		"""
+		Return the names of up to 'limit' services requested most often since the unix time 'since',
+		most requested first. Requests are counted from the GetObservationsForService and CacheHit metrics,
+		so this only finds anything when metrics are written to the database.
+		"""
+		requests = func.count(Metrics.event_id)
+		with self._get_connection() as conn:
+			rows = conn.execute(select([Metrics.comment, requests]).where(\
+				and_(Metrics.event_type_id == EventTypes.event_type_id,\
+				EventTypes.name.in_(['GetObservationsForService', 'CacheHit']),\
+				Metrics.date >= since\
+				)).group_by(Metrics.comment).order_by(requests.desc()).limit(limit)).fetchall()
+			return [row[0] for row in rows]
+
+	def rollup_metrics(self, now=None):
+		"""
+		Count the metric events of each type in each complete hour that has not been rolled up yet,
+		and store the totals in the MetricsHourly table.
+		Events the MetricsWriter dropped are added to the totals for their type,
+		and the MetricsDropped total is the number of events dropped.
+		The newest hour already rolled up is counted again, in case more of its events were written since.
+		Returns the number of hours stored.
+		"""
+		if (now == None):
+			now = time.time()
+		end = int(now) - (int(now) % 3600)
+
+		with self._get_connection() as conn:
+			# EVENT_TYPES is only filled in when this process reports metrics itself
+			event_types = dict((str(name), event_type_id) for (event_type_id, name) in
+				conn.execute(select([EventTypes.event_type_id, EventTypes.name])))
+			service_types = set(event_types[name] for name in self.SERVICE_EVENT_TYPE_NAMES if name in event_types)
+			dropped_type = event_types.get(MetricsWriter.DROPPED_EVENT_TYPE)
+			start = conn.execute(select([func.max(MetricsHourly.hour)])).first()[0]
+			if (start == None):
+				start = conn.execute(select([func.min(Metrics.date)])).first()[0]
+				if (start == None):
+					return 0
+				start -= start % 3600
+			if (start >= end):
+				return 0
+
+			counts = {} # (hour, event_type_id) -> number of events
+			sketches = {} # (hour, event_type_id) -> HyperLogLog of services
+			# stream the rows rather than reading them all into memory
+			events = conn.execution_options(stream_results=True).execute(
+				select([Metrics.event_type_id, Metrics.date, Metrics.comment]).where(\
+				and_(Metrics.date >= start, Metrics.date < end)))
+			for (event_type_id, date, comment) in events:
+				key = (date - (date % 3600), event_type_id)
+				if (event_type_id == dropped_type):
+					dropped = MetricsWriter.parse_dropped(comment)
+					if (dropped != None and dropped[0] in event_types):
+						# the events themselves were never written, so count them here
+						dropped_key = (key[0], event_types[dropped[0]])
+						counts[dropped_key] = counts.get(dropped_key, 0) + dropped[1]
+						counts[key] = counts.get(key, 0) + dropped[1]
+						continue
+				counts[key] = counts.get(key, 0) + 1
+				if (event_type_id in service_types and comment):
+					if (key not in sketches):
+						sketches[key] = HyperLogLog()
+					sketches[key].add(comment)
+
+			rows = []
+			for ((hour, event_type_id), count) in counts.iteritems():
+				sketch = sketches.get((hour, event_type_id))
+				rows.append({'hour': hour, 'event_type_id': event_type_id, 'count': count,
+					'services_sketch': sketch.to_string() if sketch != None else None})
+
+			with conn.begin():
+				conn.execute(MetricsHourly.__table__.delete().where(\
+					and_(MetricsHourly.hour >= start, MetricsHourly.hour < end)))
+				if (len(rows) > 0):
+					conn.execute(MetricsHourly.__table__.insert(), rows)
+
+		return len(set(hour for (hour, event_type_id) in counts))
+
+	def prune_metrics(self, retention, now=None):
+		"""
+		Delete raw metric events older than 'retention' seconds.
+		Events that have not been rolled up yet are kept. Returns the number of events deleted.
+		"""
+		if (now == None):
+			now = time.time()
+		with self._get_connection() as conn:
+			# rollup_metrics() counts the newest rolled-up hour again, so keep its events too
+			newest = conn.execute(select([func.max(MetricsHourly.hour)])).first()[0]
+			if (newest == None):
+				return 0
+			cutoff = min(int(now) - retention, newest)
+			with conn.begin():
+				return conn.execute(Metrics.__table__.delete().where(Metrics.date < cutoff)).rowcount
+
+	def get_hourly_metrics(self, since, until=None):
+		"""
+		Return the rolled-up metrics for hours starting at or after the unix time 'since' and before 'until',
+		as a list of (hour, event type name, count, HyperLogLog or None) tuples sorted by hour and event type.
+		"""
+		conditions = [MetricsHourly.event_type_id == EventTypes.event_type_id, MetricsHourly.hour >= since]
+		if (until != None):
+			conditions.append(MetricsHourly.hour < until)
+		with self._get_connection() as conn:
+			rows = conn.execute(select([MetricsHourly.hour, EventTypes.name, MetricsHourly.count,
+				MetricsHourly.services_sketch]).where(and_(*conditions)).order_by(MetricsHourly.hour, EventTypes.name)).fetchall()
+		return [(hour, str(name), count, HyperLogLog.from_string(sketch) if sketch else None)
+			for (hour, name, count, sketch) in rows]
+
 	def is_metrics_enabled(self):
 		"""Retun true if the metrics tracking system is currently running, false otherwise."""
 		if (self.metricsdb or self.metricslog):
 			return True
 		return False
 
-	# rate limit metrics so spamming queries doesn't take down the system.
-	# TODO: we could group metrics up to report in one big transaction, or use a background worker
-	@ratelimited(1)
 	def report_metric(self, event_type, comment=""):
-		"""Record a metric event in the database or the log."""
+		"""
+		Record a metric event in the database or the log.
+		Database events are written in the background - see MetricsWriter.
+		"""
 		if self.is_metrics_enabled():
 			if (event_type not in self.EVENT_TYPES):
 				print >> sys.stderr, "Unknown event type '%s'. Please check your call to report_metric()." % event_type
 				self.report_metric('EventTypeUnknown', str(event_type) + "|" + str(comment))
 			else:
 				if (self.metricsdb):
-					# wrap metric write attempts in a try/catch block so errors don't bring down the server
-					try:
-						with self.get_session() as session:
-							metric = Metrics(event_type_id=self.EVENT_TYPES[event_type],\
-								date=int(time.time()), comment=str(comment))
-							session.add(metric)
-							session.commit()
-					except (ProgrammingError, OperationalError, ResourceClosedError, AttributeError) as e:
-						# ResourceClosedError can happen when the database is under heavy load
-						print >> sys.stderr, "Error committing metric: '%s'" % e
-						print >> sys.stderr, "Was trying to log the following metric:"
-						self.__print_metric(event_type, comment)
+					self.metrics_writer.add(self.EVENT_TYPES[event_type], str(comment))
 				else:
 					self.__print_metric(event_type, comment)
 
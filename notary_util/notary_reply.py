@@ -0,0 +1,210 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Build signed notary replies from observation records.
+
+Used by the web server when answering requests
+and by the scanner when storing replies ahead of time.
+"""
+
+import hashlib
+import re
+import sys
+from xml.sax.saxutils import escape
+
+import notary_common
+from util import packing
+
+# saxutils.escape() handles &, < and > - also escape quotes, since we write attributes inside them
+_ATTRIBUTE_ENTITIES = {'"': "&quot;"}
+
+# services to read from the database in one query, when storing many replies
+QUERY_BATCH_SIZE = 500
+
+_SIG_ATTRIBUTE = re.compile('sig="([^"]*)"')
+_END_ATTRIBUTE = re.compile('end="([0-9]+)"')
+
+
+def group_observations(obs):
+	"""
+	Group observation records by key.
+
+	Returns a tuple of (keys, timestamps_by_key):
+	the list of keys in the order they were first seen,
+	and a dictionary of (start, end) pairs for each key.
+	"""
+	timestamps_by_key = {}
+	keys = []
+
+	if (obs != None):
+		for (name, key, start, end) in obs:
+			if key not in timestamps_by_key:
+				timestamps_by_key[key] = []
+				keys.append(key)
+			timestamps_by_key[key].append((start, end))
+
+	return (keys, timestamps_by_key)
+
+def create_reply_xml(service, service_type, keys, timestamps_by_key, signer, compact=False):
+	"""
+	Build and sign an XML notary_reply containing the given keys and their timestamps.
+
+	'signer': a crypto.Signer holding the notary's private key.
+
+	If 'compact' is True no indentation or newlines are added to the reply.
+	"""
+	signed_keys = sort_timespans(keys, timestamps_by_key)
+	packed_data = packing.pack_service(service, signed_keys)
+	sig = signer.sign(packed_data)
+	return serialize_reply(sig, service_type, signed_keys, compact)
+
+def sort_timespans(keys, timestamps_by_key):
+	"""Return a list of (key, timespans) tuples, with each key's timespans sorted by start time."""
+	signed_keys = []
+	for k in keys:
+		timespans = sorted(timestamps_by_key[k], key=lambda t_pair: t_pair[0])
+		signed_keys.append((k, timespans))
+	return signed_keys
+
+def serialize_reply(sig, service_type, signed_keys, compact=False):
+	"""
+	Write a notary_reply document in one pass.
+
+	'signed_keys': a list of (fingerprint, timespans) tuples, as passed to packing.pack_service().
+
+	The default output is the same as xml.dom.minidom's toprettyxml(),
+	which notaries used to build replies; 'compact' output contains no whitespace.
+	"""
+	return "".join(_reply_parts(sig, service_type, signed_keys, compact))
+
+def _reply_parts(sig, service_type, signed_keys, compact):
+	"""Generate the pieces of a notary_reply document, in order."""
+	if (compact):
+		(indent_key, indent_ts, newline) = ("", "", "")
+	else:
+		(indent_key, indent_ts, newline) = ("\t", "\t\t", "\n")
+
+	key_type = _escape(notary_common.SERVICE_TYPES[service_type])
+
+	# attributes are written in sorted order, to match minidom
+	yield '<notary_reply sig="%s" sig_type="rsa-md5" version="1">%s' % (_escape(sig), newline)
+	for (fingerprint, timespans) in signed_keys:
+		yield '%s<key fp="%s" type="%s">%s' % (indent_key, _escape(fingerprint), key_type, newline)
+		for (ts_start, ts_end) in timespans:
+			yield '%s<timestamp end="%d" start="%d"/>%s' % (indent_ts, ts_end, ts_start, newline)
+		yield '%s</key>%s' % (indent_key, newline)
+	yield '</notary_reply>%s' % (newline)
+
+def _escape(value):
+	"""Escape a value for use inside a double-quoted XML attribute."""
+	return escape(value, _ATTRIBUTE_ENTITIES)
+
+def get_validators(xml):
+	"""
+	Return an (etag, last_modified) tuple for a reply, for use with HTTP conditional requests.
+
+	The etag is a hash of the reply's signature, so it changes whenever the signed data does.
+	It is a weak etag because indented and compact replies carry the same signature.
+	last_modified is the newest observation end time in the reply, as a unix timestamp.
+	"""
+	match = _SIG_ATTRIBUTE.search(xml)
+	sig = ""
+	if (match != None):
+		sig = match.group(1)
+	etag = 'W/"%s"' % hashlib.md5(sig).hexdigest()
+
+	last_modified = 0
+	for end in _END_ATTRIBUTE.findall(xml):
+		last_modified = max(last_modified, int(end))
+
+	return (etag, last_modified)
+
+def store_service_reply(db, service, signer, compact=False):
+	"""
+	Build the signed reply for a service from its current observations
+	and save it in the database, so the web server can return it without signing.
+
+	Returns the reply, or None if the service has no observations.
+	"""
+	try:
+		with db.get_session() as session:
+			(keys, timestamps_by_key) = group_observations(db.get_observations(session, service))
+	except Exception as e:
+		# error already logged inside get_observations
+		return None
+
+	if (len(keys) == 0):
+		return None
+
+	try:
+		service_type = service.split(",")[1]
+		xml = create_reply_xml(service, service_type, keys, timestamps_by_key, signer, compact)
+	except (IndexError, KeyError, TypeError, ValueError) as e:
+		print >> sys.stderr, "Error building signed reply for service '%s': '%s'" % (service, e)
+		return None
+
+	db.store_signed_response(service, xml, signer.fingerprint)
+	return xml
+
+def store_service_replies(db, services, signer, compact=False):
+	"""
+	Build, sign, and store replies for many services at once.
+
+	Replies are signed together with signer.sign_batch(), so passing a crypto.SigningPool
+	spreads the signing over all CPU cores.
+	Services with no observations are skipped. Returns the number of replies stored.
+	"""
+	stored = 0
+	for i in range(0, len(services), QUERY_BATCH_SIZE):
+		stored += _store_reply_batch(db, services[i:i + QUERY_BATCH_SIZE], signer, compact)
+	return stored
+
+def _store_reply_batch(db, services, signer, compact):
+	"""Store replies for a list of services small enough to read with one query."""
+	obs_by_service = dict((service, []) for service in services)
+	try:
+		with db.get_session() as session:
+			for ob in db.get_observations_for_services(session, services):
+				obs_by_service[ob[0]].append(ob)
+	except Exception as e:
+		# error already logged inside get_observations_for_services
+		return 0
+
+	to_sign = []
+	for service in services:
+		(keys, timestamps_by_key) = group_observations(obs_by_service[service])
+		if (len(keys) == 0):
+			continue
+		try:
+			service_type = service.split(",")[1]
+			signed_keys = sort_timespans(keys, timestamps_by_key)
+			to_sign.append((service, service_type, signed_keys, packing.pack_service(service, signed_keys)))
+		except (IndexError, KeyError, TypeError, ValueError) as e:
+			print >> sys.stderr, "Error building signed reply for service '%s': '%s'" % (service, e)
+
+	sigs = signer.sign_batch([packed_data for (service, service_type, signed_keys, packed_data) in to_sign])
+
+	stored = 0
+	for ((service, service_type, signed_keys, packed_data), sig) in zip(to_sign, sigs):
+		try:
+			xml = serialize_reply(sig, service_type, signed_keys, compact)
+		except KeyError as e:
+			print >> sys.stderr, "Error building signed reply for service '%s': unknown service type %s" % (service, e)
+			continue
+		db.store_signed_response(service, xml, signer.fingerprint)
+		stored += 1
+	return stored
@@ -0,0 +1,221 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Fill a notary database with synthetic services and observations, for scale testing.
+
+Each service uses a number of keys one after the other, ending now.
+Each key is used for a number of days before it is replaced (rotated),
+and is observed over one or more timespans, separated by gaps when it was not seen.
+
+Distributions are given as one of:
+  5               always 5
+  1-10            any whole number from 1 to 10, all equally likely
+  1:70,2:20,5:10  1 70% of the time, 2 20% of the time, 5 10% of the time (the weights need not add up to 100)
+
+Data can also be written as a file2db.py tuple file instead of to the database.
+Use the same --seed to generate the same data again.
+"""
+
+import argparse
+import random
+import sys
+import time
+
+DAY = 24 * 3600 # seconds
+BATCH_SIZE = 500 # services per bulk insert
+
+DEFAULT_SERVICES = 10000
+DEFAULT_KEYS = '1:70,2:20,3:7,6:3'
+DEFAULT_TIMESPANS = '1:60,2:25,4:10,12:5'
+DEFAULT_ROTATION_DAYS = '90:30,365:50,730:20'
+
+
+class Distribution(object):
+	"""Choose whole numbers, e.g. the number of keys for a service."""
+
+	def __init__(self, spec):
+		"""Parse 'spec' - see the module documentation. Raises ValueError if it is not valid."""
+		self.spec = spec
+		self.values = []
+		self.cumulative = []
+		total = 0
+		try:
+			if (':' in spec):
+				for choice in spec.split(','):
+					(value, weight) = choice.split(':')
+					total += float(weight)
+					self.values.append(int(value))
+					self.cumulative.append(total)
+			elif ('-' in spec):
+				(low, high) = spec.split('-')
+				self.values = range(int(low), int(high) + 1)
+			else:
+				self.values = [int(spec)]
+		except ValueError:
+			raise ValueError("Invalid distribution '%s'." % spec)
+
+		if (len(self.values) == 0 or min(self.values) < 0 or (self.cumulative and total <= 0)):
+			raise ValueError("Invalid distribution '%s'." % spec)
+
+	def sample(self, rng):
+		"""Return a random value, using the random.Random 'rng'."""
+		if (not self.cumulative):
+			return rng.choice(self.values)
+		target = rng.random() * self.cumulative[-1]
+		for (value, cumulative) in zip(self.values, self.cumulative):
+			if (target < cumulative):
+				return value
+		return self.values[-1]
+
+	def __repr__(self):
+		return self.spec
+
+
+def service_names(count, start=0):
+	"""Return names for 'count' synthetic services."""
+	return ["synthetic%d.example.com:443,2" % i for i in xrange(start, start + count)]
+
+
+class SyntheticData(object):
+	"""Generate observations for services, with the given shape."""
+
+	def __init__(self, keys=DEFAULT_KEYS, timespans=DEFAULT_TIMESPANS, rotation_days=DEFAULT_ROTATION_DAYS,
+		seed=None, now=None):
+		"""
+		'keys', 'timespans', and 'rotation_days': Distributions, or strings to parse as Distributions,
+		for the number of keys each service uses, the number of timespans each key is observed over,
+		and the number of days a key is used before it is replaced.
+		"""
+		self.keys = self._distribution(keys)
+		self.timespans = self._distribution(timespans)
+		self.rotation_days = self._distribution(rotation_days)
+		self.rng = random.Random(seed)
+		self.now = int(time.time()) if now == None else now
+
+	def _distribution(self, value):
+		if (isinstance(value, Distribution)):
+			return value
+		return Distribution(value)
+
+	def random_key(self):
+		"""Return a random MD5-style fingerprint, e.g. 'aa:bb:...'."""
+		return ":".join("%02x" % self.rng.randint(0, 255) for i in range(16))
+
+	def observations(self, service):
+		"""Return a list of (service, key, start, end) tuples for one service, oldest key last."""
+		observations = []
+		end = self.now
+		for k in range(self.keys.sample(self.rng)):
+			if (end <= 0):
+				break
+			key = self.random_key()
+			lifetime = max(1, self.rotation_days.sample(self.rng)) * DAY
+			start = max(0, end - lifetime)
+			spans = max(1, self.timespans.sample(self.rng))
+
+			# split the key's lifetime into spans, with a gap of up to a day between each
+			gap = min(DAY, (end - start) // (2 * spans))
+			length = ((end - start) - (spans - 1) * gap) // spans
+			span_end = end
+			for i in range(spans):
+				span_start = start if i == spans - 1 else max(start, span_end - length)
+				observations.append((service, key, span_start, span_end))
+				span_end = span_start - gap
+				if (span_end < start):
+					break
+
+			# the previous key was last seen just before this one was first seen
+			end = start - DAY
+		return observations
+
+	def fill_database(self, db, services, progress=False):
+		"""
+		Add 'services' and generated observations for each of them to the ndb 'db' with bulk inserts.
+		Returns the number of observations added.
+		"""
+		added = 0
+		for i in xrange(0, len(services), BATCH_SIZE):
+			batch = services[i:i + BATCH_SIZE]
+			db.insert_bulk_services(batch)
+			observations = []
+			for service in batch:
+				observations.extend(self.observations(service))
+			added += db.insert_bulk_observations(observations)
+			if (progress and (i // BATCH_SIZE) % 100 == 99):
+				print "Added {0} services and {1} observations...".format(i + len(batch), added)
+		return added
+
+	def write_tuples(self, outfile, services):
+		"""
+		Write 'services' and generated observations for each of them to 'outfile' in the format read by file2db.py.
+		Returns the number of observations written.
+		"""
+		written = 0
+		for service in services:
+			observations = self.observations(service)
+			if (len(observations) == 0):
+				print >> outfile, "(%s, None, None, None)" % service
+			for (service, key, start, end) in observations:
+				print >> outfile, "(%s, %s, %d, %d)" % (service, key, start, end)
+			written += len(observations)
+		return written
+
+
+def distribution(value):
+	"""argparse type for Distributions."""
+	try:
+		return Distribution(value)
+	except ValueError as e:
+		raise argparse.ArgumentTypeError(str(e))
+
+
+if __name__ == '__main__':
+	from notary_db import ndb
+
+	parser = argparse.ArgumentParser(parents=[ndb.get_parser()], description=__doc__,
+		formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--services', type=int, default=DEFAULT_SERVICES,
+		help="Number of services to add. Default: %(default)s.")
+	parser.add_argument('--first-service', type=int, default=0, metavar='N',
+		help="Number the services from N, e.g. to add more services to a database that already has some. Default: %(default)s.")
+	parser.add_argument('--keys-per-service', type=distribution, default=DEFAULT_KEYS, metavar='DISTRIBUTION',
+		help="Number of keys each service has used. 0 adds the service with no observations. Default: %(default)s.")
+	parser.add_argument('--timespans-per-key', type=distribution, default=DEFAULT_TIMESPANS, metavar='DISTRIBUTION',
+		help="Number of separate timespans each key was observed over. Default: %(default)s.")
+	parser.add_argument('--rotation-days', type=distribution, default=DEFAULT_ROTATION_DAYS, metavar='DISTRIBUTION',
+		help="Number of days each key was used before it was replaced. Default: %(default)s.")
+	parser.add_argument('--seed', type=int, default=None,
+		help="Random seed, to generate the same data again.")
+	parser.add_argument('--output-file', type=argparse.FileType('w'), default=None, metavar='FILE',
+		help="Write a file2db.py tuple file instead of adding to the database. Use '-' for stdout.")
+	args = parser.parse_args()
+
+	data = SyntheticData(args.keys_per_service, args.timespans_per_key, args.rotation_days, args.seed)
+	services = service_names(args.services, args.first_service)
+	start = time.time()
+
+	if (args.output_file != None):
+		count = data.write_tuples(args.output_file, services)
+		args.output_file.close()
+		print >> sys.stderr, "Wrote {0} services and {1} observations in {2:.1f} seconds.".format(
+			len(services), count, time.time() - start)
+	else:
+		# pass ndb the args so it can use any relevant ones from its own parser
+		db = ndb(args)
+		count = data.fill_database(db, services, progress=True)
+		print "Added {0} services and {1} observations in {2:.1f} seconds.".format(
+			len(services), count, time.time() - start)
@@ -36,6 +36,9 @@ from notary_db import ndb
 sys.path.insert(0,
 	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 from util.ssl_scan_sock import attempt_observation_for_service, SSLScanTimeoutException, SSLAlertException
+from util.keymanager import keymanager
+from util.crypto import Signer, SigningPool
+import notary_reply
 
 
 DEFAULT_SCANS = 10
@@ -132,8 +135,11 @@ class GlobalStats():
 def record_observations_in_db(res_list): 
 	if len(res_list) == 0: 
 		return
+	written = []
 	try: 
 		for r in res_list: 
+			# a service that fails part way through may still have some of its observations changed
+			written.append(r[0])
 			ndb.report_observation(r[0], r[1])
 	except:
 		# TODO: we should probably retry here 
@@ -141,9 +147,27 @@ def record_observations_in_db(res_list):
 					len(res_list))
 		traceback.print_exc(file=sys.stdout)
 
+	# any reply signed before these observations is now out of date, even if later services failed.
+	# store_signed_replies() replaces them if we are storing replies.
+	try:
+		ndb.delete_signed_responses(written)
+	except Exception:
+		logging.error("Failed to delete the stored replies for %s services" % len(written))
+		traceback.print_exc(file=sys.stdout)
+
+def store_signed_replies(res_list):
+	"""Sign and store a new reply for each service whose observations were just recorded."""
+	if (signer == None or len(res_list) == 0):
+		return
+	try:
+		notary_reply.store_service_replies(ndb, [r[0] for r in res_list], signer, args.compact_replies)
+	except Exception:
+		logging.error("Failed to store signed replies for %s services" % len(res_list))
+		traceback.print_exc(file=sys.stdout)
 
 
-parser = argparse.ArgumentParser(parents=[ndb.get_parser()],
+
+parser = argparse.ArgumentParser(parents=[ndb.get_parser(), keymanager.get_parser()],
 description=__doc__)
 
 parser.add_argument('service_id_file', type=argparse.FileType('r'), nargs='?', default=DEFAULT_INFILE,
@@ -155,6 +179,16 @@ parser.add_argument('--timeout', '--wait', '-w', nargs='?', default=DEFAULT_WAIT
 parser.add_argument('--sni', action='store_true', default=False,
 			help="use Server Name Indication. See section 3.1 of http://www.ietf.org/rfc/rfc4366.txt.\
 			Default: \'%(default)s\'")
+parser.add_argument('--store-responses', action='store_true', default=False,
+			help="After recording observations, sign and store a reply for each service that was scanned,\
+			so a notary running with --stored-responses can return it without signing on each request.\
+			Use the same private key as the notary server; the scanner will not start if the key files do not exist.\
+			Default: \'%(default)s\'")
+parser.add_argument('--signing-processes', default=1, type=int, metavar='N',
+			help="With --store-responses: sign replies in N worker processes, to use more than one CPU core.\
+			Default: %(default)s")
+parser.add_argument('--compact-replies', action='store_true', default=False,
+			help="Store signed replies without any indentation or newlines. Default: \'%(default)s\'")
 loggroup = parser.add_mutually_exclusive_group()
 loggroup.add_argument('--verbose', '-v', default=False, action='store_true',
 			help="Verbose mode. Print more info about each scan.")
@@ -173,6 +207,22 @@ elif (args.quiet):
 	loglevel = logging.CRITICAL
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=loglevel)
 
+signer = None
+if (args.store_responses):
+	# never create new keys here: replies signed with a key the notary does not publish would fail to verify
+	(public_key, private_key) = keymanager(args).get_keys(create=False)
+	if (private_key == None):
+		logging.critical("Could not read the notary's public and private keys - cannot store signed replies.")
+		exit(1)
+	try:
+		if (args.signing_processes > 1):
+			signer = SigningPool(private_key, args.signing_processes)
+		else:
+			signer = Signer(private_key)
+	except Exception as e:
+		logging.critical("Could not load private key - cannot store signed replies: %s" % e)
+		exit(1)
+
 res_list = [] 
 stats = GlobalStats()
 rate = args.scans
@@ -203,6 +253,7 @@ for sid in all_sids:
 		if (stats.num_started % rate) == 0: 
 			time.sleep(1)
 			record_observations_in_db(res_list) 
+			store_signed_replies(res_list)
 			res_list = [] 
 			so_far = int(time.time() - start_time)
 			logging.info("%s seconds passed.  %s complete, %s " \
@@ -249,6 +300,9 @@ while stats.active_threads > 0:
 # record any observations made since we finished the
 # main for-loop			
 record_observations_in_db(res_list)
+store_signed_replies(res_list)
+if (isinstance(signer, SigningPool)):
+	signer.close()
 
 duration = int(time.time() - start_time)
 localtime = time.asctime( time.localtime(start_time) )
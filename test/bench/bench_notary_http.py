@@ -0,0 +1,406 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load test notary_http.py on this machine.
+
+Starts a notary for each cache backend in turn, replays a stream of requests
+against it, and reports throughput, latency percentiles, and the cache hit ratio.
+
+Requests are drawn uniformly or with a Zipfian distribution from the services
+in the database, or replayed from a trace file with one 'host:port,type' service per line.
+Everything runs on localhost: memcache and redis are tested by starting local memcached and
+redis-server processes, and only services with observations are requested so the notary never scans.
+
+By default a temporary SQLite database is created and filled with synthetic services
+by notary_util/synthetic_db.py.
+Use the database arguments to benchmark against another database, e.g. a Postgres copy of a real notary;
+a database that already has services is used as it is.
+
+Run it from the repository root: python -m test.bench.bench_notary_http
+"""
+
+import argparse
+import httplib
+import os
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+from bisect import bisect_left
+
+from M2Crypto import RSA
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from notary_util.notary_db import ndb
+from notary_util.synthetic_db import SyntheticData, service_names
+from util import keygen
+
+BACKENDS = ['none', 'pycache', 'memcache', 'redis']
+DEFAULT_BACKENDS = 'none,pycache,memcache,redis'
+START_TIMEOUT = 60 # seconds
+
+
+class Unavailable(Exception):
+	"""A cache backend can't be tested on this machine."""
+	pass
+
+
+def free_port():
+	"""Return a TCP port on localhost that nothing is listening on."""
+	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	try:
+		s.bind(('127.0.0.1', 0))
+		return s.getsockname()[1]
+	finally:
+		s.close()
+
+def wait_for_port(port, process, timeout=START_TIMEOUT):
+	"""Wait until something accepts connections on 'port', or raise an exception if 'process' exits first."""
+	deadline = time.time() + timeout
+	while (time.time() < deadline):
+		if (process.poll() != None):
+			raise Unavailable("exited with code %d" % process.returncode)
+		try:
+			socket.create_connection(('127.0.0.1', port), 1).close()
+			return
+		except socket.error:
+			time.sleep(0.1)
+	raise Unavailable("did not start listening on port %d within %d seconds" % (port, timeout))
+
+def stop(process):
+	"""Stop a child process, killing it if it doesn't exit promptly."""
+	if (process.poll() != None):
+		return
+	process.terminate()
+	deadline = time.time() + 10
+	while (process.poll() == None and time.time() < deadline):
+		time.sleep(0.1)
+	if (process.poll() == None):
+		process.kill()
+		process.wait()
+
+
+def write_keys(private_key_file):
+	"""Create a key pair for the notary, named the way keymanager expects."""
+	rsa = RSA.gen_key(keygen.NEW_KEY_LENGTH, 65537, lambda *args: None)
+	rsa.save_key(private_key_file, cipher=None)
+	rsa.save_pub_key(private_key_file[:-len('.priv')] + '.pub')
+
+def read_trace(trace_file):
+	"""Return the list of services in a trace file, in order."""
+	services = []
+	for line in trace_file:
+		line = line.strip()
+		if (line and not line.startswith('#')):
+			services.append(line)
+	trace_file.close()
+	return services
+
+def zipf_stream(services, count, s, rng):
+	"""Return 'count' services, where the service of rank k is requested in proportion to 1/k^s."""
+	cumulative = []
+	total = 0.0
+	for rank in range(1, len(services) + 1):
+		total += 1.0 / (rank ** s)
+		cumulative.append(total)
+	return [services[bisect_left(cumulative, rng.random() * total)] for i in xrange(count)]
+
+def request_stream(args, services, rng):
+	"""Return the list of services to request, in order."""
+	if (args.distribution == 'uniform'):
+		return [rng.choice(services) for i in xrange(args.requests)]
+	# shuffle so the most popular services aren't simply the first ones inserted
+	ranked = list(services)
+	rng.shuffle(ranked)
+	return zipf_stream(ranked, args.requests, args.zipf_exponent, rng)
+
+def percentile(ordered, p):
+	"""Return the p'th percentile of a sorted list, by the nearest-rank method."""
+	if (len(ordered) == 0):
+		return 0.0
+	return ordered[max(0, int(round(p / 100.0 * len(ordered))) - 1)]
+
+
+class LoadGenerator(object):
+	"""Send a list of requests to a notary from several threads, each with its own keep-alive connection."""
+
+	def __init__(self, port, concurrency):
+		self.port = port
+		self.concurrency = concurrency
+
+	def run(self, stream):
+		"""
+		Request each service in 'stream' once.
+		Returns (elapsed seconds, sorted list of latencies in seconds, {status: count}).
+		"""
+		latencies = []
+		statuses = {}
+		lock = threading.Lock()
+
+		def worker(services):
+			my_latencies = []
+			my_statuses = {}
+			conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=30)
+			for service in services:
+				(host_port, service_type) = service.rsplit(',', 1)
+				(host, port) = host_port.rsplit(':', 1)
+				path = '/?' + urllib.urlencode({'host': host, 'port': port, 'service_type': service_type})
+				start = time.time()
+				try:
+					conn.request('GET', path)
+					response = conn.getresponse()
+					response.read()
+					status = response.status
+				except (httplib.HTTPException, socket.error):
+					conn.close()
+					conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=30)
+					status = 'error'
+				my_latencies.append(time.time() - start)
+				my_statuses[status] = my_statuses.get(status, 0) + 1
+			conn.close()
+			with lock:
+				latencies.extend(my_latencies)
+				for (status, count) in my_statuses.items():
+					statuses[status] = statuses.get(status, 0) + count
+
+		threads = [threading.Thread(target=worker, args=(stream[i::self.concurrency],))
+			for i in range(self.concurrency)]
+		start = time.time()
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		elapsed = time.time() - start
+		return (elapsed, sorted(latencies), statuses)
+
+
+class Benchmark(object):
+	"""Start notaries with each cache backend and measure them."""
+
+	def __init__(self, args, workdir):
+		self.args = args
+		self.workdir = workdir
+		self.private_key = os.path.join(workdir, 'notary.priv')
+		write_keys(self.private_key)
+
+	def db_args(self):
+		"""Return the command-line arguments that point a notary at our database."""
+		return ['--dbtype', self.args.dbtype, '--dbname', self.args.dbname,
+			'--dbhost', self.args.dbhost, '--dbuser', self.args.dbuser]
+
+	def start_standin(self, backend):
+		"""
+		Start a local server for a memcache or redis backend.
+		Returns (process or None, environment variables for the notary).
+		"""
+		if (backend in ['none', 'pycache']):
+			return (None, {})
+
+		(module, program) = {'memcache': ('pylibmc', 'memcached'), 'redis': ('redis', 'redis-server')}[backend]
+		try:
+			__import__(module)
+		except ImportError:
+			raise Unavailable("the python module '%s' is not installed" % module)
+
+		port = free_port()
+		if (backend == 'memcache'):
+			command = [program, '-l', '127.0.0.1', '-p', str(port), '-U', '0']
+			env = {'MEMCACHE_SERVERS': '127.0.0.1:%d' % port}
+		else:
+			command = [program, '--bind', '127.0.0.1', '--port', str(port), '--save', '', '--appendonly', 'no']
+			env = {'REDISTOGO_URL': 'redis://127.0.0.1:%d' % port}
+		try:
+			process = subprocess.Popen(command, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+		except OSError:
+			raise Unavailable("'%s' is not installed" % program)
+		try:
+			wait_for_port(port, process)
+		except Unavailable as e:
+			stop(process)
+			raise Unavailable("%s %s" % (program, e))
+		return (process, env)
+
+	def start_notary(self, backend, port, env):
+		"""Start a notary using 'backend' as its cache, and wait until it is answering requests."""
+		command = [sys.executable, os.path.join(ROOT, 'notary_http.py'), '--webport', str(port),
+			'--private-key', self.private_key, '--metrics-endpoint'] + self.db_args()
+		if (backend == 'pycache'):
+			command += ['--pycache', self.args.pycache_size]
+		elif (backend != 'none'):
+			command.append('--' + backend)
+		command += shlex.split(self.args.notary_args)
+
+		log_name = os.path.join(self.workdir, 'notary_%s.log' % backend)
+		notary_env = dict(os.environ)
+		notary_env.update(env)
+		process = subprocess.Popen(command, cwd=ROOT, env=notary_env,
+			stdout=open(log_name, 'w'), stderr=subprocess.STDOUT)
+		try:
+			wait_for_port(port, process)
+		except Unavailable as e:
+			stop(process)
+			with open(log_name) as log:
+				raise Unavailable("the notary %s:\n%s" % (e, log.read()[-2000:]))
+		return process
+
+	def read_cache_counts(self, port):
+		"""Return the notary's (cache hits, cache misses) from /metrics."""
+		conn = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+		try:
+			conn.request('GET', '/metrics')
+			text = conn.getresponse().read()
+		finally:
+			conn.close()
+		counts = {}
+		for line in text.splitlines():
+			if (line.startswith('notary_cache_')):
+				(name, value) = line.split()
+				counts[name] = float(value)
+		return (counts.get('notary_cache_hits_total', 0), counts.get('notary_cache_misses_total', 0))
+
+	def run_backend(self, backend, warmup, stream):
+		"""Measure one backend. Returns a dictionary of results."""
+		(standin, env) = self.start_standin(backend)
+		notary = None
+		try:
+			port = free_port()
+			notary = self.start_notary(backend, port, env)
+			load = LoadGenerator(port, self.args.concurrency)
+			if (len(warmup) > 0):
+				load.run(warmup)
+
+			(hits_before, misses_before) = self.read_cache_counts(port)
+			(elapsed, latencies, statuses) = load.run(stream)
+			(hits, misses) = self.read_cache_counts(port)
+		finally:
+			if (notary != None):
+				stop(notary)
+			if (standin != None):
+				stop(standin)
+
+		hits -= hits_before
+		lookups = hits + misses - misses_before
+		return {'requests': len(latencies),
+			'throughput': len(latencies) / elapsed,
+			'p50': percentile(latencies, 50),
+			'p95': percentile(latencies, 95),
+			'p99': percentile(latencies, 99),
+			'hit_ratio': hits / lookups if lookups > 0 else 0.0,
+			'errors': sum(count for (status, count) in statuses.items() if status not in [200, 304])}
+
+	def run(self, backends, warmup, stream):
+		print "%-10s %9s %9s %9s %9s %9s %7s %7s" % \
+			("backend", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "hit %", "errors")
+		for backend in backends:
+			try:
+				r = self.run_backend(backend, warmup, stream)
+			except Unavailable as e:
+				print "%-10s skipped: %s" % (backend, e)
+				continue
+			print "%-10s %9d %9.1f %9.2f %9.2f %9.2f %7.1f %7d" % (backend, r['requests'], r['throughput'],
+				r['p50'] * 1000, r['p95'] * 1000, r['p99'] * 1000, r['hit_ratio'] * 100, r['errors'])
+			sys.stdout.flush()
+
+
+def prepare_database(args, workdir, traced):
+	"""
+	Set up the database to benchmark against, seeding it if it is empty.
+	Returns the services that have observations.
+	"""
+	if (args.dbtype == 'sqlite' and args.dbname == ndb.SUPPORTED_DBS['sqlite']['defaultdbname']):
+		args.dbname = os.path.join(workdir, 'bench.sqlite')
+
+	db = ndb(args)
+	if (db.count_services() == 0):
+		# every service in the trace gets data too, so none of them are scanned
+		services = sorted(set(service_names(args.services) + traced))
+		print "Adding %d services to the database..." % len(services)
+		SyntheticData(seed=args.seed).fill_database(db, services)
+		return services
+
+	known = sorted(set(row[0] for row in db.get_newest_service_names(0)))
+	if (traced):
+		return known
+	return known[:args.services]
+
+
+parser = argparse.ArgumentParser(parents=[ndb.get_parser()], description=__doc__,
+	formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--backends', default=DEFAULT_BACKENDS,
+	help="Comma-separated cache backends to test, from {%s}. Backends that can't run here are skipped. Default: %%(default)s." \
+	% ", ".join(BACKENDS))
+parser.add_argument('--distribution', choices=['uniform', 'zipf'], default='zipf',
+	help="How to choose which service each request is for. Ignored with --trace. Default: %(default)s.")
+parser.add_argument('--zipf-exponent', type=float, default=1.0, metavar='S',
+	help="With --distribution zipf: the service of rank k is requested in proportion to 1/k^S. Default: %(default)s.")
+parser.add_argument('--trace', type=argparse.FileType('r'), default=None, metavar='FILE',
+	help="Replay the services in FILE, one 'host:port,type' per line, instead of choosing them at random.")
+parser.add_argument('--requests', type=int, default=5000,
+	help="Requests to measure. Ignored with --trace. Default: %(default)s.")
+parser.add_argument('--warmup', type=int, default=0, metavar='N',
+	help="Send N requests before measuring, e.g. to fill the cache. Default: %(default)s.")
+parser.add_argument('--concurrency', '-c', type=int, default=4,
+	help="Requests sent at once, each on its own keep-alive connection. Default: %(default)s.")
+parser.add_argument('--services', type=int, default=1000,
+	help="Services to add to an empty database, or to request from an existing one. Default: %(default)s.")
+parser.add_argument('--pycache-size', default='50M',
+	help="Cache size for the pycache backend. Default: %(default)s.")
+parser.add_argument('--notary-args', default='',
+	help="Extra arguments for notary_http.py. Use an equals sign, e.g. --notary-args=\"--async --compressed-replies\".")
+parser.add_argument('--seed', type=int, default=1,
+	help="Random seed, so runs can be compared. Default: %(default)s.")
+
+def main(args):
+	backends = [b.strip() for b in args.backends.split(',') if b.strip()]
+	for backend in backends:
+		if (backend not in BACKENDS):
+			parser.error("Unknown backend '%s'." % backend)
+
+	workdir = tempfile.mkdtemp(prefix='bench_notary_')
+	try:
+		traced = read_trace(args.trace) if args.trace != None else []
+		services = prepare_database(args, workdir, traced)
+
+		rng = random.Random(args.seed)
+		if (args.trace != None):
+			# only request services that have data, so the notary doesn't scan the internet
+			known = set(services)
+			stream = [service for service in traced if service in known]
+			if (len(stream) < len(traced)):
+				print >> sys.stderr, "WARNING: %d requests in the trace are for services with no observations " \
+					"and will not be sent." % (len(traced) - len(stream))
+		else:
+			stream = request_stream(args, services, rng)
+		if (len(stream) == 0):
+			print >> sys.stderr, "ERROR: no services to request."
+			return 1
+		warmup = [rng.choice(stream) for i in xrange(args.warmup)]
+
+		print "%d requests for %d services, %d at a time.\n" % (len(stream), len(set(stream)), args.concurrency)
+		Benchmark(args, workdir).run(backends, warmup, stream)
+	finally:
+		shutil.rmtree(workdir, ignore_errors=True)
+	return 0
+
+if __name__ == '__main__':
+	exit(main(parser.parse_args()))
@@ -0,0 +1,95 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare the speed of util/packing.py with the byte-by-byte packing loop it replaced.
+
+Run it from the repository root: python -m test.bench.bench_packing
+"""
+
+import argparse
+import struct
+import sys
+import timeit
+
+from util import packing
+
+SERVICE = 'benchmark.example.com:443,2'
+
+
+def legacy_pack_service(service, keys):
+	"""The packing loop used before util/packing.py, kept here for comparison."""
+	packed_data = ""
+	for (fingerprint, timespans) in keys:
+		num_timespans = len(timespans)
+		head = struct.pack("BBBBB", (num_timespans >> 8) & 255, num_timespans & 255, 0, 16,3)
+		fp_bytes = ""
+		for hex_byte in fingerprint.split(":"):
+			fp_bytes += struct.pack("B", int(hex_byte,16))
+		ts_bytes = ""
+		for (ts_start, ts_end) in timespans:
+			ts_bytes += struct.pack("BBBB", ts_start >> 24 & 255,
+										   ts_start >> 16 & 255,
+										   ts_start >> 8 & 255,
+										   ts_start & 255)
+			ts_bytes += struct.pack("BBBB", ts_end >> 24 & 255,
+										   ts_end >> 16 & 255,
+										   ts_end >> 8 & 255,
+										   ts_end & 255)
+		packed_data = (head + fp_bytes + ts_bytes) + packed_data
+	return service.encode() + struct.pack("B", 0) + packed_data
+
+def make_keys(num_keys, timespans_per_key):
+	"""Create fake observation data with the given shape."""
+	keys = []
+	start = 1300000000
+	for k in range(num_keys):
+		fingerprint = ":".join("%02x" % ((k + b) % 256) for b in range(16))
+		timespans = []
+		for t in range(timespans_per_key):
+			timespans.append((start, start + 3600))
+			start += 7200
+		keys.append((fingerprint, timespans))
+	return keys
+
+def time_function(func, keys, repeat):
+	"""Return the best time in seconds for one call of func."""
+	timer = timeit.Timer(lambda: func(SERVICE, keys))
+	return min(timer.repeat(repeat=repeat, number=10)) / 10
+
+def run(shapes, repeat):
+	print "%6s %10s %14s %14s %8s" % ("keys", "timespans", "legacy (ms)", "packing (ms)", "speedup")
+	for (num_keys, timespans_per_key) in shapes:
+		keys = make_keys(num_keys, timespans_per_key)
+		if (legacy_pack_service(SERVICE, keys) != packing.pack_service(SERVICE, keys)):
+			print >> sys.stderr, "ERROR: packed data differs for %s keys with %s timespans each" % \
+				(num_keys, timespans_per_key)
+			return 1
+		legacy = time_function(legacy_pack_service, keys, repeat)
+		new = time_function(packing.pack_service, keys, repeat)
+		print "%6s %10s %14.3f %14.3f %7.1fx" % (num_keys, timespans_per_key,
+			legacy * 1000, new * 1000, legacy / new)
+	return 0
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--repeat', '-r', default=5, type=int,
+	help="Number of timing runs; the best run is reported. Default: %(default)s.")
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+	shapes = [(1, 1), (1, 100), (1, 500), (5, 100), (20, 50), (100, 10)]
+	exit(run(shapes, args.repeat))
@@ -0,0 +1,171 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare util/pycache.py's linked list with the lazy-deletion heap it replaced.
+
+For each workload prints the time per get or set and how many records
+each implementation holds to track the 'least recently used' order afterwards.
+The heap adds a record on every get, so on read-mostly workloads it grows without bound.
+
+Run it from the repository root: python -m test.bench.bench_pycache
+"""
+
+import argparse
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from util import pycache
+
+VALUE = "x" * 500
+EXPIRY = 3600 # seconds
+
+
+class LegacyHeapCache(object):
+	"""The cache and lazy-deletion heap used before pycache used a linked list, kept here for comparison."""
+
+	def __init__(self, max_mem):
+		self.cache = {}
+		self.heap = []
+		self.current_entries = {}
+		self.counter = itertools.count()
+		self.current_mem = 0
+		self.max_mem = max_mem
+		self.mem_lock = threading.RLock()
+
+	def push(self, entry):
+		entry_id = next(self.counter)
+		self.current_entries[entry.key] = entry_id
+		heapq.heappush(self.heap, [entry.last_requested, entry_id, entry.key])
+
+	def pop(self):
+		while self.heap:
+			(last_requested, entry_id, key) = heapq.heappop(self.heap)
+			if (key in self.current_entries and self.current_entries[key] == entry_id):
+				del self.current_entries[key]
+				return key
+		raise IndexError("Heap has no entries to pop")
+
+	def set(self, key, data, expiry):
+		entry = pycache.CacheEntry(key, data, expiry)
+		entry.last_requested = int(time.time())
+		with self.mem_lock:
+			if key in self.cache:
+				self.current_mem -= self.cache[key].memory_used
+			while self.heap and (self.current_mem + entry.memory_used > self.max_mem):
+				old_key = self.pop()
+				self.current_mem -= self.cache[old_key].memory_used
+				del self.cache[old_key]
+			self.push(entry)
+			self.cache[key] = entry
+			self.current_mem += entry.memory_used
+
+	def get(self, key):
+		if key not in self.cache:
+			return None
+		entry = self.cache[key]
+		if (entry.has_expired()):
+			if key in self.current_entries:
+				del self.current_entries[key]
+			with self.mem_lock:
+				self.current_mem -= entry.memory_used
+				del self.cache[key]
+			return None
+		entry.last_requested = int(time.time())
+		self.push(entry) # the old heap record is left behind, to be discarded when it is popped
+		return entry.data
+
+	def order_records(self):
+		return len(self.heap)
+
+
+class LruCache(object):
+	"""util/pycache.py, with the same interface as LegacyHeapCache."""
+
+	def __init__(self, max_mem):
+		pycache.clear()
+		pycache.set_cache_size(max_mem)
+
+	def set(self, key, data, expiry):
+		pycache.set(key, data, expiry)
+
+	def get(self, key):
+		return pycache.get(key)
+
+	def order_records(self):
+		records = 0
+		entry = pycache.lru.oldest()
+		while (entry != None and entry is not pycache.lru):
+			records += 1
+			entry = entry.next
+		return records
+
+
+def make_plan(operations, keys, hot_keys, set_fraction, seed):
+	"""Return a list of (is_set, key) operations, where 90% of gets are for the first 'hot_keys' keys."""
+	rng = random.Random(seed)
+	plan = []
+	for i in xrange(operations):
+		if (rng.random() < set_fraction):
+			plan.append((True, rng.choice(keys)))
+		elif (rng.random() < 0.9):
+			plan.append((False, keys[rng.randrange(hot_keys)]))
+		else:
+			plan.append((False, rng.choice(keys)))
+	return plan
+
+def run(implementation, keys, capacity, plan):
+	"""Fill a cache and run 'plan' against it. Returns (seconds per operation, LRU records held afterwards)."""
+	entry_size = pycache.CacheEntry(keys[0], VALUE, EXPIRY).memory_used
+	cache = implementation(entry_size * capacity)
+	for key in keys[:capacity]:
+		cache.set(key, VALUE, EXPIRY)
+
+	start = time.time()
+	for (is_set, key) in plan:
+		if (is_set or cache.get(key) == None):
+			cache.set(key, VALUE, EXPIRY)
+	elapsed = time.time() - start
+	return (elapsed / len(plan), cache.order_records())
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--operations', '-n', default=200000, type=int,
+	help="Gets and sets per workload. Default: %(default)s.")
+parser.add_argument('--keys', default=10000, type=int,
+	help="Number of different keys. Default: %(default)s.")
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+	keys = ["service%d.example.com:443,2" % i for i in range(args.keys)]
+
+	workloads = [
+		# (name, cache capacity in entries, fraction of sets)
+		("read-mostly, all keys fit", args.keys, 0.01),
+		("read-mostly, half the keys fit", args.keys / 2, 0.01),
+		("write-heavy, half the keys fit", args.keys / 2, 0.5),
+	]
+
+	print "%-32s %-14s %10s %12s %10s" % ("workload", "cache", "us/op", "LRU records", "capacity")
+	for (name, capacity, set_fraction) in workloads:
+		plan = make_plan(args.operations, keys, max(1, args.keys / 10), set_fraction, 1)
+		for (label, implementation) in [("heap (before)", LegacyHeapCache), ("linked list", LruCache)]:
+			(seconds, records) = run(implementation, keys, capacity, plan)
+			print "%-32s %-14s %10.2f %12d %10d" % (name, label, seconds * 1e6, records, capacity)
+	pycache.clear()
@@ -0,0 +1,89 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare signatures per second when the private key is parsed for every signature
+(crypto.sign_content), when it is parsed once (crypto.Signer),
+and when batches are signed by several processes (crypto.SigningPool).
+
+Run it from the repository root: python -m test.bench.bench_signing
+"""
+
+import argparse
+import multiprocessing
+import sys
+import timeit
+
+from M2Crypto import BIO, RSA
+
+from util import crypto, keygen, packing
+
+SERVICE = 'benchmark.example.com:443,2'
+FINGERPRINT = ":".join("%02x" % b for b in range(16))
+
+
+def generate_key():
+	"""Create a private key of the size new notaries use, without writing it to disk."""
+	rsa = RSA.gen_key(keygen.NEW_KEY_LENGTH, 65537, lambda *args: None)
+	bio = BIO.MemoryBuffer()
+	rsa.save_key_bio(bio, cipher=None)
+	return bio.read()
+
+def signatures_per_second(func, number, repeat, per_call=1):
+	"""Return the best rate for calling func() 'number' times, when each call makes 'per_call' signatures."""
+	timer = timeit.Timer(func)
+	return number * per_call / min(timer.repeat(repeat=repeat, number=number))
+
+def run(private_key, number, repeat, processes):
+	content = packing.pack_service(SERVICE, [(FINGERPRINT, [(1300000000, 1300003600)])])
+	signer = crypto.Signer(private_key)
+	if (signer.sign(content) != crypto.sign_content(content, private_key)):
+		print >> sys.stderr, "ERROR: signatures differ"
+		return 1
+
+	before = signatures_per_second(lambda: crypto.sign_content(content, private_key), number, repeat)
+	after = signatures_per_second(lambda: signer.sign(content), number, repeat)
+	pool = crypto.SigningPool(private_key, processes)
+	try:
+		batch = [content] * number
+		pooled = signatures_per_second(lambda: pool.sign_batch(batch), 1, repeat, number)
+	finally:
+		pool.close()
+
+	print "%24s %12s %8s" % ("", "signatures/s", "speedup")
+	print "%24s %12.0f %8s" % ("sign_content (parse key)", before, "")
+	print "%24s %12.0f %7.2fx" % ("Signer (key loaded once)", after, after / before)
+	print "%24s %12.0f %7.2fx" % ("SigningPool (%d procs)" % processes, pooled, pooled / before)
+	return 0
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--key', '-k', type=argparse.FileType('r'), default=None,
+	help="PEM private key file to sign with. Default: generate a %d-bit key." % keygen.NEW_KEY_LENGTH)
+parser.add_argument('--number', '-n', default=200, type=int,
+	help="Signatures per timing run. Default: %(default)s.")
+parser.add_argument('--processes', '-p', default=multiprocessing.cpu_count(), type=int,
+	help="Worker processes for SigningPool. Default: the number of CPUs (%(default)s).")
+parser.add_argument('--repeat', '-r', default=5, type=int,
+	help="Number of timing runs; the best run is reported. Default: %(default)s.")
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+	if (args.key != None):
+		private_key = args.key.read()
+	else:
+		private_key = generate_key()
+	exit(run(private_key, args.number, args.repeat, args.processes))
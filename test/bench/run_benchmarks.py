@@ -0,0 +1,313 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Time the functions on the notary's hot paths, and compare the results with a saved baseline.
+
+Each benchmark reports the best time per operation over several runs.
+Save a baseline before making a change, then compare against it afterwards:
+
+  python -m test.bench.run_benchmarks --save before.json
+  (make the change)
+  python -m test.bench.run_benchmarks --compare before.json
+
+Run it from the repository root, so the notary's modules can be imported.
+
+Compare mode exits with status 1 if any benchmark is slower than the baseline by more than --tolerance.
+Baselines are only meaningful on the machine and Python version that made them.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+from M2Crypto import RSA
+
+from client import client_common
+from notary_util.notary_db import ndb
+from notary_util import notary_reply
+from notary_util.synthetic_db import SyntheticData, service_names
+from util import crypto, keygen, packing, pycache, ssl_scan_sock
+
+SERVICE = 'benchmark.example.com:443,2'
+SERVICE_TYPE = '2'
+DEFAULT_TOLERANCE = 0.1 # fraction of the baseline time
+
+# the shape of the reply built by the calculate_service_xml benchmark
+REPLY_KEYS = '3'
+REPLY_TIMESPANS = '4'
+
+REPORT_SERVICES = 20000
+
+PYCACHE_KEYS = 2000
+PYCACHE_ENTRY_SIZE = 500 # bytes
+PYCACHE_SIZE = PYCACHE_KEYS * PYCACHE_ENTRY_SIZE / 2 # so sets must evict old entries
+PYCACHE_OPS_PER_THREAD = 5000
+PYCACHE_SET_FRACTION = 0.1
+
+
+class Benchmarks(object):
+	"""
+	Set up the data each benchmark needs.
+
+	Each bench_ method returns (func, ops): calling func() performs 'ops' operations.
+	"""
+
+	def __init__(self, args):
+		self.args = args
+		self.workdir = tempfile.mkdtemp(prefix='notary_bench_')
+		self.private_key_file = os.path.join(self.workdir, 'notary.priv')
+		rsa = RSA.gen_key(keygen.NEW_KEY_LENGTH, 65537, lambda *args: None)
+		rsa.save_key(self.private_key_file, cipher=None)
+		rsa.save_pub_key(os.path.join(self.workdir, 'notary.pub'))
+		with open(self.private_key_file) as f:
+			self.private_key = f.read()
+		with open(os.path.join(self.workdir, 'notary.pub')) as f:
+			self.public_key = f.read()
+		self.db_file = os.path.join(self.workdir, 'bench.sqlite')
+		self.data = SyntheticData(REPLY_KEYS, REPLY_TIMESPANS, seed=1)
+
+	def close(self):
+		shutil.rmtree(self.workdir, ignore_errors=True)
+
+	def get_names(self):
+		return sorted(name[len('bench_'):].replace('__', '.') for name in dir(self) if name.startswith('bench_'))
+
+	def setup(self, name):
+		return getattr(self, 'bench_' + name.replace('.', '__'))()
+
+	def reply_xml(self):
+		"""Return a signed reply for SERVICE."""
+		obs = self.data.observations(SERVICE)
+		(keys, timestamps_by_key) = notary_reply.group_observations(obs)
+		return notary_reply.create_reply_xml(SERVICE, SERVICE_TYPE, keys, timestamps_by_key,
+			crypto.Signer(self.private_key))
+
+	def bench_notary__calculate_service_xml(self):
+		# import here so the other benchmarks don't need cherrypy
+		import notary_http
+
+		# build a notary that reads a database with one service, without caching replies
+		notary = notary_http.NotaryHTTPServer(['--dbname', self.db_file, '--private-key', self.private_key_file])
+
+		self.data.fill_database(notary.ndb, [SERVICE])
+		return (lambda: notary.calculate_service_xml(SERVICE, SERVICE_TYPE), 1)
+
+	def bench_crypto__sign_content(self):
+		content = packing.pack_service(SERVICE, [("aa:" * 15 + "aa", [(1300000000, 1300003600)])])
+		return (lambda: crypto.sign_content(content, self.private_key), 1)
+
+	def bench_pycache__get_set_1_thread(self):
+		return self.pycache_contention(1)
+
+	def bench_pycache__get_set_contended(self):
+		return self.pycache_contention(self.args.threads)
+
+	def pycache_contention(self, threads):
+		"""Mostly get and occasionally set a set of keys from several threads at once."""
+		rng = random.Random(1)
+		keys = service_names(PYCACHE_KEYS)
+		value = "x" * PYCACHE_ENTRY_SIZE
+		plans = [[(rng.random() < PYCACHE_SET_FRACTION, rng.choice(keys)) for i in xrange(PYCACHE_OPS_PER_THREAD)]
+			for t in range(threads)]
+
+		pycache.clear()
+		pycache.set_cache_size(PYCACHE_SIZE)
+		for key in keys:
+			pycache.set(key, value, 3600)
+
+		def worker(plan):
+			for (is_set, key) in plan:
+				if (is_set or pycache.get(key) == None):
+					pycache.set(key, value, 3600)
+
+		def run():
+			workers = [threading.Thread(target=worker, args=(plan,)) for plan in plans]
+			for w in workers:
+				w.start()
+			for w in workers:
+				w.join()
+
+		return (run, threads * PYCACHE_OPS_PER_THREAD)
+
+	def server_handshake(self):
+		"""Return the data of a TLS handshake record with a ServerHello, Certificate, and ServerHelloDone."""
+		def message(msg_type, body):
+			return struct.pack('!BBH', msg_type, len(body) >> 16, len(body) & 0xffff) + body
+		def length3(data):
+			return struct.pack('!BH', len(data) >> 16, len(data) & 0xffff) + data
+
+		rng = random.Random(1)
+		cert = "".join(chr(rng.randint(0, 255)) for i in range(1200))
+		chain = length3(cert) + length3("".join(chr(rng.randint(0, 255)) for i in range(1000)))
+		server_hello = '\x03\x01' + '\x00' * 32 + '\x00' + '\x00\x2f' + '\x00'
+		return message(2, server_hello) + message(11, length3(chain)) + message(14, '')
+
+	def bench_ssl_scan_sock__get_all_handshake_protocols(self):
+		record = self.server_handshake()
+		return (lambda: ssl_scan_sock._get_all_handshake_protocols(record), 1)
+
+	def bench_ssl_scan_sock__get_server_cert_from_protocol(self):
+		protocols = ssl_scan_sock._get_all_handshake_protocols(self.server_handshake())
+		certificate = [data for (msg_type, data) in protocols if msg_type == 11][0]
+		return (lambda: ssl_scan_sock._get_server_cert_from_protocol(certificate), 1)
+
+	def bench_client_common__verify_notary_signature(self):
+		xml = self.reply_xml()
+		if (not client_common.verify_notary_signature(SERVICE, xml, self.public_key)):
+			raise Exception("the benchmark reply does not verify")
+		return (lambda: client_common.verify_notary_signature(SERVICE, xml, self.public_key), 1)
+
+	def bench_ndb__report_observation(self):
+		args = ndb.get_parser().parse_args([])
+		args.dbname = os.path.join(self.workdir, 'report_observation.sqlite')
+		db = ndb(args)
+
+		# the common case: a scan sees the same key as last time, an hour ago.
+		# an observation can only be extended once a second, so use enough services that each is only scanned once
+		data = SyntheticData('1', '1', seed=1, now=int(time.time()) - 3600)
+		services = service_names(REPORT_SERVICES)
+		db.insert_bulk_services(services)
+		keys = {}
+		for i in xrange(0, len(services), 1000):
+			obs = [data.observations(service)[0] for service in services[i:i + 1000]]
+			db.insert_bulk_observations(obs)
+			keys.update((service, key) for (service, key, start, end) in obs)
+
+		state = {'next': 0}
+		def run():
+			service = services[state['next'] % len(services)]
+			state['next'] += 1
+			db.report_observation(service, keys[service])
+		return (run, 1)
+
+
+def measure(func, ops, repeat, min_time):
+	"""Return the best time per operation, in seconds, with each run taking at least 'min_time' seconds."""
+	timer = timeit.Timer(func)
+	number = 1
+	while True:
+		elapsed = timer.timeit(number)
+		if (elapsed >= min_time):
+			break
+		number *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / elapsed) + 1))
+	times = [elapsed] + timer.repeat(repeat=repeat - 1, number=number)
+	return min(times) / (number * ops)
+
+def format_time(seconds):
+	if (seconds >= 1e-3):
+		return "%.3f ms" % (seconds * 1e3)
+	return "%.3f us" % (seconds * 1e6)
+
+def read_baseline(baseline_file):
+	with open(baseline_file) as f:
+		return json.load(f)
+
+def write_baseline(baseline_file, results):
+	baseline = {'created': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'results': dict((name, {'seconds_per_op': seconds}) for (name, seconds) in results.items())}
+	with open(baseline_file, 'w') as f:
+		json.dump(baseline, f, indent=2, sort_keys=True)
+		f.write("\n")
+
+def compare(baseline, results, tolerance):
+	"""Print each result next to the baseline. Returns the names of the benchmarks that regressed."""
+	if (baseline.get('python') != platform.python_version() or baseline.get('platform') != platform.platform()):
+		print >> sys.stderr, "WARNING: the baseline was made with Python %s on %s - results may not be comparable." % \
+			(baseline.get('python'), baseline.get('platform'))
+
+	regressions = []
+	print "%-50s %12s %12s %8s" % ("benchmark", "baseline", "now", "change")
+	for name in sorted(results):
+		seconds = results[name]
+		if (name not in baseline['results']):
+			print "%-50s %12s %12s %8s  new" % (name, "", format_time(seconds), "")
+			continue
+		before = baseline['results'][name]['seconds_per_op']
+		change = seconds / before - 1
+		status = ""
+		if (change > tolerance):
+			status = "REGRESSION"
+			regressions.append(name)
+		elif (change < -tolerance):
+			status = "faster"
+		print "%-50s %12s %12s %+7.1f%%  %s" % (name, format_time(before), format_time(seconds), change * 100, status)
+	return regressions
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+	help="Only run benchmarks whose names contain one of these strings. Default: run all of them.")
+parser.add_argument('--save', metavar='FILE',
+	help="Save the results as a JSON baseline.")
+parser.add_argument('--compare', metavar='FILE',
+	help="Compare the results with a JSON baseline saved by --save.")
+parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+	help="With --compare: report a regression when a benchmark is slower than the baseline by more than this fraction. \
+	Default: %(default)s.")
+parser.add_argument('--repeat', '-r', type=int, default=5,
+	help="Number of timing runs; the best run is reported. Default: %(default)s.")
+parser.add_argument('--min-time', type=float, default=0.2, metavar='SECONDS',
+	help="The shortest time for one timing run. Default: %(default)s.")
+parser.add_argument('--threads', type=int, default=4,
+	help="Threads for the contended pycache benchmark. Default: %(default)s.")
+parser.add_argument('--list', action='store_true', default=False,
+	help="List the benchmarks and exit.")
+
+def main(args):
+	benchmarks = Benchmarks(args)
+	try:
+		names = benchmarks.get_names()
+		if (args.benchmarks):
+			names = [name for name in names if any(pattern in name for pattern in args.benchmarks)]
+		if (args.list):
+			print "\n".join(names)
+			return 0
+
+		results = {}
+		for name in names:
+			(func, ops) = benchmarks.setup(name)
+			results[name] = measure(func, ops, args.repeat, args.min_time)
+			if (args.compare == None):
+				print "%-50s %12s" % (name, format_time(results[name]))
+				sys.stdout.flush()
+	finally:
+		benchmarks.close()
+
+	if (args.save != None):
+		write_baseline(args.save, results)
+		print "Saved results to '%s'." % args.save
+
+	if (args.compare != None):
+		regressions = compare(read_baseline(args.compare), results, args.tolerance)
+		if (regressions):
+			print "\n%d benchmarks regressed by more than %.0f%%." % (len(regressions), args.tolerance * 100)
+			return 1
+	return 0
+
+if __name__ == '__main__':
+	exit(main(parser.parse_args()))
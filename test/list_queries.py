@@ -38,6 +38,7 @@ import os
 sys.path.insert(0,
 	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 from notary_util.notary_db import ndb
+from notary_util.synthetic_db import SyntheticData, service_names
 
 
 
@@ -51,6 +52,7 @@ class NotarySQLEnumeration(unittest.TestCase):
 	LOG_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
 		'notary_statements.sql')
 	SQL_LOG_CHANNEL = 'sqlalchemy.engine'
+	SYNTHETIC_SERVICES = 1000 # services with realistic data for the queries to work on
 
 	test_case_count = 0
 
@@ -109,15 +111,28 @@ class NotarySQLEnumeration(unittest.TestCase):
 
 	def test_report_metric(self):
 		self.ndb.report_metric('CacheHit')
+		self.ndb.metrics_writer.flush()
+
+	def test_rollup_metrics(self):
+		self.ndb.rollup_metrics()
+
+	def test_prune_metrics(self):
+		self.ndb.prune_metrics(3600 * 24 * 30)
+
+	def test_get_hourly_metrics(self):
+		self.ndb.get_hourly_metrics(0)
 
 	def test_insert_service(self):
 		with self.ndb.get_session() as session:
 			self.ndb.insert_service(session, 'insert_service_test:443,2')
 
 	def test_get_observations(self):
-		# TODO: can we profile this even with no obs in the db?
 		with self.ndb.get_session() as session:
-			self.ndb.get_observations(session, 'get_obs_test:443,2')
+			list(self.ndb.get_observations(session, service_names(1)[0]))
+
+	def test_get_observations_for_services(self):
+		with self.ndb.get_session() as session:
+			list(self.ndb.get_observations_for_services(session, service_names(2)))
 
 	def test_insert_observation(self):
 		self.ndb._insert_observation('insert_obs_test:443,2', 'aa:bb', 1, 2)
@@ -136,7 +151,32 @@ class NotarySQLEnumeration(unittest.TestCase):
 	def test_report_observation(self):
 		self.ndb.report_observation('report_observation_test:443,2', 'aa:bb')
 
+	def test_get_signed_response(self):
+		self.ndb.get_signed_response('get_signed_response_test:443,2', 'fingerprint')
+
+	def test_get_signed_responses(self):
+		self.ndb.get_signed_responses(['get_signed_response_test:443,2', 'get_signed_response_test_2:443,2'], 'fingerprint')
+
+	def test_store_signed_response(self):
+		srv = 'store_signed_response_test:443,2'
+		with self.ndb.get_session() as session:
+			self.ndb.insert_service(session, srv)
+		self.ndb.store_signed_response(srv, '<notary_reply/>', 'fingerprint')
+
+	def test_delete_signed_response(self):
+		self.ndb.delete_signed_response('delete_signed_response_test:443,2')
+
+	def test_delete_signed_responses(self):
+		self.ndb.delete_signed_responses(['delete_signed_response_test:443,2', 'delete_signed_response_test_2:443,2'])
+
 	# less important SQL - used less often or in the background
+	def test_get_most_requested_services(self):
+		self.ndb.get_most_requested_services(10, 0)
+
+	def test_dispose_connections(self):
+		self.ndb.dispose_connections()
+		self.ndb.count_services()
+
 	def test_count_services(self):
 		self.ndb.count_services()
 
@@ -151,6 +191,10 @@ class NotarySQLEnumeration(unittest.TestCase):
 		self.ndb.insert_bulk_services(
 			['bulkinserttest:443,2', 'bulkinserttest_2:443,2', 'bulkinserttest_3:443,2'])
 
+	def test_insert_bulk_observations(self):
+		self.ndb.insert_bulk_observations(
+			[(service_names(1)[0], 'aa:bb', 1, 2), (service_names(1)[0], 'aa:bb', 3, 4)])
+
 
 if __name__ == '__main__':
 
@@ -161,6 +205,11 @@ if __name__ == '__main__':
 		except (Exception) as e:
 			print >> sys.stderr, "Error deleting test database: '{0}'. WARNING - tests may not run properly.".format(e)
 
+	# fill the database before SQL logging starts
+	args = ndb.get_parser().parse_args()
+	args.dbname = NotarySQLEnumeration.TEST_DATABASE
+	SyntheticData(seed=1).fill_database(ndb(args), service_names(NotarySQLEnumeration.SYNTHETIC_SERVICES))
+
 	test_suite = unittest.TestLoader().loadTestsFromTestCase(NotarySQLEnumeration)
 	unittest.main(verbosity=2)
 
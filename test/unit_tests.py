@@ -22,19 +22,42 @@ You may see error messages printed to stderr, but that should be evidence of cod
 """
 
 import argparse
+import asyncore
+import email.utils
+import gzip
+import StringIO
 import logging
 import os
+import random
+import shutil
+import socket
+import struct
 import sys
+import tempfile
+import threading
 import time
 import unittest
+import zlib
 
 # TODO: HACK
 # add ..\notary_util to the import path so we can import ndb
 sys.path.insert(0,
 	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 
+from client import client_common
+import notary_async
+import notary_http
+import cherrypy
+from cherrypy.lib.httputil import HeaderMap
+from notary_util import notary_db
 from notary_util.notary_db import ndb
-from util import pycache
+from notary_util import notary_reply
+from notary_util.hyperloglog import HyperLogLog
+from notary_util.synthetic_db import Distribution, SyntheticData, service_names
+from util import cache, crypto, metrics_registry, packing, pycache, tracing
+from util.keymanager import keymanager
+from util.load_shedder import LoadShedder, Overloaded
+from util.scan_queue import ScanQueue
 from util.ssl_scan_sock import attempt_observation_for_service, SSLScanTimeoutException, SSLAlertException
 
 class SSLScanSockTestCases(unittest.TestCase):
@@ -56,11 +79,1340 @@ class SSLScanSockTestCases(unittest.TestCase):
 	#	self.True(attempt_observation_for_service('testsite.com:443', 10, True))
 
 
+class PackingTestCases(unittest.TestCase):
+	"""Test packing observation data for signatures."""
+
+	def test_pack_key(self):
+		packed = packing.pack_key('aa:bb:0c', [(1, 2), (0x01020304, 0xFFFFFFFF)])
+		self.assertEqual(packed, '\x00\x02\x00\x10\x03' + '\xaa\xbb\x0c' +
+			'\x00\x00\x00\x01\x00\x00\x00\x02\x01\x02\x03\x04\xff\xff\xff\xff')
+
+	def test_pack_key_with_no_timespans(self):
+		self.assertEqual(packing.pack_key('aa', []), '\x00\x00\x00\x10\x03\xaa')
+
+	def test_pack_service_reverses_keys(self):
+		keys = [('aa:bb', [(1, 2)]), ('cc', [(3, 4), (5, 6)])]
+		packed = packing.pack_service('host:443,2', keys)
+		self.assertEqual(packed, 'host:443,2\x00' +
+			packing.pack_key('cc', [(3, 4), (5, 6)]) + packing.pack_key('aa:bb', [(1, 2)]))
+
+	def test_pack_unicode_input(self):
+		# database drivers and xml parsers may hand us unicode strings
+		self.assertEqual(packing.pack_service(u'host:443,2', [(u'aa:bb', [(1, 2)])]),
+			packing.pack_service('host:443,2', [('aa:bb', [(1, 2)])]))
+
+	def legacy_pack_key(self, fingerprint, timespans):
+		"""The byte-by-byte packing used before util/packing.py."""
+		head = struct.pack("BBBBB", (len(timespans) >> 8) & 255, len(timespans) & 255, 0, 16, 3)
+		fp_bytes = "".join(struct.pack("B", int(hex_byte, 16)) for hex_byte in fingerprint.split(":"))
+		ts_bytes = "".join(struct.pack(">II", start, end) for (start, end) in timespans)
+		return head + fp_bytes + ts_bytes
+
+	def test_same_as_legacy_packing(self):
+		for fingerprint in ['aa:bb:0c', 'a:bb', 'a:b:c', '0:ff', 'A:Bb']:
+			self.assertEqual(packing.pack_key(fingerprint, [(1, 2)]), self.legacy_pack_key(fingerprint, [(1, 2)]))
+
+	def test_invalid_fingerprint(self):
+		for fingerprint in ['aa:bbb', 'aa::bb', 'zz:aa', '']:
+			self.assertRaises(ValueError, packing.pack_key, fingerprint, [(1, 2)])
+			self.assertRaises(ValueError, client_common.pack_key, fingerprint, [(1, 2)])
+
+	def test_client_packs_the_same(self):
+		keys = [('aa:bb', [(1, 2)]), ('c:dd', [(3, 4), (0x01020304, 0xFFFFFFFF)]), (u'ee', [])]
+		self.assertEqual(client_common.pack_service(u'host:443,2', keys), packing.pack_service('host:443,2', keys))
+
+
+class NotaryReplyTestCases(unittest.TestCase):
+	"""Test building notary replies."""
+
+	SERVICE = 'golden.example.com:443,2'
+	SIGNED_KEYS = [('aa:bb:cc', [(1, 2), (5, 6)]), ('dd:ee', [(3, 4)])]
+
+	GOLDEN_PRETTY = (
+		'<notary_reply sig="c2ln" sig_type="rsa-md5" version="1">\n'
+		'\t<key fp="aa:bb:cc" type="ssl">\n'
+		'\t\t<timestamp end="2" start="1"/>\n'
+		'\t\t<timestamp end="6" start="5"/>\n'
+		'\t</key>\n'
+		'\t<key fp="dd:ee" type="ssl">\n'
+		'\t\t<timestamp end="4" start="3"/>\n'
+		'\t</key>\n'
+		'</notary_reply>\n')
+
+	GOLDEN_COMPACT = (
+		'<notary_reply sig="c2ln" sig_type="rsa-md5" version="1">'
+		'<key fp="aa:bb:cc" type="ssl">'
+		'<timestamp end="2" start="1"/>'
+		'<timestamp end="6" start="5"/>'
+		'</key>'
+		'<key fp="dd:ee" type="ssl">'
+		'<timestamp end="4" start="3"/>'
+		'</key>'
+		'</notary_reply>')
+
+	def minidom_reply(self, sig, signed_keys):
+		"""Build a reply the way notaries did before serialize_reply() existed."""
+		from xml.dom.minidom import getDOMImplementation
+		new_doc = getDOMImplementation().createDocument(None, "notary_reply", None)
+		top_element = new_doc.documentElement
+		top_element.setAttribute("version", "1")
+		top_element.setAttribute("sig_type", "rsa-md5")
+		for (fp, timespans) in signed_keys:
+			key_elem = new_doc.createElement("key")
+			key_elem.setAttribute("type", "ssl")
+			key_elem.setAttribute("fp", fp)
+			top_element.appendChild(key_elem)
+			for (start, end) in timespans:
+				ts_elem = new_doc.createElement("timestamp")
+				ts_elem.setAttribute("end", str(end))
+				ts_elem.setAttribute("start", str(start))
+				key_elem.appendChild(ts_elem)
+		top_element.setAttribute("sig", sig)
+		return top_element.toprettyxml()
+
+	def test_golden_pretty_reply(self):
+		self.assertEqual(notary_reply.serialize_reply('c2ln', '2', self.SIGNED_KEYS), self.GOLDEN_PRETTY)
+
+	def test_golden_compact_reply(self):
+		self.assertEqual(notary_reply.serialize_reply('c2ln', '2', self.SIGNED_KEYS, compact=True),
+			self.GOLDEN_COMPACT)
+
+	def test_pretty_reply_matches_minidom(self):
+		sig = 'abc+/=="<>&'
+		self.assertEqual(notary_reply.serialize_reply(sig, '2', self.SIGNED_KEYS),
+			self.minidom_reply(sig, self.SIGNED_KEYS))
+
+	def test_validators(self):
+		(etag, last_modified) = notary_reply.get_validators(self.GOLDEN_PRETTY)
+		self.assertTrue(etag.startswith('W/"') and etag.endswith('"'))
+		self.assertEqual(last_modified, 6)
+
+		# indented and compact replies carry the same signature, so they share an etag
+		self.assertEqual(notary_reply.get_validators(self.GOLDEN_COMPACT), (etag, last_modified))
+
+		# a different signature must give a different etag
+		other = self.GOLDEN_PRETTY.replace('sig="c2ln"', 'sig="b3RoZXI="')
+		self.assertNotEqual(notary_reply.get_validators(other)[0], etag)
+
+	def test_group_observations(self):
+		obs = [(self.SERVICE, 'aa', 5, 6), (self.SERVICE, 'bb', 3, 4), (self.SERVICE, 'aa', 1, 2)]
+		(keys, timestamps_by_key) = notary_reply.group_observations(obs)
+		self.assertEqual(keys, ['aa', 'bb'])
+		self.assertEqual(timestamps_by_key, {'aa': [(5, 6), (1, 2)], 'bb': [(3, 4)]})
+
+	def test_clients_verify_reply(self):
+		from M2Crypto import BIO, RSA
+		sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'client'))
+		import client_common
+
+		rsa = RSA.gen_key(1024, 65537, lambda *args: None)
+		priv_bio = BIO.MemoryBuffer()
+		rsa.save_key_bio(priv_bio, cipher=None)
+		pub_bio = BIO.MemoryBuffer()
+		rsa.save_pub_key_bio(pub_bio)
+		(priv_key, pub_key) = (priv_bio.read(), pub_bio.read())
+
+		keys = [k for (k, timespans) in self.SIGNED_KEYS]
+		timestamps_by_key = dict((k, list(reversed(timespans))) for (k, timespans) in self.SIGNED_KEYS)
+		for compact in (False, True):
+			xml = notary_reply.create_reply_xml(self.SERVICE, '2', keys, timestamps_by_key, crypto.Signer(priv_key), compact)
+			self.assertTrue(client_common.verify_notary_signature(self.SERVICE, xml, pub_key))
+			self.assertFalse(client_common.verify_notary_signature('other:443,2', xml, pub_key))
+			self.assertTrue('Key = dd:ee' in client_common.notary_reply_as_text(xml))
+
+
+class SignerTestCases(unittest.TestCase):
+	"""Test signing with a key that is only loaded once."""
+
+	@classmethod
+	def setUpClass(cls):
+		from M2Crypto import BIO, RSA
+		rsa = RSA.gen_key(1024, 65537, lambda *args: None)
+		bio = BIO.MemoryBuffer()
+		rsa.save_key_bio(bio, cipher=None)
+		cls.priv_key = bio.read()
+
+	def test_same_signature_as_sign_content(self):
+		signer = crypto.Signer(self.priv_key)
+		for content in ['', 'some content', 'golden.example.com:443,2\x00\x01']:
+			self.assertEqual(signer.sign(content), crypto.sign_content(content, self.priv_key))
+
+	def test_threads_share_signer(self):
+		signer = crypto.Signer(self.priv_key)
+		expected = signer.sign('content')
+		sigs = []
+		threads = [threading.Thread(target=lambda: sigs.append(signer.sign('content'))) for i in range(5)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(sigs, [expected] * 5)
+
+	def test_bad_key(self):
+		self.assertRaises(Exception, crypto.Signer, 'not a key')
+		self.assertRaises(Exception, crypto.SigningPool, 'not a key', 1)
+
+	def test_signing_pool(self):
+		contents = ['content %d' % i for i in range(120)]
+		pool = crypto.SigningPool(self.priv_key, 2)
+		try:
+			self.assertEqual(pool.sign_batch(contents), crypto.Signer(self.priv_key).sign_batch(contents))
+			self.assertEqual(pool.sign_batch([]), [])
+			self.assertEqual(pool.fingerprint, crypto.Signer(self.priv_key).fingerprint)
+		finally:
+			pool.close()
+
+	def test_fingerprint(self):
+		from M2Crypto import BIO, RSA
+		signer = crypto.Signer(self.priv_key)
+		bio = BIO.MemoryBuffer()
+		signer.load_key().save_pub_key_bio(bio)
+		public = RSA.load_pub_key_bio(bio)
+		# the public key has the same fingerprint as the private key
+		self.assertEqual(crypto.key_fingerprint(public), signer.fingerprint)
+
+		other = RSA.gen_key(1024, 65537, lambda *args: None)
+		self.assertNotEqual(crypto.key_fingerprint(other), signer.fingerprint)
+
+
+class KeyManagerTestCases(unittest.TestCase):
+	"""Test reading key files."""
+
+	def setUp(self):
+		self.workdir = tempfile.mkdtemp(prefix='notary_keys_')
+		self.args = argparse.Namespace(private_key=os.path.join(self.workdir, 'notary.priv'),
+			envkeys=False, export_heroku_keys=None)
+
+	def tearDown(self):
+		shutil.rmtree(self.workdir, ignore_errors=True)
+
+	def test_missing_keys_not_created(self):
+		self.assertEqual(keymanager(self.args).get_keys(create=False), (None, None))
+		self.assertEqual(os.listdir(self.workdir), [])
+
+
+class AsyncFrontEndTestCases(unittest.TestCase):
+	"""Test the parts of the event-driven front end that don't need a running notary."""
+
+	class FakeFrontEnd(object):
+		"""Record requests instead of answering them."""
+		def __init__(self):
+			self.map = {}
+			self.requests = []
+
+		def handle_request(self, conn, request):
+			self.requests.append(request)
+
+	def setUp(self):
+		self.front_end = self.FakeFrontEnd()
+		(self.client, server) = socket.socketpair()
+		self.conn = notary_async.NotaryConnection(server, self.front_end)
+
+	def tearDown(self):
+		self.client.close()
+		self.conn.close()
+
+	def send(self, data):
+		"""Send data from the client and let the connection read it."""
+		self.client.sendall(data)
+		asyncore.loop(timeout=1, map=self.front_end.map, count=1)
+
+	def read_response(self):
+		asyncore.loop(timeout=1, map=self.front_end.map, count=1)
+		self.client.settimeout(1)
+		return self.client.recv(65536)
+
+	def test_get_request(self):
+		self.send("GET /?host=a.com&port=443 HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n")
+		self.assertEqual(len(self.front_end.requests), 1)
+		request = self.front_end.requests[0]
+		self.assertEqual(request.method, 'GET')
+		self.assertEqual(request.path, '/')
+		self.assertEqual(request.params, {'host': ['a.com'], 'port': ['443']})
+		self.assertEqual(request.headers.get('accept-encoding'), 'gzip')
+		self.assertTrue(request.keep_alive)
+
+	def test_post_body(self):
+		body = "service=a.com:443,2&service=b.com:443,2"
+		self.send("POST /batch HTTP/1.0\r\nContent-Type: application/x-www-form-urlencoded\r\n" +
+			"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+		request = self.front_end.requests[0]
+		self.assertEqual(request.params, {'service': ['a.com:443,2', 'b.com:443,2']})
+		self.assertFalse(request.keep_alive)
+
+	def test_client_address_not_kept(self):
+		listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listener.bind(('127.0.0.1', 0))
+		listener.listen(1)
+		client = socket.create_connection(listener.getsockname())
+		(sock, addr) = listener.accept()
+		conn = notary_async.NotaryConnection(sock, self.front_end, local=True)
+		try:
+			self.assertEqual(conn.addr, None)
+			self.assertTrue(conn.local)
+			self.assertFalse(addr[0] in repr(conn))
+		finally:
+			conn.close()
+			client.close()
+			listener.close()
+
+	def test_pipelined_requests_answered_in_order(self):
+		self.send("GET /?host=a.com HTTP/1.1\r\n\r\nGET /?host=b.com HTTP/1.1\r\n\r\n")
+		# the second request waits until the first is answered
+		self.assertEqual(len(self.front_end.requests), 1)
+		self.conn.respond(self.front_end.requests[0], 200, notary_async.HeaderMap(), "first")
+		self.assertEqual(len(self.front_end.requests), 2)
+		self.assertEqual(self.front_end.requests[1].params, {'host': ['b.com']})
+		self.assertTrue(self.read_response().endswith("\r\n\r\nfirst"))
+
+	def test_bad_request(self):
+		self.send("not http\r\n\r\n")
+		self.assertEqual(len(self.front_end.requests), 0)
+		self.assertTrue(self.read_response().startswith("HTTP/1.1 400 "))
+
+	def test_body_too_large(self):
+		self.send("POST /batch HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % (self.conn.MAX_BODY_SIZE + 1))
+		self.assertEqual(len(self.front_end.requests), 0)
+		self.assertTrue(self.read_response().startswith("HTTP/1.1 413 "))
+
+	def test_worker_pool_is_bounded(self):
+		waker = notary_async.Waker(self.front_end.map)
+		pool = notary_async.WorkerPool('test', 1, 1, waker)
+		results = []
+		blocker = notary_async.threading.Event()
+
+		self.assertTrue(pool.submit(lambda result, error: results.append(result), blocker.wait))
+		time.sleep(0.1) # let the worker take the first job
+		self.assertTrue(pool.submit(lambda result, error: results.append(result), lambda: 'second'))
+		self.assertFalse(pool.submit(lambda result, error: results.append(result), lambda: 'third'))
+
+		blocker.set()
+		for i in range(10):
+			asyncore.loop(timeout=0.1, map=self.front_end.map, count=1)
+			if (len(results) == 2):
+				break
+		self.assertEqual(results, [True, 'second'])
+		waker.close()
+
+
+class NotaryServerTestCase(unittest.TestCase):
+	"""Base class for tests that need a notary server. Each notary gets its own database."""
+
+	SERVICE = 'notary_http_test.example.com:443,2'
+	NOTARY_ARGS = ['--pycache', '10']
+
+	class CountingCache(object):
+		"""Pass calls on to a cache, recording the name of each method called."""
+		def __init__(self, cache):
+			self.cache = cache
+			self.calls = []
+
+		def __getattr__(self, name):
+			method = getattr(self.cache, name)
+			def call(*args, **kwargs):
+				self.calls.append(name)
+				return method(*args, **kwargs)
+			return call
+
+	@classmethod
+	def setUpClass(cls):
+		from M2Crypto import RSA
+		cls.workdir = tempfile.mkdtemp(prefix='notary_http_')
+		cls.private_key_file = os.path.join(cls.workdir, 'notary.priv')
+		rsa = RSA.gen_key(1024, 65537, lambda *args: None)
+		rsa.save_key(cls.private_key_file, cipher=None)
+		rsa.save_pub_key(os.path.join(cls.workdir, 'notary.pub'))
+
+	@classmethod
+	def tearDownClass(cls):
+		shutil.rmtree(cls.workdir, ignore_errors=True)
+
+	def tearDown(self):
+		pycache.clear()
+
+	def create_notary(self, args=None):
+		"""Return a new notary started with the list of 'args' (default: NOTARY_ARGS), with an empty cache."""
+		if (args == None):
+			args = self.NOTARY_ARGS
+		pycache.clear()
+		(fd, db) = tempfile.mkstemp(suffix='.sqlite', dir=self.workdir)
+		os.close(fd)
+		notary = notary_http.NotaryHTTPServer(['--dbname', db, '--private-key', self.private_key_file] + args)
+		# a service with data, so building its reply never starts a scan
+		notary.ndb._insert_observation(self.SERVICE, 'aa:bb:cc', 1000, 2000)
+		return notary
+
+	def headers(self, **values):
+		"""Return request headers, e.g. headers(Accept_Encoding='gzip')."""
+		h = HeaderMap()
+		for (name, value) in values.items():
+			h[name.replace('_', '-')] = value
+		return h
+
+
+class CompressedReplyTestCases(NotaryServerTestCase):
+	"""Test sending compressed replies chosen by Accept-Encoding."""
+
+	NOTARY_ARGS = ['--pycache', '10', '--compressed-replies']
+
+	def setUp(self):
+		self.notary = self.create_notary()
+		self.xml = self.notary.calculate_service_xml(self.SERVICE, '2')
+
+	def get(self, **request_headers):
+		"""Return (body, response headers) for a request answered from the cache."""
+		response_headers = HeaderMap()
+		body = self.notary.get_cached_response(self.SERVICE, self.headers(**request_headers), response_headers)
+		return (body, response_headers)
+
+	def gunzip(self, data):
+		return gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+
+	def test_negotiation(self):
+		(body, headers) = self.get(Accept_Encoding='gzip')
+		self.assertEqual(headers['Content-Encoding'], 'gzip')
+		self.assertEqual(self.gunzip(body), self.xml)
+
+		(body, headers) = self.get(Accept_Encoding='deflate')
+		self.assertEqual(headers['Content-Encoding'], 'deflate')
+		self.assertEqual(zlib.decompress(body), self.xml)
+
+		# the highest quality value wins, and gzip is preferred for '*'
+		(body, headers) = self.get(Accept_Encoding='gzip;q=0.5, deflate;q=0.9')
+		self.assertEqual(headers['Content-Encoding'], 'deflate')
+		(body, headers) = self.get(Accept_Encoding='*')
+		self.assertEqual(headers['Content-Encoding'], 'gzip')
+
+	def test_q_zero_refuses_encoding(self):
+		(body, headers) = self.get(Accept_Encoding='gzip;q=0, deflate')
+		self.assertEqual(headers['Content-Encoding'], 'deflate')
+		self.assertEqual(zlib.decompress(body), self.xml)
+
+		(body, headers) = self.get(Accept_Encoding='gzip;q=0')
+		self.assertFalse('Content-Encoding' in headers)
+		self.assertEqual(body, self.xml)
+
+	def test_uncompressed_fallback(self):
+		for request_headers in [{}, {'Accept_Encoding': 'identity'}, {'Accept_Encoding': 'br'}]:
+			(body, headers) = self.get(**request_headers)
+			self.assertFalse('Content-Encoding' in headers)
+			self.assertEqual(body, self.xml)
+			# the response still depends on the header, for shared caches between us and the client
+			self.assertEqual(headers['Vary'], 'Accept-Encoding')
+
+	def test_vary_only_when_compressing(self):
+		self.notary = self.create_notary(['--pycache', '10'])
+		self.notary.calculate_service_xml(self.SERVICE, '2')
+		(body, headers) = self.get(Accept_Encoding='gzip')
+		self.assertFalse('Vary' in headers)
+		self.assertFalse('Content-Encoding' in headers)
+
+	def test_compressed_lazily(self):
+		cache = self.notary.cache
+		self.assertEqual(cache.get(self.SERVICE + '|gzip'), None)
+		self.assertEqual(cache.get(self.SERVICE + '|deflate'), None)
+		self.get(Accept_Encoding='gzip')
+		self.assertNotEqual(cache.get(self.SERVICE + '|gzip'), None)
+		self.assertEqual(cache.get(self.SERVICE + '|deflate'), None)
+
+	def test_one_cache_call_per_hit(self):
+		self.get(Accept_Encoding='gzip')
+		self.notary.cache = self.CountingCache(self.notary.cache)
+		(body, headers) = self.get(Accept_Encoding='gzip')
+		self.assertEqual(self.gunzip(body), self.xml)
+		self.assertEqual(self.notary.cache.calls, ['get_multi'])
+
+		self.notary.cache.calls = []
+		(body, headers) = self.get()
+		self.assertEqual(body, self.xml)
+		self.assertEqual(self.notary.cache.calls, ['get_multi'])
+
+	def test_copy_of_old_reply_not_sent(self):
+		self.get(Accept_Encoding='gzip')
+		self.notary.ndb._insert_observation(self.SERVICE, 'dd:ee:ff', 3000, 4000)
+		new_xml = self.notary.calculate_service_xml(self.SERVICE, '2')
+		self.assertNotEqual(new_xml, self.xml)
+		(body, headers) = self.get(Accept_Encoding='gzip')
+		self.assertEqual(self.gunzip(body), new_xml)
+
+	def test_new_reply_compressed(self):
+		response_headers = HeaderMap()
+		body = self.notary.finish_response(self.SERVICE, self.xml, self.headers(Accept_Encoding='gzip'), response_headers)
+		self.assertEqual(response_headers['Content-Encoding'], 'gzip')
+		self.assertEqual(self.gunzip(body), self.xml)
+		# the next request uses the cached copy
+		self.notary.cache = self.CountingCache(self.notary.cache)
+		self.get(Accept_Encoding='gzip')
+		self.assertEqual(self.notary.cache.calls, ['get_multi'])
+
+
+class ConditionalRequestTestCases(NotaryServerTestCase):
+	"""Test answering conditional requests with 304 Not Modified."""
+
+	def setUp(self):
+		self.notary = self.create_notary()
+		self.xml = self.notary.calculate_service_xml(self.SERVICE, '2')
+		(self.etag, self.last_modified) = notary_reply.get_validators(self.xml)
+		self.last_modified_date = email.utils.formatdate(self.last_modified, usegmt=True)
+
+	def get(self, request_headers):
+		"""
+		Request the cached reply and return the HTTP status.
+		The same request is also checked against a reply that was just built, which must give the same status.
+		"""
+		statuses = []
+		for answer in [self.notary.get_cached_response, self.notary.finish_response]:
+			response_headers = HeaderMap()
+			args = (self.SERVICE, request_headers, response_headers)
+			if (answer == self.notary.finish_response):
+				args = (self.SERVICE, self.xml, request_headers, response_headers)
+			try:
+				body = answer(*args)
+				self.assertEqual(body, self.xml)
+				statuses.append(200)
+			except cherrypy.HTTPRedirect as e:
+				statuses.append(e.status)
+			# validators are sent with 304s too
+			self.assertEqual(response_headers['ETag'], self.etag)
+			self.assertEqual(response_headers['Last-Modified'], self.last_modified_date)
+		self.assertEqual(statuses[0], statuses[1])
+		return statuses[0]
+
+	def test_unconditional(self):
+		self.assertEqual(self.get(self.headers()), 200)
+
+	def test_if_none_match(self):
+		self.assertEqual(self.get(self.headers(If_None_Match=self.etag)), 304)
+		self.assertEqual(self.get(self.headers(If_None_Match='W/"other", ' + self.etag)), 304)
+		self.assertEqual(self.get(self.headers(If_None_Match='W/"other"')), 200)
+
+	def test_weak_and_wildcard_etags(self):
+		# our etags are weak; a strong form of the same tag matches with the weak comparison
+		self.assertTrue(self.etag.startswith('W/'))
+		self.assertEqual(self.get(self.headers(If_None_Match=self.etag[2:])), 304)
+		self.assertEqual(self.get(self.headers(If_None_Match='*')), 304)
+
+	def test_if_modified_since(self):
+		since = lambda t: email.utils.formatdate(t, usegmt=True)
+		self.assertEqual(self.get(self.headers(If_Modified_Since=since(self.last_modified))), 304)
+		self.assertEqual(self.get(self.headers(If_Modified_Since=since(self.last_modified + 60))), 304)
+		self.assertEqual(self.get(self.headers(If_Modified_Since=since(self.last_modified - 1))), 200)
+		self.assertEqual(self.get(self.headers(If_Modified_Since='not a date')), 200)
+
+	def test_if_none_match_takes_precedence(self):
+		# a matching etag wins over an old date, and a different etag wins over a current date
+		old = email.utils.formatdate(self.last_modified - 1, usegmt=True)
+		self.assertEqual(self.get(self.headers(If_None_Match=self.etag, If_Modified_Since=old)), 304)
+		self.assertEqual(self.get(self.headers(If_None_Match='W/"other"',
+			If_Modified_Since=self.last_modified_date)), 200)
+
+
+class StaleWhileRevalidateTestCases(NotaryServerTestCase):
+	"""Test answering from stale cached replies while they are rebuilt in the background."""
+
+	NOTARY_ARGS = ['--pycache', '10', '--stale-while-revalidate', '60']
+
+	def setUp(self):
+		self.notary = self.create_notary()
+		self.xml = self.notary.calculate_service_xml(self.SERVICE, '2')
+		self.refreshed = []
+		self.notary.refresh_queue = ScanQueue(self.refresh, 1, 10)
+
+	def refresh(self, service):
+		self.refreshed.append(service)
+		self.notary.refresh_reply(service)
+
+	def make_stale(self):
+		"""Expire the marker that says the cached reply is fresh."""
+		pycache.cache[self.SERVICE + self.notary.FRESH_KEY_SUFFIX].expiry = int(time.time()) - 1
+
+	def wait_for_refreshes(self, count):
+		for i in range(500):
+			if (self.notary.refresh_queue.stats()['completed'] >= count):
+				return
+			time.sleep(0.01)
+		self.fail("Timed out waiting for the reply to be refreshed")
+
+	def test_fresh_reply_not_refreshed(self):
+		self.assertEqual(self.notary.get_cached_response(self.SERVICE, self.headers(), HeaderMap()), self.xml)
+		self.assertEqual(self.notary.refresh_queue.stats()['added'], 0)
+
+	def test_stale_reply_served_and_refreshed_once(self):
+		self.make_stale()
+		lookups = self.notary.db_lookups.value
+		for i in range(2):
+			body = self.notary.get_cached_response(self.SERVICE, self.headers(), HeaderMap())
+			self.assertEqual(body, self.xml)
+		self.wait_for_refreshes(1)
+
+		# the second request finds the reply queued, being rebuilt, or fresh again
+		self.assertEqual(self.refreshed, [self.SERVICE])
+		self.assertEqual(self.notary.refresh_queue.stats()['added'], 1)
+		self.assertEqual(self.notary.cache_misses.value, 0)
+		# refreshes are not client lookups
+		self.assertEqual(self.notary.db_lookups.value, lookups)
+		self.assertNotEqual(self.notary.cache.get(self.SERVICE + self.notary.FRESH_KEY_SUFFIX), None)
+
+	def test_refresh_does_not_scan(self):
+		self.notary.scan_queue = ScanQueue(self.refreshed.append, 1, 10)
+		self.notary.refresh_reply('unknown.example.com:443,2')
+		self.assertEqual(self.notary.scan_queue.stats()['added'], 0)
+		self.assertEqual(self.notary.negative_cache.get('unknown.example.com:443,2'), None)
+
+	def test_refresh_waits_for_load_shedder(self):
+		self.notary.run_admitted = lambda func, *args: self.refreshed.append(func)
+		self.make_stale()
+		self.notary.refresh_reply(self.SERVICE)
+		self.assertEqual(self.refreshed, [self.notary.rebuild_reply])
+
+
+class RefreshAheadTestCases(NotaryServerTestCase):
+	"""Test rebuilding requested replies before they expire from the cache."""
+
+	NOTARY_ARGS = ['--pycache', '10', '--cache-expiry', '300', '--refresh-ahead', '60']
+	OTHER_SERVICE = 'notary_http_other.example.com:443,2'
+
+	def setUp(self):
+		self.notary = self.create_notary()
+		self.notary.ndb._insert_observation(self.OTHER_SERVICE, 'dd:ee:ff', 1000, 2000)
+		for service in [self.SERVICE, self.OTHER_SERVICE]:
+			self.notary.calculate_service_xml(service, '2')
+		self.refreshed = []
+		self.notary.refresh_queue = ScanQueue(self.refresh, 1, 10)
+
+	def refresh(self, service):
+		self.refreshed.append(service)
+		self.notary.refresh_reply(service)
+
+	def request(self, service):
+		self.assertNotEqual(self.notary.get_cached_response(service, self.headers(), HeaderMap()), None)
+
+	def expire_soon(self, service, seconds):
+		"""Make the cached reply for 'service' expire in 'seconds'."""
+		pycache.cache[service].expiry = int(time.time()) + seconds
+
+	def wait_for_refreshes(self, count):
+		for i in range(500):
+			if (self.notary.refresh_queue.stats()['completed'] >= count):
+				return
+			time.sleep(0.01)
+		self.fail("Timed out waiting for the reply to be refreshed")
+
+	def test_expiring_replies_chosen(self):
+		self.expire_soon(self.SERVICE, 30)
+		self.assertEqual(self.notary.refresh_ahead([self.SERVICE, self.OTHER_SERVICE]), [self.SERVICE])
+		self.expire_soon(self.OTHER_SERVICE, 61)
+		self.assertEqual(self.notary.refresh_ahead([self.OTHER_SERVICE]), [])
+
+	def test_expiry_read_from_validators_without_ttl(self):
+		# e.g. memcached cannot say how long a key has left
+		self.notary.cache.get_ttl = lambda key: None
+		key = self.SERVICE + self.notary.VALIDATORS_KEY_SUFFIX
+		fields = self.notary.cache.get(key).split(" ")
+		self.notary.cache.set(key, "%s %s %d" % (fields[0], fields[1], int(time.time()) + 30))
+		self.assertEqual(self.notary.refresh_ahead([self.SERVICE, self.OTHER_SERVICE]), [self.SERVICE])
+
+	def test_only_requested_replies_checked(self):
+		self.expire_soon(self.SERVICE, 30)
+		self.request(self.OTHER_SERVICE)
+		self.notary.queue_refresh_ahead()
+		self.assertEqual(self.notary.refresh_queue.stats()['added'], 0)
+
+	def test_expiring_reply_rebuilt_once(self):
+		self.expire_soon(self.SERVICE, 30)
+		for i in range(3):
+			self.request(self.SERVICE)
+		self.notary.queue_refresh_ahead()
+		self.wait_for_refreshes(1)
+		self.assertEqual(self.refreshed, [self.SERVICE])
+		self.assertTrue(self.notary.cache.get_ttl(self.SERVICE) > 60)
+
+		# the rebuilt reply is not due again, and each check only sees requests made since the last one
+		self.request(self.SERVICE)
+		self.notary.queue_refresh_ahead()
+		self.notary.queue_refresh_ahead()
+		self.assertEqual(self.notary.refresh_queue.stats()['added'], 1)
+		self.assertEqual(self.refreshed, [self.SERVICE])
+
+	def test_refresh_is_not_a_lookup(self):
+		lookups = self.notary.db_lookups.value
+		self.expire_soon(self.SERVICE, 30)
+		self.request(self.SERVICE)
+		self.notary.queue_refresh_ahead()
+		self.wait_for_refreshes(1)
+		self.assertEqual(self.notary.db_lookups.value, lookups)
+
+
+class MetricsEndpointTestCases(NotaryServerTestCase):
+	"""Test the notary's /metrics text."""
+
+	NOTARY_ARGS = ['--pycache', '10', '--metrics-endpoint', '--max-db-requests', '2']
+
+	def metric(self, text, name):
+		"""Return the value of the metric 'name' in 'text'."""
+		for line in text.splitlines():
+			if (line.startswith(name + " ")):
+				return float(line.split(" ")[1])
+		self.fail("Metric '%s' not found" % name)
+
+	def test_only_local_clients(self):
+		notary = self.create_notary()
+		self.assertRaises(cherrypy.HTTPError, notary.get_metrics_text, False)
+
+	def test_db_wait(self):
+		notary = self.create_notary()
+		notary.run_admitted(notary.calculate_service_xml, self.SERVICE, '2')
+		self.assertEqual(self.metric(notary.get_metrics_text(True), 'notary_db_requests_admitted_total'), 1)
+		notary.load_shedder.average_wait = 0.25
+		self.assertEqual(self.metric(notary.get_metrics_text(True), 'notary_db_wait_seconds'), 0.25)
+
+
+class BatchRequestTestCases(NotaryServerTestCase):
+	"""Test checking the services sent in a batch request."""
+
+	def setUp(self):
+		self.notary = self.create_notary()
+
+	def services(self, count, start=0):
+		return ['batch%d.example.com:443,2' % i for i in range(start, start + count)]
+
+	def assertStatus(self, status, service):
+		try:
+			self.notary.get_batch_service_ids(service)
+			self.fail("Expected HTTP %d" % status)
+		except cherrypy.HTTPError as e:
+			self.assertEqual(e.status, status)
+
+	def test_unique_services_in_order(self):
+		services = self.services(3)
+		self.assertEqual(self.notary.get_batch_service_ids(services + services[::-1]), services)
+		self.assertEqual(self.notary.get_batch_service_ids(services[0]), services[:1])
+
+	def test_invalid_service(self):
+		self.assertStatus(400, self.services(2) + ['not a service'])
+
+	def test_too_many_services(self):
+		limit = self.notary.MAX_BATCH_SIZE
+		self.assertEqual(len(self.notary.get_batch_service_ids(self.services(limit) * 2)), limit)
+		# rejected as soon as one too many is seen, even if later names are invalid
+		self.assertStatus(413, self.services(limit + 1) + ['not a service'])
+
+	def test_too_many_names(self):
+		# rejected before any name is checked
+		self.assertStatus(413, ['not a service'] * (self.notary.MAX_BATCH_IDS + 1))
+
+
+class OverloadTestCases(NotaryServerTestCase):
+	"""Test that requests the notary can answer from memory are not turned away when the database is busy."""
+
+	MISSING = 'notary_http_missing.example.com:443,2'
+
+	def setUp(self):
+		self.notary = self.create_notary()
+		self.notary.negative_cache.set(self.MISSING, cache.NegativeCache.NO_DATA)
+		self.admitted = []
+		self.notary.run_admitted = self.overloaded
+
+	def overloaded(self, func, *args):
+		self.admitted.append(args)
+		raise self.notary.overloaded_error()
+
+	def test_negative_cache_answered_before_admission(self):
+		try:
+			self.notary.get_uncached_xml(self.MISSING, '2')
+			self.fail("Expected a 404")
+		except cherrypy.HTTPError as e:
+			self.assertEqual(e.status, 404)
+		self.assertEqual(self.admitted, [])
+		self.assertEqual(self.notary.negative_cache_hits.value, 1)
+
+	def test_other_services_are_shed(self):
+		self.assertRaises(notary_http.OverloadedError, self.notary.get_uncached_xml, self.SERVICE, '2')
+
+	def test_batch(self):
+		results = self.notary.get_xml_batch([self.MISSING, self.SERVICE])
+		self.assertEqual([(service, status) for (service, status, xml) in results],
+			[(self.MISSING, 404), (self.SERVICE, 503)])
+		# only the service that needs the database asked to be admitted
+		self.assertEqual([args[0] for args in self.admitted], [[self.SERVICE]])
+
+
+class WarmCacheTestCases(NotaryServerTestCase):
+	"""Test filling the cache with the most requested services on start-up."""
+
+	NOTARY_ARGS = ['--pycache', '10', '--warm-cache', '10']
+	MISSING = 'notary_http_missing.example.com:443,2'
+
+	def setUp(self):
+		self.notary = self.create_notary()
+		self.notary.get_hot_services = lambda limit: [self.SERVICE, self.MISSING]
+		self.notary.negative_cache.set(self.MISSING, cache.NegativeCache.NO_DATA)
+		self.notary.RETRY_AFTER = 0
+		self.admitted = []
+		self.shed = 1
+		self.run_admitted = self.notary.run_admitted
+		self.notary.run_admitted = self.admit
+
+	def admit(self, func, *args):
+		"""Turn away the first 'shed' jobs, then run the rest."""
+		self.admitted.append(list(args[0]))
+		if (len(self.admitted) <= self.shed):
+			raise self.notary.overloaded_error()
+		return self.run_admitted(func, *args)
+
+	def test_waits_for_admission(self):
+		self.notary.warm_cache()
+		# the batch was tried again once it could be admitted, without the service known to have no data
+		self.assertEqual(self.admitted, [[self.SERVICE], [self.SERVICE]])
+		self.assertNotEqual(self.notary.cache.get(self.SERVICE), None)
+		self.assertEqual(self.notary.negative_cache_hits.value, 0)
+
+	def test_cached_services_skipped(self):
+		self.notary.calculate_service_xml(self.SERVICE, '2')
+		self.notary.warm_cache()
+		self.assertEqual(self.admitted, [])
+
+
+class NegativeCacheTestCases(unittest.TestCase):
+	"""Test the negative cache."""
+
+	def test_set_and_get(self):
+		neg = cache.NegativeCache(ttl=60)
+		self.assertEqual(neg.get('neg.example.com:443,2'), None)
+		neg.set('neg.example.com:443,2', cache.NegativeCache.SCAN_IN_PROGRESS)
+		self.assertEqual(neg.get('neg.example.com:443,2'), cache.NegativeCache.SCAN_IN_PROGRESS)
+		neg.set('neg.example.com:443,2', cache.NegativeCache.SCAN_FAILED)
+		self.assertEqual(neg.get('neg.example.com:443,2'), cache.NegativeCache.SCAN_FAILED)
+		self.assertEqual(neg.count(), 1)
+
+	def test_remove(self):
+		neg = cache.NegativeCache(ttl=60)
+		neg.set('neg.example.com:443,2', cache.NegativeCache.NO_DATA)
+		neg.remove('neg.example.com:443,2')
+		self.assertEqual(neg.get('neg.example.com:443,2'), None)
+		# removing a service that isn't there is fine
+		neg.remove('neg.example.com:443,2')
+
+	def test_entry_expires(self):
+		neg = cache.NegativeCache(ttl=1)
+		neg.set('neg.example.com:443,2', cache.NegativeCache.NO_DATA)
+		time.sleep(1.1)
+		self.assertEqual(neg.get('neg.example.com:443,2'), None)
+		self.assertEqual(neg.count(), 0)
+
+	def test_zero_ttl_disables(self):
+		neg = cache.NegativeCache(ttl=0)
+		neg.set('neg.example.com:443,2', cache.NegativeCache.NO_DATA)
+		self.assertEqual(neg.get('neg.example.com:443,2'), None)
+
+	def test_oldest_entries_removed_when_full(self):
+		neg = cache.NegativeCache(ttl=60, max_entries=3)
+		for i in range(5):
+			neg.set('neg%d.example.com:443,2' % i, cache.NegativeCache.NO_DATA)
+		self.assertEqual(neg.count(), 3)
+		self.assertEqual(neg.get('neg0.example.com:443,2'), None)
+		self.assertEqual(neg.get('neg1.example.com:443,2'), None)
+		self.assertEqual(neg.get('neg4.example.com:443,2'), cache.NegativeCache.NO_DATA)
+
+
+class HotKeysTestCases(unittest.TestCase):
+	"""Test counting and saving the most requested keys."""
+
+	TEST_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'hot_keys.unit_test.txt')
+
+	def tearDown(self):
+		if (os.path.exists(self.TEST_FILE)):
+			os.remove(self.TEST_FILE)
+
+	def test_top(self):
+		hot = cache.HotKeys()
+		for key in ['a', 'b', 'b', 'c', 'c', 'c']:
+			hot.record(key)
+		self.assertEqual(hot.top(2), ['c', 'b'])
+
+	def test_forget_least_requested(self):
+		hot = cache.HotKeys(4)
+		for key in ['a', 'a', 'b', 'b', 'c', 'd', 'e']:
+			hot.record(key)
+		self.assertEqual(sorted(hot.top(10)), ['a', 'b'])
+
+	def test_save_and_load(self):
+		hot = cache.HotKeys()
+		for key in ['a', 'b', 'b', 'c', 'c', 'c']:
+			hot.record(key)
+		hot.save(self.TEST_FILE, 10)
+		self.assertEqual(cache.HotKeys.load(self.TEST_FILE, 10), ['c', 'b', 'a'])
+		self.assertEqual(cache.HotKeys.load(self.TEST_FILE, 2), ['c', 'b'])
+
+	def test_load_missing_file(self):
+		self.assertEqual(cache.HotKeys.load(self.TEST_FILE, 10), [])
+
+
+class SingleFlightTestCases(unittest.TestCase):
+	"""Test coalescing of concurrent calls."""
+
+	class DictCache(cache.CacheBase):
+		"""A cache that supports add(), kept in a dictionary."""
+		def __init__(self):
+			self.values = {}
+		def get(self, key):
+			return self.values.get(key)
+		def set(self, key, data, expiry):
+			self.values[key] = data
+		def add(self, key, data, expiry):
+			if (key in self.values):
+				return False
+			self.values[key] = data
+			return True
+		def delete(self, key):
+			self.values.pop(key, None)
+
+	def setUp(self):
+		self.calls = 0
+
+	def slow_func(self, value, delay=0.2):
+		self.calls += 1
+		time.sleep(delay)
+		return value
+
+	def run_threads(self, count, target):
+		threads = [threading.Thread(target=target) for i in range(count)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+
+	def test_concurrent_calls_share_one_result(self):
+		flight = cache.SingleFlight(5)
+		results = []
+		self.run_threads(5, lambda: results.append(flight.do('key', self.slow_func, 'value')))
+		self.assertEqual(self.calls, 1)
+		self.assertEqual(results, ['value'] * 5)
+		self.assertEqual(flight.calls, {})
+
+	def test_errors_are_shared(self):
+		flight = cache.SingleFlight(5)
+		errors = []
+		def fail():
+			self.calls += 1
+			time.sleep(0.2)
+			raise ValueError('no data')
+		def call():
+			try:
+				flight.do('key', fail)
+			except ValueError as e:
+				errors.append(e)
+		self.run_threads(3, call)
+		self.assertEqual(self.calls, 1)
+		self.assertEqual(len(errors), 3)
+
+	def test_waiters_give_up_after_timeout(self):
+		flight = cache.SingleFlight(0.05)
+		self.run_threads(2, lambda: flight.do('key', self.slow_func, 'value', 0.5))
+		self.assertEqual(self.calls, 2)
+
+	def test_zero_timeout_disables(self):
+		flight = cache.SingleFlight(0)
+		self.run_threads(3, lambda: flight.do('key', self.slow_func, 'value'))
+		self.assertEqual(self.calls, 3)
+
+	def test_shared_cache_waits_for_other_process(self):
+		shared = self.DictCache()
+		flight = cache.SingleFlight(5, shared)
+		# pretend another process is building the value
+		shared.add('key' + flight.LOCK_SUFFIX, "1", 5)
+		threading.Timer(0.2, shared.set, ['key', 'their value', 60]).start()
+		self.assertEqual(flight.do('key', self.slow_func, 'our value'), 'their value')
+		self.assertEqual(self.calls, 0)
+
+	def test_shared_lock_released(self):
+		shared = self.DictCache()
+		flight = cache.SingleFlight(5, shared)
+		self.assertEqual(flight.do('key', self.slow_func, 'value', 0), 'value')
+		self.assertEqual(shared.get('key' + flight.LOCK_SUFFIX), None)
+
+
+class ScanQueueTestCases(unittest.TestCase):
+	"""Test the on-demand scan queue."""
+
+	def setUp(self):
+		self.scanned = []
+		self.release = threading.Event()
+		self.done = threading.Event()
+
+	def scan(self, service):
+		if (service == 'block'):
+			self.release.wait(5)
+		elif (service == 'fail'):
+			raise ValueError('scan failed')
+		self.scanned.append(service)
+		if (service == 'last'):
+			self.done.set()
+
+	def test_most_requested_scanned_first(self):
+		queue = ScanQueue(self.scan, 1, 10)
+		queue.add('block')
+		# wait for the worker to take 'block' off the queue
+		while (queue.stats()['scanning'] == 0):
+			time.sleep(0.01)
+		for service in ['once', 'thrice', 'twice', 'thrice', 'twice', 'thrice']:
+			queue.add(service)
+		queue.add('last')
+		self.release.set()
+		self.assertTrue(self.done.wait(5))
+		self.assertEqual(self.scanned, ['block', 'thrice', 'twice', 'once', 'last'])
+
+	def test_services_are_queued_once(self):
+		queue = ScanQueue(self.scan, 1, 10)
+		queue.add('block')
+		while (queue.stats()['scanning'] == 0):
+			time.sleep(0.01)
+		# adding a service that is being scanned does nothing
+		self.assertTrue(queue.add('block'))
+		for i in range(3):
+			self.assertTrue(queue.add('a'))
+		stats = queue.stats()
+		self.assertEqual(stats['queued'], 1)
+		self.assertEqual(stats['scanning'], 1)
+		self.assertEqual(stats['added'], 2)
+		self.release.set()
+
+	def test_full_queue_drops_new_services(self):
+		queue = ScanQueue(self.scan, 1, 2)
+		queue.add('block')
+		while (queue.stats()['scanning'] == 0):
+			time.sleep(0.01)
+		self.assertTrue(queue.add('a'))
+		self.assertTrue(queue.add('b'))
+		self.assertFalse(queue.add('c'))
+		# services already queued can still be requested again
+		self.assertTrue(queue.add('a'))
+		self.assertEqual(queue.stats()['dropped'], 1)
+		self.release.set()
+
+	def test_errors_do_not_stop_workers(self):
+		queue = ScanQueue(self.scan, 1, 10)
+		queue.add('fail')
+		queue.add('last')
+		self.assertTrue(self.done.wait(5))
+		self.assertEqual(self.scanned, ['last'])
+		while (queue.stats()['completed'] < 2):
+			time.sleep(0.01)
+
+	def test_workers_start_when_needed(self):
+		queue = ScanQueue(self.scan, 3, 10)
+		self.assertEqual(queue.threads, [])
+		queue.add('last')
+		self.assertEqual(len(queue.threads), 3)
+		self.assertTrue(self.done.wait(5))
+
+
+class LoadShedderTestCases(unittest.TestCase):
+	"""Test admission control for requests that need the database."""
+
+	def setUp(self):
+		self.changes = []
+
+	def changed(self, shedding, stats):
+		self.changes.append((shedding, stats['shed']))
+
+	def test_disabled_admits_everything(self):
+		shedder = LoadShedder(0, 0)
+		with shedder.admit():
+			with shedder.admit():
+				pass
+		self.assertEqual(shedder.stats()['in_flight'], 0)
+
+	def test_sheds_when_full(self):
+		shedder = LoadShedder(1, 0.05, self.changed)
+		shedder.RECOVERY_PERIOD = 0
+		with shedder.admit():
+			start = time.time()
+			with self.assertRaises(Overloaded):
+				with shedder.admit():
+					pass
+			# waited for a slot before giving up
+			self.assertTrue(time.time() - start >= 0.04)
+			stats = shedder.stats()
+			self.assertTrue(stats['shedding'])
+			self.assertEqual(stats['in_flight'], 1)
+			self.assertEqual(stats['shed'], 1)
+		self.assertEqual(self.changes, [(True, 1)])
+
+		# a slot is free again, so the next job runs and shedding stops
+		with shedder.admit():
+			pass
+		stats = shedder.stats()
+		self.assertFalse(stats['shedding'])
+		self.assertEqual(stats['admitted'], 2)
+		self.assertEqual(stats['in_flight'], 0)
+		self.assertEqual(self.changes, [(True, 1), (False, 1)])
+
+	def test_waiting_job_is_admitted_when_slot_frees(self):
+		shedder = LoadShedder(1, 5, self.changed)
+		started = threading.Event()
+		release = threading.Event()
+
+		def hold():
+			with shedder.admit():
+				started.set()
+				release.wait(5)
+
+		t = threading.Thread(target=hold)
+		t.start()
+		self.assertTrue(started.wait(5))
+		threading.Timer(0.05, release.set).start()
+		with shedder.admit():
+			pass
+		t.join()
+		stats = shedder.stats()
+		self.assertEqual(stats['admitted'], 2)
+		self.assertEqual(stats['shed'], 0)
+		self.assertTrue(stats['average_wait'] > 0)
+		self.assertEqual(self.changes, [])
+
+	def test_slot_freed_after_exception(self):
+		shedder = LoadShedder(1, 0)
+		with self.assertRaises(ValueError):
+			with shedder.admit():
+				raise ValueError('query failed')
+		with shedder.admit():
+			pass
+		self.assertEqual(shedder.stats()['shed'], 0)
+
+	def test_keeps_shedding_until_recovered(self):
+		shedder = LoadShedder(1, 0, self.changed)
+		with shedder.admit():
+			with self.assertRaises(Overloaded):
+				with shedder.admit():
+					pass
+		# admitted, but too soon after the last request was shed to report that we recovered
+		with shedder.admit():
+			pass
+		self.assertTrue(shedder.stats()['shedding'])
+		self.assertEqual(self.changes, [(True, 1)])
+
+
+class MetricsRegistryTestCases(unittest.TestCase):
+	"""Test the in-memory metrics served at /metrics."""
+
+	def setUp(self):
+		self.registry = metrics_registry.Registry()
+
+	def test_counter(self):
+		counter = self.registry.counter('test_total', "Things counted.")
+		counter.inc()
+		counter.inc(2)
+		self.assertEqual(counter.get(), 3)
+		self.assertEqual(self.registry.render(),
+			"# HELP test_total Things counted.\n# TYPE test_total counter\ntest_total 3\n")
+
+	def test_gauge_from_function(self):
+		values = [5]
+		self.registry.gauge('test_length', "A queue.", lambda: values[0])
+		self.registry.gauge('test_on', "A flag.", lambda: True)
+		values[0] = 7
+		text = self.registry.render()
+		self.assertTrue("# TYPE test_length gauge\ntest_length 7\n" in text)
+		self.assertTrue("test_on 1\n" in text)
+
+	def test_histogram(self):
+		histogram = self.registry.histogram('test_seconds', "Timings.", (0.1, 1))
+		histogram.observe(0.05)
+		histogram.observe(0.1)
+		histogram.observe(0.5)
+		histogram.observe(3)
+		lines = self.registry.render().splitlines()
+		self.assertEqual(lines[2:], [
+			'test_seconds_bucket{le="0.1"} 2',
+			'test_seconds_bucket{le="1"} 3',
+			'test_seconds_bucket{le="+Inf"} 4',
+			'test_seconds_sum 3.65',
+			'test_seconds_count 4'])
+
+	def test_histogram_time(self):
+		histogram = self.registry.histogram('test_seconds', "Timings.")
+		with self.assertRaises(ValueError):
+			with histogram.time():
+				raise ValueError('failed')
+		self.assertEqual(histogram.samples()[-1], ('test_seconds_count', "", 1))
+
+	def test_labelled_histograms(self):
+		self.registry.histogram('test_seconds', "Timings.", (1,), {'phase': 'a'}).observe(0.5)
+		self.registry.histogram('test_seconds', "Timings.", (1,), {'phase': 'b'})
+		self.assertEqual(self.registry.render().splitlines(), [
+			'# HELP test_seconds Timings.',
+			'# TYPE test_seconds histogram',
+			'test_seconds_bucket{phase="a",le="1"} 1',
+			'test_seconds_bucket{phase="a",le="+Inf"} 1',
+			'test_seconds_sum{phase="a"} 0.5',
+			'test_seconds_count{phase="a"} 1',
+			'test_seconds_bucket{phase="b",le="1"} 0',
+			'test_seconds_bucket{phase="b",le="+Inf"} 0',
+			'test_seconds_sum{phase="b"} 0.0',
+			'test_seconds_count{phase="b"} 0'])
+		with self.assertRaises(ValueError):
+			self.registry.histogram('test_seconds', "Timings.", (1,), {'phase': 'a'})
+
+	def test_names_are_unique(self):
+		self.registry.counter('test_total', "Things counted.")
+		with self.assertRaises(ValueError):
+			self.registry.gauge('test_total', "Something else.")
+
+
+class TracerTestCases(unittest.TestCase):
+	"""Test timing the phases of sampled requests."""
+
+	def setUp(self):
+		self.registry = metrics_registry.Registry()
+		self.slow_log = StringIO.StringIO()
+
+	def test_sampling(self):
+		tracer = tracing.Tracer(3)
+		traces = [tracer.start('index') for i in range(6)]
+		self.assertEqual([trace != None for trace in traces], [True, False, False, True, False, False])
+		self.assertEqual(tracing.Tracer(0).start('index'), None)
+
+	def test_phases_are_recorded_for_active_trace(self):
+		tracer = tracing.Tracer(1, 0, self.slow_log, self.registry)
+		with tracer.phase('ignored'):
+			pass
+		trace = tracer.start('index')
+		with tracer.activate(trace):
+			with tracer.phase('db_query'):
+				pass
+			for i in range(2):
+				with tracer.phase('signing'):
+					pass
+		with tracer.phase('ignored'):
+			pass
+		self.assertEqual([(name, count) for (name, seconds, count) in trace.totals()],
+			[('db_query', 1), ('signing', 2)])
+
+		trace.finish()
+		line = self.slow_log.getvalue()
+		self.assertTrue(" index total=" in line)
+		self.assertTrue(" db_query=" in line)
+		self.assertTrue(" signing=" in line and "ms/2 " in line)
+		self.assertFalse("ignored" in line)
+		text = self.registry.render()
+		self.assertTrue('notary_request_phase_seconds_count{phase="total"} 1' in text)
+		self.assertTrue('notary_request_phase_seconds_count{phase="signing"} 1' in text)
+
+	def test_fast_requests_are_not_logged(self):
+		tracer = tracing.Tracer(1, 10, self.slow_log)
+		tracer.start('index').finish()
+		self.assertEqual(self.slow_log.getvalue(), "")
+
+	def test_histogram_is_always_observed(self):
+		tracer = tracing.Tracer(0)
+		histogram = self.registry.histogram('test_seconds', "Timings.")
+		with tracer.phase('signing', histogram):
+			pass
+		self.assertEqual(histogram.samples()[-1][2], 1)
+
+	def test_wrap_runs_on_other_threads(self):
+		tracer = tracing.Tracer(1)
+		trace = tracer.start('batch')
+		def work():
+			with tracer.phase('db_query'):
+				pass
+		t = threading.Thread(target=tracer.wrap(trace, work))
+		t.start()
+		t.join()
+		self.assertEqual([name for (name, seconds, count) in trace.totals()], ['db_query'])
+		self.assertEqual(tracer.wrap(None, work), work)
+
+
+class SyntheticDataTestCases(unittest.TestCase):
+	"""Test generating synthetic observation data."""
+
+	NOW = 1400000000
+	DAY = 24 * 3600
+
+	def test_distributions(self):
+		rng = random.Random(1)
+		self.assertEqual(set(Distribution('3').sample(rng) for i in range(20)), set([3]))
+		self.assertEqual(set(Distribution('1-3').sample(rng) for i in range(200)), set([1, 2, 3]))
+		samples = [Distribution('1:90,5:10').sample(rng) for i in range(1000)]
+		self.assertEqual(set(samples), set([1, 5]))
+		self.assertTrue(800 < samples.count(1) < 980)
+		for spec in ['', 'x', '1:x', '-1', '1:0', '3-1']:
+			with self.assertRaises(ValueError):
+				Distribution(spec)
+
+	def test_shape(self):
+		data = SyntheticData(keys='3', timespans='2', rotation_days='10', seed=1, now=self.NOW)
+		obs = data.observations('shape:443,2')
+		self.assertEqual(len(obs), 6)
+		self.assertEqual(len(set(key for (service, key, start, end) in obs)), 3)
+		self.assertEqual(max(end for (service, key, start, end) in obs), self.NOW)
+		for (service, key, start, end) in obs:
+			self.assertTrue(0 <= start <= end)
+
+		# keys are used one after the other, each for its rotation period
+		by_key = {}
+		for (service, key, start, end) in obs:
+			by_key.setdefault(key, []).append((start, end))
+		spans = sorted((min(s for (s, e) in times), max(e for (s, e) in times)) for times in by_key.values())
+		for (start, end) in spans:
+			self.assertEqual(end - start, 10 * self.DAY)
+		for (earlier, later) in zip(spans, spans[1:]):
+			self.assertTrue(earlier[1] < later[0])
+
+	def test_same_seed_same_data(self):
+		services = service_names(5)
+		first = [SyntheticData(seed=7, now=self.NOW).observations(s) for s in services]
+		second = [SyntheticData(seed=7, now=self.NOW).observations(s) for s in services]
+		self.assertEqual(first, second)
+
+	def test_tuple_file(self):
+		out = StringIO.StringIO()
+		written = SyntheticData(keys='0:1,1:1', seed=1, now=self.NOW).write_tuples(out, service_names(20))
+		lines = out.getvalue().splitlines()
+		self.assertEqual(len([line for line in lines if 'None' not in line]), written)
+		self.assertTrue("(synthetic0.example.com:443,2, " in lines[0])
+		self.assertTrue(any(line.endswith(", None, None, None)") for line in lines))
+
+
+class HyperLogLogTestCases(unittest.TestCase):
+	"""Test counting distinct services with HyperLogLog sketches."""
+
+	def test_small_counts_are_exact(self):
+		sketch = HyperLogLog()
+		self.assertEqual(sketch.count(), 0)
+		for service in ['a.com:443,2', 'b.com:443,2', 'a.com:443,2', u'c.com:443,2']:
+			sketch.add(service)
+		self.assertEqual(sketch.count(), 3)
+
+	def test_large_count_is_close(self):
+		sketch = HyperLogLog()
+		for i in range(20000):
+			sketch.add('service%d.com:443,2' % i)
+		self.assertTrue(abs(sketch.count() - 20000) < 20000 * 0.1)
+
+	def test_merge(self):
+		(a, b) = (HyperLogLog(), HyperLogLog())
+		for i in range(3000):
+			a.add(str(i))
+			b.add(str(i + 1500))
+		a.merge(b)
+		self.assertTrue(abs(a.count() - 4500) < 4500 * 0.1)
+		with self.assertRaises(ValueError):
+			a.merge(HyperLogLog(8))
+
+	def test_to_string(self):
+		sketch = HyperLogLog(6)
+		for i in range(100):
+			sketch.add(str(i))
+		copy = HyperLogLog.from_string(sketch.to_string())
+		self.assertEqual(copy.precision, 6)
+		self.assertEqual(copy.registers, sketch.registers)
+
+
 class PyCacheTestCases(unittest.TestCase):
 	"""Test the pycache module."""
 
-	#TODO: add test cases for underlying logic and classes. e.g. the Heap class.
-
 	def setUp(self):
 		"""Make sure the cache is fresh or was cleared after the last test."""
 		self.cache = pycache
@@ -80,6 +1432,17 @@ class PyCacheTestCases(unittest.TestCase):
 		"""Helper function."""
 		self.cache.set(key, value, expiry)
 
+	def test_get_ttl(self):
+		self.cache.set_cache_size(1024)
+		self.assertEqual(self.cache.get_ttl('ttl_key'), None)
+		self.set_key('ttl_key', 'val', 100)
+		ttl = self.cache.get_ttl('ttl_key')
+		self.assertTrue(99 <= ttl <= 100)
+
+		self.set_key('ttl_expired_key', 'val', 1)
+		time.sleep(2)
+		self.assertEqual(self.cache.get_ttl('ttl_expired_key'), None)
+
 	def test_added_key_uses_memory(self):
 		self.cache.set_cache_size(1024)
 		mem_before = self.cache.get_cache_size()
@@ -136,6 +1499,15 @@ class PyCacheTestCases(unittest.TestCase):
 		self.assertTrue(mem_after == mem_before == 0)
 		self.assertTrue(count_after == count_before == 0)
 
+	def test_get_multi(self):
+		self.cache.set_cache_size(1024)
+		self.set_key('multi_a', 'a', 100)
+		self.set_key('multi_b', 'b', 100)
+		ram_cache = cache.Pycache('1')
+		self.assertEqual(ram_cache.get_multi(['multi_a', 'multi_b', 'multi_c']),
+			{'multi_a': 'a', 'multi_b': 'b'})
+		self.assertEqual(ram_cache.get_multi([]), {})
+
 	def test_entry_removed_after_expiry(self):
 		self.cache.set_cache_size(1024)
 		key = 'test_key'
@@ -144,6 +1516,63 @@ class PyCacheTestCases(unittest.TestCase):
 		time.sleep(expiry * 2)
 		value = self.cache.get(key)
 		self.assertTrue(value == None)
+		self.assertEqual(self.cache.get_cache_count(), 0)
+		self.assertEqual(self.cache.get_cache_size(), 0)
+
+	def test_least_recently_used_evicted_first(self):
+		entry_size = pycache.CacheEntry('lru_0', 'v' * 100, 100).memory_used
+		self.cache.set_cache_size(entry_size * 3)
+		for key in ['lru_0', 'lru_1', 'lru_2']:
+			self.set_key(key, 'v' * 100, 100)
+		# reading lru_0 makes lru_1 the least recently used
+		self.assertEqual(self.cache.get('lru_0'), 'v' * 100)
+		self.set_key('lru_3', 'v' * 100, 100)
+		self.assertEqual(self.cache.get('lru_1'), None)
+		for key in ['lru_0', 'lru_2', 'lru_3']:
+			self.assertEqual(self.cache.get(key), 'v' * 100)
+		self.assertEqual(self.cache.get_cache_count(), 3)
+
+	def test_replacing_key_keeps_one_entry(self):
+		self.cache.set_cache_size(1024)
+		self.set_key('replace_key', 'a', 100)
+		self.set_key('replace_key', 'a much longer value', 100)
+		self.assertEqual(self.cache.get_cache_count(), 1)
+		self.assertEqual(self.cache.get_cache_size(),
+			pycache.CacheEntry('replace_key', 'a much longer value', 100).memory_used)
+		self.assertEqual(self.cache.get('replace_key'), 'a much longer value')
+
+	def test_reads_do_not_grow_the_cache(self):
+		self.cache.set_cache_size(1024 * 1024)
+		for i in range(10):
+			self.set_key('read_%d' % i, 'val', 100)
+		for i in range(10000):
+			self.cache.get('read_%d' % (i % 10))
+		self.assertEqual(self.cache.get_cache_count(), 10)
+		self.assertEqual(len(pycache.cache), 10)
+
+	def test_contention(self):
+		keys = ['contended_%d' % i for i in range(200)]
+		self.cache.set_cache_size(pycache.CacheEntry(keys[0], 'v' * 100, 100).memory_used * 50)
+		errors = []
+
+		def worker(seed):
+			rng = random.Random(seed)
+			try:
+				for i in range(2000):
+					key = rng.choice(keys)
+					if (self.cache.get(key) == None):
+						self.set_key(key, 'v' * 100, 100)
+			except Exception as e:
+				errors.append(e)
+
+		threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(4)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(errors, [])
+		self.assertTrue(self.cache.get_cache_count() <= 50)
+		self.assertEqual(self.cache.get_cache_size(), sum(entry.memory_used for entry in pycache.cache.values()))
 
 
 
@@ -197,6 +1626,7 @@ class NotaryDBTestCases(unittest.TestCase):
 		try:
 			self.ndb.report_metric('CacheHit')
 			self.ndb.report_metric('SomeEventNotInTheDatabase')
+			self.ndb.metrics_writer.flush()
 		finally:
 			self.ndb.metricsdb = orig
 
@@ -414,6 +1844,196 @@ class NotaryDBTestCases(unittest.TestCase):
 		# so long as callers use report_obseration() instead of _insert_observation()
 		# no invalid data will be put into the database.
 
+	def test_get_observations_for_services(self):
+		services = ['obs_for_services_1:443,2', 'obs_for_services_2:443,2', 'obs_for_services_3:443,2']
+		self.ndb._insert_observation(services[0], 'aa:bb', 1, 2)
+		self.ndb._insert_observation(services[0], 'aa:bb', 3, 4)
+		self.ndb._insert_observation(services[1], 'cc:dd', 1, 2)
+
+		with self.ndb.get_session() as session:
+			obs = list(self.ndb.get_observations_for_services(session, services))
+		self.assertEqual(len(obs), 3)
+		self.assertEqual(sorted(set(ob[0] for ob in obs)), services[:2])
+
+		with self.ndb.get_session() as session:
+			self.assertEqual(list(self.ndb.get_observations_for_services(session, [])), [])
+
+	def test_get_signed_responses(self):
+		services = ['signed_responses_1:443,2', 'signed_responses_2:443,2', 'signed_responses_3:443,2']
+		self.ndb.insert_bulk_services(services)
+		self.ndb.store_signed_response(services[0], '<notary_reply/>', 'fingerprint')
+		self.ndb.store_signed_response(services[1], '<notary_reply/>', 'other fingerprint')
+		self.assertEqual(self.ndb.get_signed_responses(services, 'fingerprint'), {services[0]: '<notary_reply/>'})
+
+		self.ndb.delete_signed_responses(services)
+		self.assertEqual(self.ndb.get_signed_responses(services, 'fingerprint'), {})
+		self.assertEqual(self.ndb.get_signed_responses(services, 'other fingerprint'), {})
+		self.ndb.delete_signed_responses([])
+
+	def test_signed_response(self):
+		service = 'signed_response_test:443,2'
+		xml = '<notary_reply sig="abc"/>'
+		fingerprint = 'fingerprint'
+
+		# a service with no stored reply should return nothing
+		self.assertTrue(self.ndb.get_signed_response(service, fingerprint) == None)
+
+		# replies can only be stored for known services
+		self.ndb.store_signed_response(service, xml, fingerprint)
+		self.assertTrue(self.ndb.get_signed_response(service, fingerprint) == None)
+
+		with self.ndb.get_session() as session:
+			self.ndb.insert_service(session, service)
+		self.ndb.store_signed_response(service, xml, fingerprint)
+		self.assertTrue(self.ndb.get_signed_response(service, fingerprint) == xml)
+
+		# replies signed with a different key should not be returned
+		self.assertTrue(self.ndb.get_signed_response(service, 'other fingerprint') == None)
+
+		# storing again should replace the previous reply
+		self.ndb.store_signed_response(service, xml + ' ', fingerprint)
+		self.assertTrue(self.ndb.get_signed_response(service, fingerprint) == xml + ' ')
+
+		# reporting an observation leaves the stored reply for the caller to remove
+		self.ndb.report_observation(service, 'aa:bb')
+		self.assertTrue(self.ndb.get_signed_response(service, fingerprint) == xml + ' ')
+		self.ndb.delete_signed_response(service)
+		self.assertTrue(self.ndb.get_signed_response(service, fingerprint) == None)
+
+		# deleting a reply that does not exist should be ignored
+		self.ndb.delete_signed_response(service)
+
+	def test_store_service_replies(self):
+		from M2Crypto import BIO, RSA
+		rsa = RSA.gen_key(1024, 65537, lambda *args: None)
+		bio = BIO.MemoryBuffer()
+		rsa.save_key_bio(bio, cipher=None)
+		signer = crypto.Signer(bio.read())
+
+		services = ['store_replies_1:443,2', 'store_replies_2:443,2', 'store_replies_none:443,2']
+		self.ndb._insert_observation(services[0], 'aa:bb', 1, 2)
+		self.ndb._insert_observation(services[0], 'cc:dd', 3, 4)
+		self.ndb._insert_observation(services[1], 'ee:ff', 5, 6)
+
+		self.assertEqual(notary_reply.store_service_replies(self.ndb, services, signer), 2)
+		self.assertEqual(self.ndb.get_signed_response(services[2], signer.fingerprint), None)
+
+		# replies must match those built one at a time
+		for service in services[:2]:
+			stored = self.ndb.get_signed_response(service, signer.fingerprint)
+			self.assertEqual(stored, notary_reply.store_service_reply(self.ndb, service, signer))
+
+	def test_get_most_requested_services(self):
+		# use dates far in the future, so metrics from other tests are not counted
+		since = 4000000000
+		requests = [('GetObservationsForService', 'hot_1:443,2'), ('CacheHit', 'hot_1:443,2'),
+			('CacheHit', 'hot_1:443,2'), ('GetObservationsForService', 'hot_2:443,2'),
+			('CacheHit', 'hot_2:443,2'), ('GetObservationsForService', 'hot_3:443,2'),
+			('CacheMiss', 'hot_3:443,2'), ('CacheMiss', 'hot_3:443,2'), ('ScanForNewService', 'hot_3:443,2')]
+		with self.ndb.get_session() as session:
+			for (event_type, service) in requests:
+				session.add(notary_db.Metrics(event_type_id=self.ndb.EVENT_TYPES[event_type],
+					date=since + 1, comment=service))
+			session.add(notary_db.Metrics(event_type_id=self.ndb.EVENT_TYPES['CacheHit'],
+				date=since - 1, comment='hot_old:443,2'))
+			session.commit()
+
+		self.assertEqual(self.ndb.get_most_requested_services(10, since), ['hot_1:443,2', 'hot_2:443,2', 'hot_3:443,2'])
+		self.assertEqual(self.ndb.get_most_requested_services(1, since), ['hot_1:443,2'])
+
+	def test_metrics_writer(self):
+		# a long flush interval, so only our own flush() writes
+		writer = notary_db.MetricsWriter(self.ndb.db, 60, 2, self.ndb.EVENT_TYPES)
+		event_type_id = self.ndb.EVENT_TYPES['ServiceScanStop']
+		comments = ['writer_1', 'writer_2', 'writer_3', 'writer_3', 'writer_4', 'writer_5']
+		for comment in comments:
+			writer.add(event_type_id, comment)
+		writer.add(self.ndb.EVENT_TYPES['ServiceScanStart'], 'writer_6')
+		# two are buffered, the rest are dropped and counted
+		self.assertEqual(len(writer.events), 2)
+		self.assertEqual(writer.dropped, {event_type_id: 4, self.ndb.EVENT_TYPES['ServiceScanStart']: 1})
+
+		# the buffered events, and one row for each type of event dropped
+		self.assertEqual(writer.flush(), 4)
+		self.assertEqual(writer.flush(), 0)
+		dropped_type_id = self.ndb.EVENT_TYPES['MetricsDropped']
+		with self.ndb.get_session() as session:
+			written = [m.comment for m in session.query(notary_db.Metrics).filter(
+				notary_db.Metrics.comment.in_(comments)).filter(
+				notary_db.Metrics.event_type_id == event_type_id)]
+			dropped = [m.comment for m in session.query(notary_db.Metrics).filter(
+				notary_db.Metrics.event_type_id == dropped_type_id)]
+		self.assertEqual(sorted(written), ['writer_1', 'writer_2'])
+		self.assertEqual(sorted(dropped), ['ServiceScanStart 1', 'ServiceScanStop 4'])
+		with self.ndb.get_session() as session:
+			session.query(notary_db.Metrics).filter(notary_db.Metrics.comment.in_(comments)).delete(
+				synchronize_session=False)
+			session.query(notary_db.Metrics).filter(notary_db.Metrics.event_type_id == dropped_type_id).delete(
+				synchronize_session=False)
+			session.commit()
+
+	def test_rollup_metrics(self):
+		# use dates far in the future, after the metrics from other tests
+		base = 4100000000 - (4100000000 % 3600)
+		events = [(base, 'CacheHit', 'rollup_1:443,2'), (base + 1, 'CacheHit', 'rollup_1:443,2'),
+			(base + 2, 'CacheHit', 'rollup_2:443,2'), (base + 3, 'GetObservationsForService', 'rollup_3:443,2'),
+			(base + 3600, 'CacheMiss', 'rollup_1:443,2'), (base + 3600, 'LoadSheddingStart', 'MaxDBRequests: 1'),
+			# not rolled up until its hour is over
+			(base + 7200, 'CacheHit', 'rollup_4:443,2')]
+		def add_events(events):
+			with self.ndb.get_session() as session:
+				for (date, event_type, comment) in events:
+					session.add(notary_db.Metrics(event_type_id=self.ndb.EVENT_TYPES[event_type],
+						date=date, comment=comment))
+				session.commit()
+		add_events(events)
+
+		# overflow a writer during the first hour: one event is written and two are dropped
+		class Clock(object):
+			sleep = staticmethod(time.sleep)
+			time = staticmethod(lambda: base + 5)
+		notary_db.time = Clock
+		try:
+			writer = notary_db.MetricsWriter(self.ndb.db, 60, 1, self.ndb.EVENT_TYPES)
+			for i in range(3):
+				writer.add(self.ndb.EVENT_TYPES['CacheHit'], 'rollup_1:443,2')
+			self.assertEqual(writer.flush(), 2)
+		finally:
+			notary_db.time = time
+
+		now = base + 7210
+		self.ndb.rollup_metrics(now)
+		hourly = self.ndb.get_hourly_metrics(base)
+		# dropped events are added to the totals for their type
+		self.assertEqual([(hour, event_type, count) for (hour, event_type, count, sketch) in hourly],
+			[(base, 'CacheHit', 6), (base, 'GetObservationsForService', 1), (base, 'MetricsDropped', 2),
+			(base + 3600, 'CacheMiss', 1), (base + 3600, 'LoadSheddingStart', 1)])
+		sketches = [sketch for (hour, event_type, count, sketch) in hourly]
+		self.assertEqual(sketches[0].count(), 2)
+		self.assertEqual(sketches[2], None)
+		self.assertEqual(sketches[3].count(), 1)
+		self.assertEqual(sketches[4], None)
+
+		# events written late to the newest rolled-up hour are counted when we roll up again
+		add_events([(base + 3601, 'CacheMiss', 'rollup_2:443,2')])
+		self.assertEqual(self.ndb.rollup_metrics(now), 1)
+		hourly = self.ndb.get_hourly_metrics(base + 3600, base + 7200)
+		self.assertEqual([(event_type, count, sketch and sketch.count()) for (hour, event_type, count, sketch) in hourly],
+			[('CacheMiss', 2, 2), ('LoadSheddingStart', 1, None)])
+
+		# raw events are only deleted once they will not be rolled up again
+		self.assertTrue(self.ndb.prune_metrics(0, now) >= 4)
+		with self.ndb.get_session() as session:
+			remaining = session.query(notary_db.Metrics).filter(notary_db.Metrics.date >= base).count()
+			self.assertEqual(remaining, 4)
+			self.assertEqual(session.query(notary_db.Metrics).filter(notary_db.Metrics.date < base).count(), 0)
+
+	def test_dispose_connections(self):
+		count = self.ndb.count_services()
+		self.ndb.dispose_connections()
+		# a new connection is opened when needed
+		self.assertEqual(self.ndb.count_services(), count)
+
 	# less important SQL - used less often or in the background
 	def test_count_services(self):
 		count = self.ndb.count_services()
@@ -435,6 +2055,27 @@ class NotaryDBTestCases(unittest.TestCase):
 		count_srv_after = self.ndb.count_services()
 		self.assertTrue(count_srv_before == (count_srv_after - len(services)))
 
+	def test_insert_bulk_observations(self):
+		services = ['bulk_obs_1:443,2', 'bulk_obs_2:443,2']
+		self.ndb.insert_bulk_services(services)
+		count_obs_before = self.ndb.count_observations()
+		added = self.ndb.insert_bulk_observations([(services[0], 'aa:bb', 1, 2), (services[0], 'aa:bb', 3, 4),
+			(services[1], 'cc:dd', 1, 2),
+			('bulk_obs_unknown:443,2', 'ee:ff', 1, 2), (services[1], 'cc:dd', 5, 4)])
+		self.assertEqual(added, 3)
+		self.assertEqual(self.ndb.count_observations(), count_obs_before + 3)
+		with self.ndb.get_session() as session:
+			self.assertEqual(sorted(list(self.ndb.get_observations(session, services[0]))),
+				[(services[0], 'aa:bb', 1, 2), (services[0], 'aa:bb', 3, 4)])
+		self.assertEqual(self.ndb.insert_bulk_observations([]), 0)
+
+	def test_fill_synthetic_data(self):
+		services = service_names(20, 1000000)
+		count_obs_before = self.ndb.count_observations()
+		added = SyntheticData(seed=1).fill_database(self.ndb, services)
+		self.assertTrue(added >= len(services))
+		self.assertEqual(self.ndb.count_observations(), count_obs_before + added)
+
 parser = argparse.ArgumentParser(description=__doc__)
 
 if __name__ == '__main__':
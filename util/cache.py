@@ -19,8 +19,13 @@ Cache and retrieve data in key-value pairs.
 """
 
 import abc
+import collections
+import errno
+import math
 import os
 import sys
+import threading
+import time
 
 
 class CacheBase(object):
@@ -56,6 +61,41 @@ class CacheBase(object):
 		"""Save the value to a given key name."""
 		raise NotImplementedError( "This is just the abstract base class - please use a class that inherits from CacheBase." )
 
+	def get_multi(self, keys):
+		"""
+		Retrieve the values for several keys at once.
+		Returns a dictionary containing only the keys that exist.
+		"""
+		# caches that can fetch many keys in one round trip should override this
+		found = {}
+		for key in keys:
+			value = self.get(key)
+			if (value != None):
+				found[key] = value
+		return found
+
+	# caches shared between processes should override add() and delete(),
+	# so they can be used to coordinate notary processes.
+
+	def add(self, key, data, expiry):
+		"""
+		Save the value to a given key name only if the key does not exist yet, as one atomic operation.
+		Returns True if the value was saved, False if the key already exists, or None on error.
+		"""
+		raise NotImplementedError( "This type of cache does not support add()." )
+
+	def delete(self, key):
+		"""Remove a key."""
+		raise NotImplementedError( "This type of cache does not support delete()." )
+
+	def get_ttl(self, key):
+		"""
+		Return the number of seconds until a key expires,
+		or None if the key does not exist or the cache cannot tell.
+		"""
+		# e.g. memcached has no command to read an entry's expiry
+		return None
+
 
 class Memcache(CacheBase):
 	"""
@@ -119,6 +159,22 @@ class Memcache(CacheBase):
 			print >> sys.stderr, "Cache does not exist! Create it first"
 			return None
 
+	def get_multi(self, keys):
+		"""
+		Retrieve the values for several keys at once.
+		Returns a dictionary containing only the keys that exist.
+		"""
+		if (self.pool != None):
+			with self.pool.reserve() as mc:
+				try:
+					return mc.get_multi([str(key) for key in keys])
+				except Exception as e:
+					print >> sys.stderr, "cache get_multi() error: '{0}'.".format(e)
+					return {}
+		else:
+			print >> sys.stderr, "Cache does not exist! Create it first"
+			return {}
+
 	def set(self, key, data, expiry=CacheBase.CACHE_EXPIRY):
 		"""Save the value to a given key name."""
 		if (self.pool != None):
@@ -130,6 +186,29 @@ class Memcache(CacheBase):
 		else:
 			print >> sys.stderr, "Cache does not exist! Create it first"
 
+	def add(self, key, data, expiry=CacheBase.CACHE_EXPIRY):
+		"""Save the value to a given key name only if the key does not exist yet."""
+		if (self.pool != None):
+			with self.pool.reserve() as mc:
+				try:
+					return mc.add(str(key), data, time=expiry)
+				except Exception as e:
+					print >> sys.stderr, "cache add() error: '{0}'.".format(e)
+		else:
+			print >> sys.stderr, "Cache does not exist! Create it first"
+		return None
+
+	def delete(self, key):
+		"""Remove a key."""
+		if (self.pool != None):
+			with self.pool.reserve() as mc:
+				try:
+					mc.delete(str(key))
+				except Exception as e:
+					print >> sys.stderr, "cache delete() error: '{0}'.".format(e)
+		else:
+			print >> sys.stderr, "Cache does not exist! Create it first"
+
 
 class Memcachier(Memcache):
 	"""
@@ -160,10 +239,22 @@ class Memcachier(Memcache):
 		"""Retrieve the value for a given key, or None if no key exists."""
 		return super(Memcachier, self).get(key)
 
+	def get_multi(self, keys):
+		"""Retrieve the values for several keys at once."""
+		return super(Memcachier, self).get_multi(keys)
+
 	def set(self, key, data, expiry):
 		"""Save the value to a given key name."""
 		return super(Memcachier, self).set(key, data, expiry)
 
+	def add(self, key, data, expiry):
+		"""Save the value to a given key name only if the key does not exist yet."""
+		return super(Memcachier, self).add(key, data, expiry)
+
+	def delete(self, key):
+		"""Remove a key."""
+		return super(Memcachier, self).delete(key)
+
 
 class Redis(CacheBase):
 	"""
@@ -209,6 +300,23 @@ class Redis(CacheBase):
 			print >> sys.stderr, "ERROR: Redis cache does not exist! Create it first"
 			return None
 
+	def get_multi(self, keys):
+		"""
+		Retrieve the values for several keys at once.
+		Returns a dictionary containing only the keys that exist.
+		"""
+		if (self.redis != None):
+			try:
+				keys = list(keys)
+				values = self.redis.mget(keys)
+				return dict((key, value) for (key, value) in zip(keys, values) if value != None)
+			except Exception, e:
+				print >> sys.stderr, "redis get_multi() error: '{0}'.".format(e)
+				return {}
+		else:
+			print >> sys.stderr, "ERROR: Redis cache does not exist! Create it first"
+			return {}
+
 	def set(self, key, data, expiry=CacheBase.CACHE_EXPIRY):
 		"""Save the value to a given key name."""
 		if (self.redis != None):
@@ -220,6 +328,42 @@ class Redis(CacheBase):
 		else:
 			print >> sys.stderr, "ERROR: Redis cache does not exist! Create it first"
 
+	def add(self, key, data, expiry=CacheBase.CACHE_EXPIRY):
+		"""Save the value to a given key name only if the key does not exist yet."""
+		if (self.redis != None):
+			try:
+				# SET with NX and EX sets the value and its expiry in one atomic command
+				return bool(self.redis.set(key, data, ex=expiry, nx=True))
+			except Exception, e:
+				print >> sys.stderr, "redis add() error: '{0}'.".format(e)
+		else:
+			print >> sys.stderr, "ERROR: Redis cache does not exist! Create it first"
+		return None
+
+	def delete(self, key):
+		"""Remove a key."""
+		if (self.redis != None):
+			try:
+				self.redis.delete(key)
+			except Exception, e:
+				print >> sys.stderr, "redis delete() error: '{0}'.".format(e)
+		else:
+			print >> sys.stderr, "ERROR: Redis cache does not exist! Create it first"
+
+	def get_ttl(self, key):
+		"""Return the number of seconds until a key expires, or None if the key does not exist."""
+		if (self.redis != None):
+			try:
+				# TTL returns -2 if the key does not exist and -1 if it never expires
+				ttl = self.redis.ttl(key)
+				if (ttl != None and ttl >= 0):
+					return ttl
+			except Exception, e:
+				print >> sys.stderr, "redis get_ttl() error: '{0}'.".format(e)
+		else:
+			print >> sys.stderr, "ERROR: Redis cache does not exist! Create it first"
+		return None
+
 
 class Pycache(CacheBase):
 	"""
@@ -305,3 +449,225 @@ class Pycache(CacheBase):
 				print >> sys.stderr, "pycache set() error: '{0}'.".format(e)
 		else:
 			print >> sys.stderr, "pycache set() error: cache does not exist! create it before setting values."
+
+	def get_ttl(self, key):
+		"""Return the number of seconds until a key expires, or None if the key does not exist."""
+		if (self.cache != None):
+			try:
+				return self.cache.get_ttl(key)
+			except Exception, e:
+				print >> sys.stderr, "pycache get_ttl() error: '{0}'.".format(e)
+		else:
+			print >> sys.stderr, "pycache get_ttl() error: cache does not exist! create it before retrieving values."
+		return None
+
+
+class NegativeCache(object):
+	"""
+	Remember, for a short time, services we have no data for,
+	so repeated requests for them can be answered without reading the database.
+
+	Entries are kept in local memory, separately from the cache of replies,
+	and hold the reason we have no data.
+	"""
+
+	NO_DATA = 'no data'
+	SCAN_IN_PROGRESS = 'scan in progress'
+	SCAN_FAILED = 'scan failed'
+
+	TTL = 30 # seconds
+	MAX_ENTRIES = 10000
+
+	def __init__(self, ttl=TTL, max_entries=MAX_ENTRIES):
+		"""Create an empty negative cache. A ttl of 0 or less disables it."""
+		self.ttl = ttl
+		self.max_entries = max_entries
+		# every entry has the same ttl, so entries are kept in order of expiry
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, service):
+		"""Return the reason we have no data for a service, or None if there is no current entry."""
+		with self.lock:
+			entry = self.entries.get(service)
+			if (entry == None):
+				return None
+			(reason, expires) = entry
+			if (expires <= time.time()):
+				del self.entries[service]
+				return None
+			return reason
+
+	def set(self, service, reason):
+		"""Record that we have no data for a service."""
+		if (self.ttl <= 0):
+			return
+		now = time.time()
+		with self.lock:
+			self.entries.pop(service, None)
+			self.entries[service] = (reason, now + self.ttl)
+
+			# remove expired entries, then the oldest ones if we are still too big
+			while (len(self.entries) > 0):
+				(oldest, (oldest_reason, expires)) = next(self.entries.iteritems())
+				if (expires > now and len(self.entries) <= self.max_entries):
+					break
+				del self.entries[oldest]
+
+	def remove(self, service):
+		"""Forget any entry for a service - e.g. because we now have data for it."""
+		with self.lock:
+			self.entries.pop(service, None)
+
+	def count(self):
+		"""Return the number of entries, including any that have expired but not been removed."""
+		return len(self.entries)
+
+
+class HotKeys(object):
+	"""
+	Count how often each key is requested, so the most requested keys can be saved to a file
+	and loaded again - e.g. to warm the cache after a restart.
+	"""
+
+	MAX_KEYS = 100000
+
+	def __init__(self, max_keys=MAX_KEYS):
+		"""When more than 'max_keys' keys are counted, the less requested half is forgotten."""
+		self.max_keys = max_keys
+		self.counts = collections.Counter()
+		self.lock = threading.Lock()
+
+	def record(self, key):
+		"""Count one request for a key."""
+		with self.lock:
+			self.counts[key] += 1
+			if (len(self.counts) > self.max_keys):
+				self.counts = collections.Counter(dict(self.counts.most_common(self.max_keys / 2)))
+
+	def top(self, limit):
+		"""Return up to 'limit' keys, most requested first."""
+		with self.lock:
+			return [key for (key, count) in self.counts.most_common(limit)]
+
+	def save(self, path, limit):
+		"""Write the 'limit' most requested keys to a file, one per line."""
+		keys = self.top(limit)
+		# write to a new file and rename it, so readers never see a partial list
+		temp_path = "%s.%d.tmp" % (path, os.getpid())
+		with open(temp_path, 'w') as f:
+			for key in keys:
+				f.write(key + "\n")
+		os.rename(temp_path, path)
+
+	@staticmethod
+	def load(path, limit):
+		"""Return up to 'limit' keys from a file written by save(), or an empty list if there is no file."""
+		keys = []
+		try:
+			with open(path, 'r') as f:
+				for line in f:
+					key = line.strip()
+					if (key != ""):
+						keys.append(key)
+						if (len(keys) >= limit):
+							break
+		except IOError as e:
+			# there is no list until one has been saved
+			if (e.errno != errno.ENOENT):
+				print >> sys.stderr, "Could not read hot key list '%s': '%s'" % (path, e)
+		return keys
+
+
+class SingleFlight(object):
+	"""
+	Make sure only one caller at a time computes the value for a key.
+	Callers that ask for the same key while it is being computed wait for the first caller's result.
+
+	If 'shared_cache' is given, callers in other processes are coordinated too,
+	using a lock key added to that cache.
+	"""
+
+	LOCK_SUFFIX = '|lock'
+	POLL_INTERVAL = 0.05 # seconds
+
+	class Call(object):
+		"""One computation that other callers may be waiting for."""
+		def __init__(self):
+			self.done = threading.Event()
+			self.result = None
+			self.error = None
+
+	def __init__(self, timeout, shared_cache=None):
+		"""
+		Callers wait at most 'timeout' seconds for someone else's result before computing it themselves.
+		A timeout of 0 or less disables waiting.
+		"""
+		self.timeout = timeout
+		self.shared_cache = shared_cache
+		self.calls = {}
+		self.lock = threading.Lock()
+
+	def do(self, key, func, *args):
+		"""
+		Return func(*args), or the result of a call for the same key that is already running.
+		Exceptions raised by that call are raised to every caller that waited for it.
+
+		With a shared cache, func must save its result in the cache under 'key'.
+		"""
+		if (self.timeout <= 0):
+			return func(*args)
+
+		with self.lock:
+			call = self.calls.get(key)
+			first = (call == None)
+			if (first):
+				call = self.Call()
+				self.calls[key] = call
+
+		if (not first):
+			# threading.Event.wait() returns False on timeout
+			if (not call.done.wait(self.timeout)):
+				return func(*args)
+			if (call.error != None):
+				raise call.error
+			return call.result
+
+		try:
+			if (self.shared_cache != None):
+				call.result = self._do_shared(key, func, args)
+			else:
+				call.result = func(*args)
+			return call.result
+		except Exception as e:
+			call.error = e
+			raise
+		finally:
+			with self.lock:
+				del self.calls[key]
+			call.done.set()
+
+	def _do_shared(self, key, func, args):
+		"""Compute the value unless another process already is, in which case wait for it to appear in the cache."""
+		lock_key = key + self.LOCK_SUFFIX
+		# if we die while holding the lock, it expires by itself
+		acquired = self.shared_cache.add(lock_key, "1", int(math.ceil(self.timeout)))
+
+		if (acquired == False):
+			deadline = time.time() + self.timeout
+			while (time.time() < deadline):
+				time.sleep(self.POLL_INTERVAL)
+				found = self.shared_cache.get_multi([key, lock_key])
+				if (key in found):
+					return found[key]
+				if (lock_key not in found):
+					# the other process finished without saving a value (e.g. there was an error)
+					break
+			return func(*args)
+
+		# if the cache is unavailable (acquired is None) we can still compute the value
+		try:
+			return func(*args)
+		finally:
+			if (acquired):
+				self.shared_cache.delete(lock_key)
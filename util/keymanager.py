@@ -110,15 +110,16 @@ class keymanager:
 		return parser
 
 
-	def get_keys(self):
+	def get_keys(self, create=True):
 		"""
 		Read and return a public/private key pair, creating them if necessary.
+		If 'create' is False, key files that do not exist are not created.
 		If valid keys cannot be created or read, return (None, None).
 		"""
 		if (self.envkeys):
 			(pub_key, priv_key) = self.get_env_keys()
 		else:
-			(pub_key, priv_key) = self.get_file_keys(self.private_key)
+			(pub_key, priv_key) = self.get_file_keys(self.private_key, create)
 
 		if (pub_key == None or priv_key == None):
 			return (None, None)
@@ -167,10 +168,14 @@ class keymanager:
 
 		return (pub_key, priv_key)
 
-	def get_file_keys(self, private_key):
-		"""Read public and private keys from files on disk."""
+	def get_file_keys(self, private_key, create=True):
+		"""Read public and private keys from files on disk, creating them first if 'create' is True."""
 		(pub_file, priv_file) = self.get_keynames(private_key)
-		keygen.generate_keypair(pub_file, priv_file)
+		if (create):
+			keygen.generate_keypair(pub_file, priv_file)
+		elif not (os.path.isfile(priv_file) and os.path.isfile(pub_file)):
+			print >> sys.stderr, "Error: key files '%s' and '%s' do not exist." % (priv_file, pub_file)
+			return (None, None)
 		try:
 			with open(priv_file,'r') as priv:
 				priv_key = priv.read()
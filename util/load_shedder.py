@@ -0,0 +1,124 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Limit how much work runs at once, and turn away the rest quickly when overloaded.
+"""
+
+from contextlib import contextmanager
+import threading
+import time
+
+
+class Overloaded(Exception):
+	"""Raised when work is turned away because too much is already running."""
+	pass
+
+
+class LoadShedder(object):
+	"""
+	Admit at most a fixed number of jobs at a time - e.g. requests that need the database.
+
+	A job that cannot start right away waits up to 'max_wait' seconds for another to finish;
+	if none does, it is shed (Overloaded is raised) instead of queueing behind work that is already late.
+	"""
+
+	WAIT_SMOOTHING = 0.1 # weight of each new wait time in the average
+	RECOVERY_PERIOD = 1 # seconds without shedding before we report that we have stopped
+
+	def __init__(self, max_in_flight, max_wait, on_change=None):
+		"""
+		A 'max_in_flight' of 0 or less admits everything.
+		on_change(shedding, stats) is called whenever we start or stop shedding jobs.
+		"""
+		self.max_in_flight = max_in_flight
+		self.max_wait = max_wait
+		self.on_change = on_change
+		self.condition = threading.Condition()
+
+		self.in_flight = 0
+		self.waiting = 0
+		self.shedding = False
+		self.last_shed = 0
+		self.admitted = 0
+		self.shed = 0
+		self.average_wait = 0.0 # seconds, for admitted jobs
+
+	@contextmanager
+	def admit(self):
+		"""Run the body of a 'with' block as one job, or raise Overloaded."""
+		if (self.max_in_flight <= 0):
+			yield
+			return
+
+		self._acquire()
+		try:
+			yield
+		finally:
+			with self.condition:
+				self.in_flight -= 1
+				self.condition.notify()
+
+	def _acquire(self):
+		"""Wait for a free slot, or raise Overloaded."""
+		start = time.time()
+		changed = False
+		with self.condition:
+			deadline = start + self.max_wait
+			self.waiting += 1
+			try:
+				while (self.in_flight >= self.max_in_flight):
+					remaining = deadline - time.time()
+					if (remaining <= 0):
+						break
+					self.condition.wait(remaining)
+			finally:
+				self.waiting -= 1
+
+			admitted = (self.in_flight < self.max_in_flight)
+			if (not admitted):
+				self.shed += 1
+				self.last_shed = time.time()
+				changed = (not self.shedding)
+				self.shedding = True
+			else:
+				self.in_flight += 1
+				self.admitted += 1
+				self.average_wait += self.WAIT_SMOOTHING * ((time.time() - start) - self.average_wait)
+				# don't flap between states while only some jobs are being shed
+				if (self.shedding and time.time() - self.last_shed >= self.RECOVERY_PERIOD):
+					changed = True
+					self.shedding = False
+			shedding = self.shedding
+
+		if (changed and self.on_change != None):
+			self.on_change(shedding, self.stats())
+		if (not admitted):
+			raise Overloaded()
+
+	def stats(self):
+		"""Return a dictionary of the limits, current load, and counters."""
+		with self.condition:
+			return {
+				'max_in_flight': self.max_in_flight,
+				'max_wait': self.max_wait,
+				'in_flight': self.in_flight,
+				'waiting': self.waiting,
+				'shedding': self.shedding,
+				'admitted': self.admitted,
+				'shed': self.shed,
+				'average_wait': self.average_wait,
+			}
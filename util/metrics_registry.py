@@ -0,0 +1,183 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Count events and time operations in memory, and print them in the Prometheus text format.
+
+Unlike ndb.report_metric() nothing is written per event:
+each update only takes a lock and adds a number.
+No information about clients or the services they ask for is recorded.
+"""
+
+import bisect
+from contextlib import contextmanager
+import threading
+import time
+
+# seconds. suits everything from a cache lookup to a slow database query
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter(object):
+	"""A number that only goes up."""
+
+	TYPE = 'counter'
+
+	def __init__(self, name, description, func=None):
+		"""If 'func' is given, func() is called for the value instead of counting with inc()."""
+		self.name = name
+		self.description = description
+		self.func = func
+		self.value = 0
+		self.lock = threading.Lock()
+
+	def inc(self, amount=1):
+		with self.lock:
+			self.value += amount
+
+	def get(self):
+		if (self.func != None):
+			return self.func()
+		with self.lock:
+			return self.value
+
+	def samples(self):
+		"""Return a list of (name, labels, value) tuples to print."""
+		return [(self.name, "", self.get())]
+
+
+class Gauge(Counter):
+	"""A number that goes up and down, e.g. the length of a queue."""
+
+	TYPE = 'gauge'
+
+	def set(self, value):
+		with self.lock:
+			self.value = value
+
+
+class Histogram(object):
+	"""Count how many observations fall into each of a fixed set of buckets, e.g. for response times."""
+
+	TYPE = 'histogram'
+
+	def __init__(self, name, description, buckets=DEFAULT_BUCKETS, labels=None):
+		"""
+		'labels': an optional dictionary of label names and values, to tell apart
+		histograms that share a name - e.g. {'phase': 'signing'}.
+		"""
+		self.name = name
+		self.description = description
+		self.labels = "".join('%s="%s",' % (name, value) for (name, value) in sorted((labels or {}).items()))
+		self.buckets = tuple(sorted(buckets))
+		self.counts = [0] * (len(self.buckets) + 1) # the last bucket is +Inf
+		self.sum = 0.0
+		self.lock = threading.Lock()
+
+	def observe(self, value):
+		i = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			self.counts[i] += 1
+			self.sum += value
+
+	@contextmanager
+	def time(self):
+		"""Observe how many seconds the body of a 'with' block takes."""
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.observe(time.time() - start)
+
+	def samples(self):
+		with self.lock:
+			counts = list(self.counts)
+			total = self.sum
+
+		samples = []
+		cumulative = 0
+		for (bound, count) in zip(self.buckets + (float('inf'),), counts):
+			cumulative += count
+			samples.append((self.name + '_bucket', '{%sle="%s"}' % (self.labels, _format_value(bound)), cumulative))
+		labels = ""
+		if (self.labels):
+			labels = "{%s}" % self.labels.rstrip(",")
+		samples.append((self.name + '_sum', labels, total))
+		samples.append((self.name + '_count', labels, cumulative))
+		return samples
+
+
+class Registry(object):
+	"""Hold a set of named metrics and print them all."""
+
+	def __init__(self):
+		self.metrics = []
+		self.names = set()
+		self.lock = threading.Lock()
+
+	def _add(self, metric):
+		key = (metric.name, getattr(metric, 'labels', ""))
+		with self.lock:
+			if (key in self.names):
+				raise ValueError("Metric '%s' is already registered" % metric.name)
+			self.names.add(key)
+			self.metrics.append(metric)
+		return metric
+
+	def counter(self, name, description, func=None):
+		return self._add(Counter(name, description, func))
+
+	def gauge(self, name, description, func=None):
+		return self._add(Gauge(name, description, func))
+
+	def histogram(self, name, description, buckets=DEFAULT_BUCKETS, labels=None):
+		"""Add a histogram. Histograms with the same name must have different labels."""
+		return self._add(Histogram(name, description, buckets, labels))
+
+	def render(self):
+		"""Return every metric in the Prometheus text exposition format."""
+		with self.lock:
+			metrics = list(self.metrics)
+
+		# metrics that share a name are printed together, under one description
+		by_name = {}
+		for metric in metrics:
+			by_name.setdefault(metric.name, []).append(metric)
+
+		lines = []
+		for metric in metrics:
+			same_name = by_name.pop(metric.name, None)
+			if (same_name == None):
+				continue
+			lines.append("# HELP %s %s" % (metric.name, metric.description))
+			lines.append("# TYPE %s %s" % (metric.name, metric.TYPE))
+			for each in same_name:
+				for (name, labels, value) in each.samples():
+					lines.append("%s%s %s" % (name, labels, _format_value(value)))
+		return "\n".join(lines) + "\n"
+
+
+def _format_value(value):
+	"""Format a number the way Prometheus expects."""
+	if (value == float('inf')):
+		return '+Inf'
+	if (isinstance(value, bool)):
+		return str(int(value))
+	if (isinstance(value, float)):
+		return repr(value)
+	return str(value)
@@ -0,0 +1,79 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Pack observation data into the binary format covered by notary signatures.
+
+Notaries sign, and clients verify, the following bytes:
+
+	service name, a zero byte,
+	then for each key, in *reverse* order of the keys in the reply:
+		number of timespans (2 bytes, big-endian), 0, 16, 3,
+		the fingerprint bytes,
+		the start and end time of each timespan (4 bytes each, big-endian)
+
+The server and the clients must produce exactly the same bytes.
+client/client_common.py keeps its own copy of this code so the client does not need the server's files;
+change both together.
+"""
+
+import binascii
+import struct
+
+# bytes that follow the timespan count in each key header
+KEY_HEADER_SUFFIX = (0, 16, 3)
+
+
+def pack_key(fingerprint, timespans):
+	"""
+	Pack one key and its timespans.
+
+	'fingerprint': a hex string with bytes separated by colons - e.g. 'aa:bb:cc'.
+		Bytes may have one digit - 'a:bb' packs the same as '0a:bb'.
+	'timespans': a list of (start, end) pairs, in the order they appear in the reply
+
+	Raises ValueError if the fingerprint is not valid.
+	"""
+	num_timespans = len(timespans)
+	head = struct.pack(">HBBB", num_timespans & 0xFFFF, *KEY_HEADER_SUFFIX)
+
+	parts = fingerprint.split(":")
+	hex_digits = "".join(part.zfill(2) for part in parts)
+	if (len(hex_digits) != 2 * len(parts) or "" in parts):
+		raise ValueError("Invalid fingerprint '%s'" % fingerprint)
+	try:
+		fp_bytes = binascii.unhexlify(hex_digits)
+	except TypeError:
+		raise ValueError("Invalid fingerprint '%s'" % fingerprint)
+
+	# pack every timestamp with one call rather than one call per byte
+	times = [t for pair in timespans for t in pair]
+	ts_bytes = struct.pack(">%dI" % len(times), *times)
+
+	return head + fp_bytes + ts_bytes
+
+def pack_service(service, keys):
+	"""
+	Pack all of the data for a service.
+
+	'keys': a list of (fingerprint, timespans) tuples, in the order they appear in the reply.
+	See pack_key() for details.
+	"""
+	packed_keys = [pack_key(fingerprint, timespans) for (fingerprint, timespans) in keys]
+	# keys are signed in the reverse order they appear
+	packed_keys.reverse()
+
+	return service.encode() + "\x00" + "".join(packed_keys)
@@ -28,15 +28,13 @@ Make sure you have enough memory to use the cache you request!
 # Use a module so python can ensure there is only one cache regardless of threads.
 # Note this doesn't allow inheritance; if we need that we will need to refactor.
 
-import heapq
-import itertools
 import sys
 import threading
 import time
 
-# Note: the maximum cache size applies only to stored data;
+# Note: the maximum cache size applies only to stored keys and data;
 # the internal structures used to for implementation will cause pycache
-# to use slightly more memory.
+# to use slightly more memory (a fixed amount per entry).
 DEFAULT_CACHE_SIZE = 50 * 1024 * 1024 # bytes
 
 
@@ -49,22 +47,14 @@ class CacheEntry(object):
 		if (expiry < 1):
 			raise ValueError("CacheEntry expiry values must be positive")
 
-		now = int(time.time())
-
 		self.key = key
 		self.data = data
-		self.expiry = now + expiry
-		self.memory_used = sys.getsizeof(data)
-
-		# count the key as having been requested just now, so it is not immediately removed.
-		# this is usually correct, as the caller will likely have just retrieved or calculated
-		# the data before calling us to store it.
-		# this also prevents thrashing so new entries are not rapidly added and then removed from the heap.
-		self.last_requested = now
+		self.expiry = int(time.time()) + expiry
+		self.memory_used = sys.getsizeof(key) + sys.getsizeof(data)
 
-	def update_request_time(self):
-		"""Update the most recent request time for this cache entry."""
-		self.last_requested = int(time.time())
+		# neighbours in the 'least recently used' list
+		self.prev = None
+		self.next = None
 
 	def has_expired(self):
 		"""Returns true if this entry has expired; false otherwise."""
@@ -73,118 +63,75 @@ class CacheEntry(object):
 		return False
 
 
-class Heap(object):
-	"""Store CacheEntries in a heap.
-	Entries are stored in 'least recently used' order
-	so we know what to remove when we run out of space."""
-
-	# This is a wrapper class to allow use of the heapq module in an Object-Oriented way,
-	# and to contain the logic for our priority queue.
-	# The heap does not store the cached data; it is only used to track the 'least recently used' order
-	# so cache entries can be removed when we need space.
+class LruList(object):
+	"""
+	A circular doubly linked list of CacheEntries, from least to most recently used.
+	Adding, moving, and removing an entry all take constant time.
+	"""
 
-	# This heap uses lazy deletion - entries are not deleted immediately, as we don't want
-	# to spend time traversing and re-creating the heap each time.
-	# Instead entries are marked for deletion and removed when they are encountered via popping.
-
-	# Performance Note:
-	# We could add checks to recreate the heap list if old entries are taking up too much space,
-	# but with keys expiring it should be fine for now.
-	# We could also add a check to see if the counter has grown too large, but iterators use
-	# an infinite stream, so it shouldn't be necessary.
+	# the list object itself is the sentinel node at both ends,
+	# so no operation needs to check for an empty list or missing neighbour
 
 	def __init__(self):
-		"""Create a new heap."""
-		self.heap = []
-		self.current_entries = {}
-		self.counter = itertools.count()
-
-	def __len__(self):
-		"""Return the number of items in the heap."""
-		return len(self.heap)
-
-	def __del__(self):
-		"""Delete the heap."""
-		del self.heap
-		del self.current_entries
+		self.prev = self
+		self.next = self
 
 	def clear(self):
-		"""Remove all items from the heap."""
-		self.current_entries.clear()
-		del self.heap
-		self.heap = []
-
-	def push(self, cache_entry):
-		"""Add an entry onto the heap."""
-		# use an iterator to break ties if multiple keys are added in the same second;
-		# this ensures tuple comparison works in python 3.
-		# credit for this idea goes to the python docs -
-		# http://docs.python.org/2/library/heapq.html
-		entry_id = next(self.counter)
-
-		heap_entry = [cache_entry.last_requested, entry_id, cache_entry.key]
-		self.current_entries[cache_entry.key] = entry_id
-		heapq.heappush(self.heap, heap_entry)
-
-	def update(self, cache_entry):
-		"""Update the value of a heap entry."""
-		# this is a convenience function to make it easier to understand what's happening.
-		# entries are not actually updated in-place (that takes too long);
-		# instead a new entry is created and the current one marked for lazy deletion later
-		# (the entry is 'marked' for deletion by replacing the entry_id for that key in current_entries)
-		self.push(cache_entry)
-
-	def pop(self):
-		"""Remove the least recently used heap entry."""
-		while self.heap:
-			last_requested, entry_id, key = heapq.heappop(self.heap)
-			if (key in self.current_entries and (self.current_entries[key] == entry_id)):
-				del self.current_entries[key]
-				return key
-			# otherwise the element we just popped is either expired or an old junk entry;
-			# discard it and continue.
-		raise IndexError("Heap has no entries to pop")
-
-	def remove(self, cache_entry):
-		"""Remove the entry from the heap."""
-		# a convenience function: entries are not removed immediately but marked for lazy deletion.
-		if cache_entry.key in self.current_entries:
-			del self.current_entries[cache_entry.key]
-		# else: don't worry - some other thread might have removed the entry just before us.
+		self.prev = self
+		self.next = self
+
+	def append(self, entry):
+		"""Add an entry as the most recently used."""
+		last = self.prev
+		entry.prev = last
+		entry.next = self
+		last.next = entry
+		self.prev = entry
+
+	def remove(self, entry):
+		"""Remove an entry from the list."""
+		entry.prev.next = entry.next
+		entry.next.prev = entry.prev
+		entry.prev = None
+		entry.next = None
+
+	def move_to_end(self, entry):
+		"""Mark an entry in the list as the most recently used."""
+		entry.prev.next = entry.next
+		entry.next.prev = entry.prev
+		self.append(entry)
+
+	def oldest(self):
+		"""Return the least recently used entry, or None if the list is empty."""
+		if (self.next is self):
+			return None
+		return self.next
+
+
+def __delete_entry(entry):
+	"""Remove this entry from the cache."""
+	global current_mem
+
+	lru.remove(entry)
+	del cache[entry.key]
+	current_mem -= entry.memory_used
 
 
 def __free_memory(mem_needed):
-	"""Remove entries from the heap and cache until we have enough free memory."""
-	global current_mem
-	global max_mem
-
-	with mem_lock:
-		while heap and (current_mem + mem_needed > max_mem):
-			key = heap.pop()
-			if key in cache:
-				# naive implementation - we don't worry about discarding a non-expired item
-				# before all expired items are gone.
-				# we just want to clear *some* memory for the new item as fast as possible.
-				# if this really hurts performance we could refactor.
-				__delete_key(key)
-			else:
-				raise KeyError("The heap key '%s' does not exist in the cache and cannot be removed." % (key))
-
-
-def __delete_key(key):
-	"""Remove this entry from the cache."""
+	"""Remove the least recently used entries until we have enough free memory."""
 	global current_mem
 
-	with mem_lock:
-		current_mem -= cache[key].memory_used
-		del cache[key]
+	while cache and (current_mem + mem_needed > max_mem):
+		# we don't worry about discarding a non-expired item before all expired items are gone;
+		# we just want to clear *some* memory for the new item as fast as possible.
+		__delete_entry(lru.oldest())
 
 
 def set_cache_size(size):
 	"""Set the maximum amount of RAM to use, in bytes."""
 	size = int(size)
 	if size > 0:
-		with mem_lock:
+		with lock:
 			global max_mem
 			max_mem = size
 
@@ -203,81 +150,70 @@ def clear():
 	"""Delete all entries from the cache."""
 	global current_mem
 
-	with mem_lock:
+	with lock:
 		cache.clear()
-		heap.clear()
+		lru.clear()
 		current_mem = 0
 
 
 def set(key, data, expiry):
 	"""Save the value to a given key."""
 	global current_mem
-	global max_mem
-
-	with set_lock:
-		if key in set_threads:
-			# some other thread is already updating the value for this key.
-			# don't compete or waste time calculating a possibly duplicate value
-			return
-		else:
-			set_threads[key] = True
-
-	try:
-		entry = CacheEntry(key, data, expiry)
 
-		if (entry.memory_used > max_mem):
-			print >> sys.stderr, "ERROR: cannot store data for '%s' - it's larger than the max cache size (%s bytes)\n" \
-				% (key, max_mem)
-			return
+	entry = CacheEntry(key, data, expiry)
 
-		with mem_lock:
+	if (entry.memory_used > max_mem):
+		print >> sys.stderr, "ERROR: cannot store data for '%s' - it's larger than the max cache size (%s bytes)\n" \
+			% (key, max_mem)
+		return
 
-			# add/replace the entry in the hash;
-			# this tracks whether we have the key at all.
-			if entry.key in cache:
-				current_mem -= cache[key].memory_used # subtract the memory we gain back
+	with lock:
+		# replace any existing entry; the new one is the most recently used
+		if key in cache:
+			__delete_entry(cache[key])
 
-			if (current_mem + entry.memory_used > max_mem):
-				__free_memory(entry.memory_used)
+		if (current_mem + entry.memory_used > max_mem):
+			__free_memory(entry.memory_used)
 
-			heap.push(entry)
-			cache[key] = entry
-			current_mem += entry.memory_used
-
-	finally:
-		del set_threads[key]
+		cache[key] = entry
+		lru.append(entry)
+		current_mem += entry.memory_used
 
 
 def get(key):
 	"""Retrieve the value for a given key, or None if no key exists."""
-	if key not in cache:
-		return None
+	with lock:
+		entry = cache.get(key)
+		if (entry == None):
+			return None
 
-	if (cache[key].has_expired()):
-		heap.remove(cache[key])
-		__delete_key(key)
-		return None
+		if (entry.has_expired()):
+			__delete_entry(entry)
+			return None
 
-	cache[key].update_request_time()
-	heap.update(cache[key])
+		lru.move_to_end(entry)
+		return entry.data
 
-	return cache[key].data
 
+def get_ttl(key):
+	"""Return the number of seconds until a key expires, or None if no key exists."""
+	# don't count this as a request for the key
+	entry = cache.get(key)
+	if (entry == None or entry.has_expired()):
+		return None
+	return entry.expiry - int(time.time())
 
 
 # Use a dictionary to efficiently store/retrieve data
-# and a heap to maintain a 'least recently used' order.
+# and a linked list to maintain a 'least recently used' order.
+# Finding, touching, and evicting an entry all take constant time,
+# and the list never holds more than one node per entry.
 cache = {}
-heap = Heap()
+lru = LruList()
 
 current_mem = 0 # bytes
 max_mem = DEFAULT_CACHE_SIZE
 
-
-# we don't care if we get a slightly out of date value when retrieving,
-# but prevent multiple set() calls from writing data for the same key at the same time.
-set_threads = {}
-set_lock = threading.Lock()
-
-# prevent multiple threads from altering memory counts at the same time
-mem_lock = threading.RLock()
+# every change to the cache or its order happens under this lock,
+# so an entry can't be evicted by one thread while another is reading it
+lock = threading.RLock()
@@ -0,0 +1,139 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Scan services in the background with a fixed pool of worker threads.
+"""
+
+import heapq
+import itertools
+import sys
+import threading
+import traceback
+
+
+class ScanQueue(object):
+	"""
+	A queue of services waiting to be scanned, and the threads that scan them.
+
+	Each service is queued at most once. Asking for a service that is already
+	queued raises its priority instead, so services requested by more clients are scanned first.
+	Worker threads are started the first time a service is added,
+	so a queue created before the process forks still works in the child.
+	"""
+
+	WORKERS = 10 # simultaneous scans
+	MAX_QUEUED = 1000 # services waiting to be scanned
+
+	def __init__(self, scan_func, num_workers=WORKERS, max_queued=MAX_QUEUED):
+		"""
+		scan_func(service) is called on a worker thread for each service;
+		exceptions it raises are printed and otherwise ignored.
+		"""
+		self.scan_func = scan_func
+		self.num_workers = num_workers
+		self.max_queued = max_queued
+
+		self.requests = {} # queued service -> number of times it was requested
+		self.heap = [] # (-requests, order, service). entries with an old request count are skipped
+		self.order = itertools.count() # scan services with the same count in the order they arrived
+		self.scanning = set()
+		self.threads = []
+		self.condition = threading.Condition()
+
+		self.added = 0
+		self.dropped = 0
+		self.completed = 0
+
+	def add(self, service):
+		"""
+		Queue a service to be scanned, unless it is already queued or being scanned.
+		Returns False if the queue is full and the service could not be added.
+		"""
+		with self.condition:
+			if (service in self.scanning):
+				return True
+
+			if (service in self.requests):
+				self.requests[service] += 1
+			elif (len(self.requests) >= self.max_queued):
+				self.dropped += 1
+				return False
+			else:
+				self.requests[service] = 1
+				self.added += 1
+
+			heapq.heappush(self.heap, (-self.requests[service], next(self.order), service))
+			if (len(self.heap) > 4 * len(self.requests) + 100):
+				self._compact()
+
+			if (len(self.threads) == 0):
+				self._start_workers()
+			self.condition.notify()
+		return True
+
+	def _compact(self):
+		"""Rebuild the heap without stale entries. Caller must hold the lock."""
+		self.heap = [entry for entry in self.heap
+			if self.requests.get(entry[2]) == -entry[0]]
+		heapq.heapify(self.heap)
+
+	def _start_workers(self):
+		"""Start the worker threads. Caller must hold the lock."""
+		for i in range(self.num_workers):
+			t = threading.Thread(target=self._work, name="scan-%d" % i)
+			t.daemon = True
+			t.start()
+			self.threads.append(t)
+
+	def _next_service(self):
+		"""Wait for and return the queued service with the most requests."""
+		with self.condition:
+			while True:
+				while (len(self.heap) == 0):
+					self.condition.wait()
+				(count, order, service) = heapq.heappop(self.heap)
+				if (self.requests.get(service) == -count):
+					del self.requests[service]
+					self.scanning.add(service)
+					return service
+
+	def _work(self):
+		"""Scan services from the queue, forever."""
+		while True:
+			service = self._next_service()
+			try:
+				self.scan_func(service)
+			except Exception:
+				print >> sys.stderr, "Error scanning '%s'" % service
+				traceback.print_exc(file=sys.stderr)
+			finally:
+				with self.condition:
+					self.scanning.discard(service)
+					self.completed += 1
+
+	def stats(self):
+		"""Return a dictionary of the queue's current size and counters."""
+		with self.condition:
+			return {
+				'workers': self.num_workers,
+				'max_queued': self.max_queued,
+				'queued': len(self.requests),
+				'scanning': len(self.scanning),
+				'added': self.added,
+				'dropped': self.dropped,
+				'completed': self.completed,
+			}
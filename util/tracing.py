@@ -0,0 +1,168 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Time the phases of a sample of requests, to show where the time goes in slow ones.
+
+Only phase names and durations are recorded - never services, addresses, or anything else about clients.
+"""
+
+from contextlib import contextmanager
+import itertools
+import sys
+import threading
+import time
+
+
+class Trace(object):
+	"""The phases of one request and how long each took."""
+
+	def __init__(self, tracer, kind):
+		self.tracer = tracer
+		self.kind = kind
+		self.start = time.time()
+		self.phases = [] # (name, seconds), in the order they finished
+
+	def add(self, name, seconds):
+		# list.append() is atomic, so threads working on the same request can all add phases
+		self.phases.append((name, seconds))
+
+	def totals(self):
+		"""Return a list of (name, total seconds, count) for each phase, in the order each phase first finished."""
+		totals = {}
+		order = []
+		for (name, seconds) in self.phases:
+			if (name not in totals):
+				totals[name] = [0.0, 0]
+				order.append(name)
+			totals[name][0] += seconds
+			totals[name][1] += 1
+		return [(name, totals[name][0], totals[name][1]) for name in order]
+
+	def finish(self):
+		"""Record the request's phases - see Tracer.finish()."""
+		self.tracer.finish(self)
+
+
+class Tracer(object):
+	"""
+	Trace one in every 'sample_every' requests.
+
+	Code times a phase with 'with tracer.phase(name):'. Unless it is also given a histogram this does nothing
+	when the thread is not working on a traced request (see activate()), so it is cheap to leave in place.
+	When a traced request finishes its phase times are added to histograms in 'registry',
+	and if it took at least 'slow_threshold' seconds its phases are written as one line to 'slow_log'.
+	"""
+
+	def __init__(self, sample_every, slow_threshold=None, slow_log=None, registry=None):
+		"""
+		'sample_every': trace one in this many requests. 0 turns tracing off.
+		'slow_log': a file opened for appending, or None.
+		'registry': a metrics_registry.Registry, or None.
+		"""
+		self.sample_every = sample_every
+		self.slow_threshold = slow_threshold
+		self.slow_log = slow_log
+		self.registry = registry
+		self.requests = itertools.count()
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.histograms = {}
+
+	def start(self, kind):
+		"""Return a Trace for a new request of type 'kind' if it is sampled, otherwise None."""
+		if (self.sample_every <= 0 or next(self.requests) % self.sample_every != 0):
+			return None
+		return Trace(self, kind)
+
+	@contextmanager
+	def activate(self, trace):
+		"""Record the phases timed by this thread in the body of a 'with' block in 'trace' (which may be None)."""
+		previous = getattr(self.local, 'trace', None)
+		self.local.trace = trace
+		try:
+			yield
+		finally:
+			self.local.trace = previous
+
+	def wrap(self, trace, func):
+		"""Return a function that calls func() with 'trace' active, e.g. to run on another thread."""
+		if (trace == None):
+			return func
+		def traced(*args):
+			with self.activate(trace):
+				return func(*args)
+		return traced
+
+	@contextmanager
+	def phase(self, name, histogram=None):
+		"""
+		Time the body of a 'with' block as phase 'name' of the active trace, if there is one.
+		If 'histogram' is given the time is also added to it, whether or not the request is traced.
+		"""
+		trace = getattr(self.local, 'trace', None)
+		if (trace == None and histogram == None):
+			yield
+			return
+		start = time.time()
+		try:
+			yield
+		finally:
+			seconds = time.time() - start
+			if (histogram != None):
+				histogram.observe(seconds)
+			if (trace != None):
+				trace.add(name, seconds)
+
+	def finish(self, trace):
+		"""Record the phases of a finished request. 'trace' may be None."""
+		if (trace == None):
+			return
+		total = time.time() - trace.start
+		totals = trace.totals()
+
+		if (self.registry != None):
+			self._histogram('total').observe(total)
+			for (name, seconds, count) in totals:
+				self._histogram(name).observe(seconds)
+
+		if (self.slow_log != None and self.slow_threshold != None and total >= self.slow_threshold):
+			self._log_slow(trace, total, totals)
+
+	def _histogram(self, phase):
+		with self.lock:
+			if (phase not in self.histograms):
+				self.histograms[phase] = self.registry.histogram('notary_request_phase_seconds',
+					"Time spent in each phase of a sample of requests, and in the whole request (phase 'total').",
+					labels={'phase': phase})
+			return self.histograms[phase]
+
+	def _log_slow(self, trace, total, totals):
+		parts = [time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(trace.start)), trace.kind,
+			"total=%.2fms" % (total * 1000)]
+		for (name, seconds, count) in totals:
+			if (count > 1):
+				parts.append("%s=%.2fms/%d" % (name, seconds * 1000, count))
+			else:
+				parts.append("%s=%.2fms" % (name, seconds * 1000))
+		parts.append("other=%.2fms" % ((total - sum(seconds for (name, seconds, count) in totals)) * 1000))
+		line = " ".join(parts) + "\n"
+		with self.lock:
+			try:
+				self.slow_log.write(line)
+				self.slow_log.flush()
+			except IOError as e:
+				print >> sys.stderr, "Error writing to the slow request log: '%s'" % e